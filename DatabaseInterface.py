@@ -1,7 +1,79 @@
 import psycopg2
+import threading
+from contextlib import contextmanager
+from psycopg2.extras import execute_batch, execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 
 from config import DB_SETTINGS
 
+class ConnectionState(object):
+  """
+  holds a connection, its cursor, the number of open
+  DBInterface.transaction blocks using them and the functions to call if
+  their transaction is rolled back
+  """
+  def __init__(self):
+    self.connection = None
+    self.cursor = None
+    self.transaction_depth = 0
+    self.rollback_hooks = []
+
+
+class ThreadConnectionState(threading.local,ConnectionState):
+  """
+  a ConnectionState that is separate for every thread
+  used by DBInterface in pooled mode, where it also holds the PooledConnection
+  of the thread
+  """
+  def __init__(self):
+    ConnectionState.__init__(self)
+    self.lease = None
+
+
+class PooledConnection(object):
+  """
+  a connection checked out of a pool, and the pool slot it takes
+  it is only referenced from the ThreadConnectionState of the thread that
+  checked it out, so if the thread exits without calling
+  DBInterface.close_connection it is released when the thread's state is
+  freed, instead of keeping the slot forever
+  """
+  def __init__(self,pool,pool_slots,connection):
+    self.pool = pool
+    self.pool_slots = pool_slots
+    self.connection = connection
+
+  def release(self):
+    """
+    rolls back anything left unfinished and hands the connection back to the
+    pool, closing it if the pool has been closed since
+    """
+    connection, self.connection = self.connection, None
+    if connection is None:
+      return
+    try:
+      if not connection.closed:
+        connection.rollback()
+      self.pool.putconn(connection)
+    except (psycopg2.Error,PoolError):
+      connection.close()
+    finally:
+      self.pool_slots.release()
+
+  def __del__(self):
+    self.release()
+
+
+class StatementConnection(psycopg2.extensions.connection):
+  """
+  psycopg2 connection that remembers the names of the server-side prepared
+  statements created on it
+  """
+  def __init__(self,*args,**kwargs):
+    psycopg2.extensions.connection.__init__(self,*args,**kwargs)
+    self.prepared_statements = set()
+
+
 class DBInterface(object):
 
   the_interface = None
@@ -22,17 +94,85 @@ class DBInterface(object):
   INIT
   Saves the connection settings from DB_SETTINGS in config.py
   Sets connection and cursor to None
+  If DB_SETTINGS["pooled"] is set, connections come from a thread-safe pool
+    holding between DB_SETTINGS["min_connections"] and 
+    DB_SETTINGS["max_connections"] connections, and each thread checks out 
+    its own connection and cursor
+  Otherwise one connection and cursor are shared by the whole process
   """
   def __init__(self):
-    self.the_connection = None
-    self.the_cursor = None
     self.hostname = DB_SETTINGS["hostname"]
     self.db_name = DB_SETTINGS["db_name"]
     self.username = DB_SETTINGS["username"]
     self.password = DB_SETTINGS["password"]
+    self.pooled = DB_SETTINGS.get("pooled",False)
+    self.min_connections = DB_SETTINGS.get("min_connections",1)
+    self.max_connections = DB_SETTINGS.get("max_connections",1)
+    self.the_pool = None
+    self.pool_lock = threading.Lock()
+    #limits checked out connections so threads wait instead of erroring
+    self.pool_slots = threading.BoundedSemaphore(self.max_connections)
+    if self.pooled:
+      self.state = ThreadConnectionState()
+    else:
+      self.state = ConnectionState()
+    #statements keyed by (kind,tablename,columns), see get_statement
+    self.statement_cache = {}
+    self.statement_lock = threading.Lock()
+    self.statement_cache_hits = 0
+    self.statement_cache_misses = 0
+    self.prepared_count = 0
+    #used to give every named cursor a unique name
+    self.named_cursor_count = 0
+
+  #the connection, cursor and transaction depth live in self.state so that
+  #they can be per thread in pooled mode
+  @property
+  def the_connection(self):
+    return self.state.connection
+
+  @the_connection.setter
+  def the_connection(self,connection):
+    self.state.connection = connection
+
+  @property
+  def the_cursor(self):
+    return self.state.cursor
+
+  @the_cursor.setter
+  def the_cursor(self,cursor):
+    self.state.cursor = cursor
+
+  @property
+  def transaction_depth(self):
+    return self.state.transaction_depth
+
+  @transaction_depth.setter
+  def transaction_depth(self,depth):
+    self.state.transaction_depth = depth
+
+  """
+  SUMMARY: builds the psycopg2 connection string from the settings
+  INPUT: None
+  OUTPUT: connection string
+  """
+  def get_conn_string(self):
+    conn_string = ""
+    if self.hostname:
+      conn_string += "host=" + self.hostname + " "
+    if self.db_name:
+      conn_string += "dbname=" + self.db_name + " "
+    if self.username:
+      conn_string += "user=" + self.username + " "
+    if self.password:
+      conn_string += "password=" + self.password
+    return conn_string
 
   """
   SUMMARY: attempts to establish connection to database defined in config.py
+           in pooled mode, checks out a connection from the pool for the
+           calling thread, waiting if all of them are in use; it goes back
+           to the pool on close_connection or when the thread exits
   INPUT: None
   OUTPUT: None
   """
@@ -41,17 +181,15 @@ class DBInterface(object):
     if self.is_connected() and self.has_cursor():
       return
     if not self.is_connected():
-      conn_string = ""
-      if self.hostname:
-        conn_string += "host=" + self.hostname + " "
-      if self.db_name:
-        conn_string += "dbname=" + self.db_name + " "
-      if self.username:
-        conn_string += "user=" + self.username + " "
-      if self.password:
-        conn_string += "password=" + self.password
+      conn_string = self.get_conn_string()
       try:
-        connection = psycopg2.connect(conn_string)
+        if self.pooled:
+          connection = self.checkout_connection()
+          self.state.lease = PooledConnection(self.the_pool,self.pool_slots,
+                                              connection)
+        else:
+          connection = psycopg2.connect(conn_string,
+                                        connection_factory=StatementConnection)
       except psycopg2.Error as e:
         print("Error in DatabaseInterface.connect")
         print("Unable to connect to database with given connections string")
@@ -60,6 +198,25 @@ class DBInterface(object):
       self.the_connection = connection
     if not self.has_cursor():
       self.the_cursor = self.the_connection.cursor()
+
+  """
+  SUMMARY: takes a connection from the pool, creating the pool on first use
+  INPUT: None
+  OUTPUT: a psycopg2 connection
+  """
+  def checkout_connection(self):
+    with self.pool_lock:
+      if not self.the_pool:
+        self.the_pool = ThreadedConnectionPool(self.min_connections,
+                                               self.max_connections,
+                                               self.get_conn_string(),
+                                               connection_factory=StatementConnection)
+    self.pool_slots.acquire()
+    try:
+      return self.the_pool.getconn()
+    except:
+      self.pool_slots.release()
+      raise
     
   """
   SUMMARY: True if open connection, False if not
@@ -87,15 +244,113 @@ class DBInterface(object):
     
   """
   SUMMARY: Close the connection and reset the_connection instance variable
+           in pooled mode, the calling thread's connection is handed back to 
+           the pool instead of being closed
   INPUT: None
   OUTPUT: None
   """
   def close_connection(self):
-    self.the_cursor.close()
+    if self.the_cursor:
+      self.the_cursor.close()
     self.the_cursor = None
-    self.the_connection.close()
+    if self.the_connection:
+      if self.pooled:
+        #don't hand a half finished transaction to the next thread
+        self.rollback()
+        self.state.lease.release()
+        self.state.lease = None
+      else:
+        self.the_connection.close()
     self.the_connection = None
 
+  """
+  SUMMARY: closes every connection in the pool
+  INPUT: None
+  OUTPUT: None
+  """
+  def close_pool(self):
+    with self.pool_lock:
+      if self.the_pool:
+        self.the_pool.closeall()
+        self.the_pool = None
+
+  @contextmanager
+  def thread_connection(self):
+    """
+    context manager for worker threads in pooled mode
+    checks out a connection for the calling thread and returns it to the pool
+    when the block exits
+    """
+    self.connect()
+    try:
+      yield self
+    finally:
+      self.close_connection()
+
+  """
+  SUMMARY: commits the current transaction, unless a DBInterface.transaction
+           block is open, in which case the commit happens when it exits
+  INPUT: None
+  OUTPUT: None
+  """
+  def commit(self):
+    if self.transaction_depth:
+      return
+    self.the_connection.commit()
+    self.state.rollback_hooks = []
+
+  """
+  SUMMARY: rolls back the current transaction and calls the functions
+           registered for it with on_rollback, most recent first
+  INPUT: None
+  OUTPUT: None
+  """
+  def rollback(self):
+    self.the_connection.rollback()
+    hooks = self.state.rollback_hooks
+    self.state.rollback_hooks = []
+    for hook in reversed(hooks):
+      hook()
+
+  """
+  SUMMARY: registers a function to call if the open transaction is rolled
+           back, so that state kept outside the database can be put back
+           outside a DBInterface.transaction block every statement is
+           committed on its own, so nothing is registered
+  INPUT: function taking no arguments
+  OUTPUT: None
+  """
+  def on_rollback(self,hook):
+    if self.transaction_depth:
+      self.state.rollback_hooks.append(hook)
+
+  @contextmanager
+  def transaction(self):
+    """
+    context manager that groups every statement run inside it into a single
+    transaction
+    commits once when the outermost block exits, rolls back on an exception
+    and calls the functions registered with on_rollback
+    blocks can be nested, only the outermost one commits
+    """
+    self.connect()
+    self.transaction_depth += 1
+    try:
+      yield self
+    except GeneratorExit:
+      #a generator holding the block was closed early, that is not an error
+      #so the work done inside it is kept
+      self.transaction_depth -= 1
+      self.commit()
+      raise
+    except:
+      self.transaction_depth -= 1
+      if not self.transaction_depth:
+        self.rollback()
+      raise
+    self.transaction_depth -= 1
+    self.commit()
+
   """
   SUMMARY: Checks if a table exists in the database
   INPUT: table name for query
@@ -114,22 +369,176 @@ class DBInterface(object):
     else:
       return False
 
-  def create_table(self,tablename,col_dict):
+  def create_table(self,tablename,col_dict,indexes=(),unique_indexes=()):
     """
     create a table with the given name and columns
     col_dict is of the form col_dict[column_name] = sql_type
     where sql_type is a string
+    indexes (optional) is a list of tuples of column names to index, see
+      create_index
+    unique_indexes (optional) is a list of tuples of column names to create a
+      unique index on
     """
     creation_string = "CREATE TABLE " + tablename + " ("
     col_list = [name+" "+sql_type for (name,sql_type) in col_dict.iteritems()]
     creation_string += ", ".join(col_list) + ");"
     self.connect()
+    with self.transaction():
+      try:
+        self.the_cursor.execute(creation_string)
+      except psycopg2.Error as e:
+        print("ERROR in DBInterface.create_table")
+        raise e
+      for columns in indexes:
+        self.create_index(tablename,columns)
+      for columns in unique_indexes:
+        self.create_index(tablename,columns,unique=True)
+
+  def create_index(self,tablename,columns,unique=False):
+    """
+    create an index on the given columns of a table unless it exists
+    the index is named by index_name
+    """
+    index_name = self.index_name(tablename,columns,unique)
+    query_string = "CREATE %sINDEX IF NOT EXISTS %s ON %s (%s);" % \
+                   ("UNIQUE " if unique else "",index_name,tablename,
+                    ", ".join(columns))
+    self.connect()
     try:
-      self.the_cursor.execute(creation_string)
+      self.the_cursor.execute(query_string)
     except psycopg2.Error as e:
-      print("ERROR in DBInterface.create_table")
+      print("ERROR in DBInterface.create_index")
+      print("Attempted query: " + query_string)
       raise e
-    self.the_connection.commit()
+    self.commit()
+
+  @staticmethod
+  def index_name(tablename,columns,unique=False):
+    """
+    returns the name create_index gives an index,
+    <tablename>_<column>_..._idx, or ..._key if unique
+    """
+    return "_".join([tablename] + list(columns) + ["key" if unique else "idx"])
+
+  """
+  SUMMARY: finds the values of some columns that more than one row shares,
+           which would make creating a unique index on them fail
+           rows with a NULL in any of the columns are ignored, as they are
+           by a unique index
+  INPUT: tablename
+         list of column names
+         limit (optional), maximum number of values returned
+  OUTPUT: 2-tuple (number of duplicated values, list of up to limit 2-tuples
+          (tuple of the values, number of rows), most rows first)
+  """
+  def find_duplicates(self,tablename,columns,limit=10):
+    column_list = ", ".join(columns)
+    not_null = " AND ".join(["%s IS NOT NULL" % col for col in columns])
+    query_string = """SELECT %s, count(*) AS copies, count(*) OVER ()
+                      FROM %s WHERE %s
+                      GROUP BY %s HAVING count(*) > 1
+                      ORDER BY copies DESC, %s LIMIT %%(limit)s;""" % \
+                   (column_list,tablename,not_null,column_list,column_list)
+    self.connect()
+    try:
+      self.the_cursor.execute(query_string,{"limit":limit})
+    except psycopg2.Error as e:
+      print("Error in DatabaseInterface.find_duplicates")
+      print("Attempted query: " + query_string)
+      raise e
+    rows = self.the_cursor.fetchall()
+    if not rows:
+      return (0,[])
+    return (rows[0][-1],[(tuple(row[:-2]),row[-2]) for row in rows])
+
+  """
+  SUMMARY: merges the rows that share a value of a column into the one with
+           the lowest id, the others are deleted after every reference to
+           them is changed to the row that is kept
+           used before creating a unique index on a column that did not have
+           one
+  INPUT: tablename
+         column name
+         references, list of 2-tuples (tablename, column) of the columns
+           holding ids of rows of tablename
+  OUTPUT: the number of rows deleted
+  """
+  def merge_duplicates(self,tablename,column,references=()):
+    merged = """(SELECT id, min(id) OVER (PARTITION BY %s) AS keep_id
+                 FROM %s WHERE %s IS NOT NULL) AS merged""" % \
+             (column,tablename,column)
+    query_strings = ["""UPDATE %s SET %s = merged.keep_id FROM %s
+                        WHERE %s.%s = merged.id AND merged.id <> merged.keep_id;"""
+                     % (ref_table,ref_column,merged,ref_table,ref_column)
+                     for (ref_table,ref_column) in references]
+    query_strings.append("""DELETE FROM %s USING %s
+                            WHERE %s.id = merged.id AND merged.id <> merged.keep_id;"""
+                         % (tablename,merged,tablename))
+    self.connect()
+    with self.transaction():
+      for query_string in query_strings:
+        try:
+          self.the_cursor.execute(query_string)
+        except psycopg2.Error as e:
+          print("Error in DatabaseInterface.merge_duplicates")
+          print("Attempted query: " + query_string)
+          raise e
+      deleted = self.the_cursor.rowcount
+    return deleted
+
+  """
+  SUMMARY: loads the columns and indexes of many tables in one query
+  INPUT: list of table names
+  OUTPUT: dict of table name to a 2-tuple (set of column names, set of index
+          names), or to None if the table does not exist
+  """
+  def get_catalog(self,tablenames):
+    tablenames = list(tablenames)
+    query_string = """SELECT 'column', table_name, column_name
+                      FROM information_schema.columns
+                      WHERE table_schema = current_schema()
+                        AND table_name = ANY(%(tablenames)s)
+                      UNION ALL
+                      SELECT 'index', tablename, indexname
+                      FROM pg_indexes
+                      WHERE schemaname = current_schema()
+                        AND tablename = ANY(%(tablenames)s);"""
+    self.connect()
+    try:
+      self.the_cursor.execute(query_string,{'tablenames':tablenames})
+    except psycopg2.Error as e:
+      print("Error in DatabaseInterface.get_catalog")
+      print("Query string: "+str(self.the_cursor.query))
+      raise e
+    catalog = dict([(tablename,None) for tablename in tablenames])
+    for kind, tablename, name in self.the_cursor.fetchall():
+      if catalog[tablename] is None:
+        catalog[tablename] = (set(),set())
+      catalog[tablename][0 if kind == 'column' else 1].add(name)
+    self.commit()
+    return catalog
+
+  """
+  SUMMARY: adds columns to an existing table in one ALTER TABLE statement
+  INPUT: tablename
+         col_dict of the form col_dict[column_name] = sql_type
+  OUTPUT: nothing
+  """
+  def add_columns(self,tablename,col_dict):
+    if not col_dict:
+      return
+    alter_string = "ALTER TABLE " + tablename + " "
+    alter_string += ", ".join(["ADD COLUMN IF NOT EXISTS "+name+" "+sql_type
+                               for (name,sql_type) in sorted(col_dict.items())])
+    alter_string += ";"
+    self.connect()
+    try:
+      self.the_cursor.execute(alter_string)
+    except psycopg2.Error as e:
+      print("ERROR in DBInterface.add_columns")
+      print("Attempted query: " + alter_string)
+      raise e
+    self.commit()
 
   """
   SUMMARY: inserts or updates a row in the given table as appropriate
@@ -137,10 +546,11 @@ class DBInterface(object):
            exists, otherwise there would be no way to know the id
   INPUT: tablename
          value_dict containing columns and values to set in database
+         conflict_column (optional), see insert_row
   OUTPUT: if this is an insert (and not an update) then return the id so the
           object can save it
   """
-  def save_to_table(self,tablename,value_dict):
+  def save_to_table(self,tablename,value_dict,conflict_column=None):
     the_id = None
     #if there is an id, then this row has already been inserted and should be updated
     if ("id" in value_dict) and value_dict["id"]:
@@ -150,35 +560,142 @@ class DBInterface(object):
       #if the id is in the value_dict, it is False, None, or 0 and we should
       #delete it so that we don't try to insert it
       if "id" in value_dict: del value_dict["id"]
-      the_id = self.insert_row(tablename,value_dict)
+      the_id = self.insert_row(tablename,value_dict,conflict_column)
     if the_id:
       return the_id
   
   """
   SUMMARY: inserts the row and returns the id
+           with a conflict_column, a row whose value in that unique column is
+           already in the table is updated instead, see upsert_clause, and
+           value_dict is updated with the values the row holds afterwards
   INPUT: tablename
          value_dict with columns and values to insert
-  OUTPUT: the id of the inserted row
+         conflict_column (optional), name of a column with a unique index
+  OUTPUT: the id of the inserted or updated row
   """
-  def insert_row(self,tablename,value_dict):
-    #build string to insert row
-    insert_string = "INSERT INTO " + tablename + " "
-    insert_string += "(" + ",".join(value_dict.keys()) + ") "
-    insert_string += "VALUES ("
-    insert_string += ", ".join(["%("+key+")s" for key in value_dict.keys()])
-    insert_string += ") RETURNING id;"
+  def insert_row(self,tablename,value_dict,conflict_column=None):
+    columns = tuple(sorted(value_dict.keys()))
+    kind = "insert"
+    if conflict_column and value_dict.get(conflict_column) is not None:
+      kind = "upsert"
+    else:
+      conflict_column = None
     #make sure connected to db
     self.connect()
     try:
-      self.the_cursor.execute(insert_string,value_dict)
+      self.execute_prepared(kind,tablename,columns,value_dict,conflict_column)
     except psycopg2.Error as e:
       print("Error inserting row in DatabaseInterface.insert_row")
-      print("Query string: "+self.the_cursor.query)
+      print("Query string: "+str(self.the_cursor.query))
       raise e
-    the_id = self.the_cursor.fetchone()[0]
-    self.the_connection.commit()
+    row = self.the_cursor.fetchone()
+    the_id = row[0]
+    if kind == "upsert":
+      value_dict.update(zip(columns,row[1:]))
+    self.commit()
     return the_id
 
+  """
+  SUMMARY: inserts many rows with multi-row INSERT statements and a single
+           commit, returning the ids in the same order as the input rows
+           COPY is not used because it cannot hand back the generated ids
+           with a conflict_column, rows whose value in that unique column is
+           already in the table are updated instead, in the same statements,
+           see upsert_clause, and those rows are updated with the values the
+           table holds afterwards; rows repeating a value share one id and the
+           last of them is the one written
+  INPUT: tablename
+         rows, a list of value_dicts which must all have the same columns
+           an 'id' column is ignored so the database can generate it
+         page_size (optional), number of rows sent per INSERT statement
+         conflict_column (optional), name of a column with a unique index
+  OUTPUT: list of ids of the inserted rows, in input order
+  """
+  def bulk_insert(self,tablename,rows,page_size=1000,conflict_column=None):
+    if not rows:
+      return []
+    columns = sorted([key for key in rows[0].keys() if key != "id"])
+    insert_string = "INSERT INTO " + tablename + " "
+    insert_string += "(" + ",".join(columns) + ") "
+    insert_string += "VALUES %s"
+    template = "(" + ", ".join(["%("+col+")s" for col in columns]) + ")"
+    #rows without a value for the unique column can never conflict
+    keyed = []
+    if conflict_column:
+      keyed = [i for (i,row) in enumerate(rows)
+               if row.get(conflict_column) is not None]
+    keyed_set = set(keyed)
+    plain = [i for i in range(len(rows)) if i not in keyed_set]
+    ids = [None] * len(rows)
+    self.connect()
+    with self.transaction():
+      try:
+        if plain:
+          returned = self.insert_pages(insert_string + " RETURNING id;",
+                                       [rows[i] for i in plain],template,
+                                       page_size)
+          for i, row in zip(plain,returned):
+            ids[i] = row[0]
+        if keyed:
+          #one statement cannot update a row twice, so each value is sent once
+          unique_rows = {}
+          for i in keyed:
+            unique_rows[rows[i][conflict_column]] = rows[i]
+          upsert_string = insert_string
+          upsert_string += self.upsert_clause(tablename,columns,conflict_column)
+          upsert_string += " RETURNING id, " + ", ".join(columns) + ";"
+          returned = self.insert_pages(upsert_string,unique_rows.values(),
+                                       template,page_size)
+          key_position = columns.index(conflict_column) + 1
+          stored = dict([(row[key_position],row) for row in returned])
+          for i in keyed:
+            row = stored[rows[i][conflict_column]]
+            ids[i] = row[0]
+            rows[i].update(zip(columns,row[1:]))
+      except psycopg2.Error as e:
+        print("Error inserting rows in DatabaseInterface.bulk_insert")
+        print("Query string: "+str(self.the_cursor.query))
+        raise e
+    return ids
+
+  """
+  SUMMARY: sends rows through a multi-row INSERT statement page_size rows at a
+           time, used by bulk_insert
+  INPUT: statement with one VALUES %s placeholder and a RETURNING clause
+         rows, list of value_dicts
+         template for one row of VALUES
+         page_size, number of rows per statement
+  OUTPUT: list of the returned rows
+  """
+  def insert_pages(self,insert_string,rows,template,page_size):
+    returned = []
+    for start in range(0,len(rows),page_size):
+      page = rows[start:start+page_size]
+      returned += execute_values(self.the_cursor,insert_string,page,
+                                 template=template,page_size=page_size,
+                                 fetch=True)
+    return returned
+
+  """
+  SUMMARY: builds the ON CONFLICT clause that turns an INSERT into an upsert
+           on a unique column
+           the other inserted columns are updated, but a NULL being inserted
+           keeps the value already in the table, so that unset columns of a
+           new model never erase data saved by something else
+  INPUT: tablename, list of the inserted columns, the unique column
+  OUTPUT: ON CONFLICT string
+  """
+  def upsert_clause(self,tablename,columns,conflict_column):
+    #DO NOTHING would not return the id of the existing row
+    update_columns = [col for col in columns if col != conflict_column]
+    if not update_columns:
+      update_columns = [conflict_column]
+    clause = " ON CONFLICT (" + conflict_column + ") DO UPDATE SET "
+    clause += ", ".join(["%s = COALESCE(EXCLUDED.%s, %s.%s)" %
+                         (col,col,tablename,col) for col in update_columns])
+    return clause
+
   """
   SUMMARY: update the row with the given id
   INPUT: tablename
@@ -191,18 +708,150 @@ class DBInterface(object):
       print("Cannot update a row without an id")
       print("Input table: " + tablename)
       print("Input values: " + str(value_dict))
-    update_string = "UPDATE " + tablename +" SET "
-    value_string_list = [key+" = %("+key+")s" for key in value_dict.keys() if key != "id"]
-    update_string += ", ".join(value_string_list)
-    update_string += " WHERE id = %(id)s;"
+    columns = tuple(sorted([key for key in value_dict.keys() if key != "id"]))
     self.connect()
     try:
-      self.the_cursor.execute(update_string,value_dict)
+      self.execute_prepared("update",tablename,columns,value_dict)
     except psycopg2.Error as e:
       print("Error updating in DatabaseInterface.update_row")
-      print("Query string: "+self.the_cursor.query)
+      print("Query string: "+str(self.the_cursor.query))
       raise e
-    self.the_connection.commit()
+    self.commit()
+
+  """
+  SUMMARY: returns the cached statement for a kind of query on a table and
+           set of columns, building and caching it on the first request
+           kind is "insert" (INSERT ... RETURNING id), "upsert" (INSERT ... 
+           ON CONFLICT ... RETURNING id and the columns) or "update" (UPDATE
+           by id)
+  INPUT: kind, tablename, columns as a tuple
+         conflict_column, the unique column of an upsert
+  OUTPUT: 3-tuple (statement name, PREPARE string, EXECUTE string)
+  """
+  def get_statement(self,kind,tablename,columns,conflict_column=None):
+    key = (kind,tablename,columns,conflict_column)
+    statement = self.statement_cache.get(key)
+    if statement:
+      self.statement_cache_hits += 1
+      return statement
+    with self.statement_lock:
+      statement = self.statement_cache.get(key)
+      if statement:
+        self.statement_cache_hits += 1
+        return statement
+      self.statement_cache_misses += 1
+      name = "%s_%s_%d" % (kind,tablename,len(self.statement_cache))
+      placeholders = ["$%d" % (i+1) for i in range(len(columns))]
+      if kind in ("insert","upsert"):
+        sql = "INSERT INTO " + tablename + " (" + ",".join(columns) + ") "
+        sql += "VALUES (" + ", ".join(placeholders) + ")"
+        if kind == "upsert":
+          sql += self.upsert_clause(tablename,columns,conflict_column)
+          #the row may hold values the model left unset, see upsert_clause
+          sql += " RETURNING id, " + ", ".join(columns)
+        else:
+          sql += " RETURNING id"
+        param_names = columns
+      else:
+        sql = "UPDATE " + tablename + " SET "
+        sql += ", ".join([col+" = "+ph for (col,ph) in zip(columns,placeholders)])
+        sql += " WHERE id = $%d" % (len(columns)+1)
+        param_names = columns + ("id",)
+      prepare_string = "PREPARE " + name + " AS " + sql + ";"
+      execute_string = "EXECUTE " + name
+      if param_names:
+        execute_string += " (" + ", ".join(["%("+col+")s" for col in param_names]) + ")"
+      execute_string += ";"
+      statement = (name,prepare_string,execute_string)
+      self.statement_cache[key] = statement
+    return statement
+
+  """
+  SUMMARY: runs a cached statement as a server-side prepared statement
+           the first use on a connection also sends the PREPARE, later uses
+           only send EXECUTE
+  INPUT: kind, tablename, columns as a tuple, value_dict with the parameters
+         conflict_column (optional), see get_statement
+  OUTPUT: nothing, results are left on the_cursor
+  """
+  def execute_prepared(self,kind,tablename,columns,value_dict,
+                       conflict_column=None):
+    name, prepare_string, execute_string = self.get_statement(kind,tablename,
+                                                              columns,
+                                                              conflict_column)
+    prepared = self.the_connection.prepared_statements
+    if name in prepared:
+      self.the_cursor.execute(execute_string,value_dict)
+      return
+    #PREPARE is sent on its own since it is not undone if the EXECUTE fails
+    #and the transaction is rolled back
+    self.the_cursor.execute(prepare_string)
+    prepared.add(name)
+    self.prepared_count += 1
+    self.the_cursor.execute(execute_string,value_dict)
+
+  """
+  SUMMARY: hit and miss counters for the statement cache
+  INPUT: None
+  OUTPUT: dict with 'hits', 'misses', 'size' and 'prepared', the number of 
+          PREPAREs sent to the server
+  """
+  def get_statement_cache_stats(self):
+    return {"hits":self.statement_cache_hits,
+            "misses":self.statement_cache_misses,
+            "size":len(self.statement_cache),
+            "prepared":self.prepared_count}
+
+  """
+  SUMMARY: updates many rows by id, sending the UPDATE statements in pages
+           instead of one round trip per row, with a single commit
+  INPUT: tablename
+         rows, a list of value_dicts which must each contain an 'id'
+         page_size (optional), number of UPDATE statements per round trip
+  OUTPUT: nothing
+  """
+  def bulk_update(self,tablename,rows,page_size=1000):
+    #rows with the same columns share one UPDATE statement
+    by_columns = {}
+    for row in rows:
+      if ("id" not in row) or (not row["id"]):
+        print("Error in DatabaseInterface.bulk_update")
+        print("Cannot update a row without an id")
+        print("Input table: " + tablename)
+        print("Input values: " + str(row))
+        continue
+      columns = tuple(sorted([key for key in row.keys() if key != "id"]))
+      by_columns.setdefault(columns,[]).append(row)
+    self.connect()
+    with self.transaction():
+      for columns, column_rows in by_columns.items():
+        update_string = "UPDATE " + tablename + " SET "
+        update_string += ", ".join([col+" = %("+col+")s" for col in columns])
+        update_string += " WHERE id = %(id)s;"
+        try:
+          execute_batch(self.the_cursor,update_string,column_rows,
+                        page_size=page_size)
+        except psycopg2.Error as e:
+          print("Error updating rows in DatabaseInterface.bulk_update")
+          print("Query string: "+str(self.the_cursor.query))
+          raise e
+
+  """
+  SUMMARY: deletes the rows with the given ids in a single statement
+  INPUT: tablename
+         list of ids
+  OUTPUT: nothing
+  """
+  def delete_rows(self,tablename,ids):
+    delete_string = "DELETE FROM " + tablename + " WHERE id = ANY(%(ids)s);"
+    self.connect()
+    try:
+      self.the_cursor.execute(delete_string,{'ids':list(ids)})
+    except psycopg2.Error as e:
+      print("Error deleting in DatabaseInterface.delete_rows")
+      print("Query string: "+str(self.the_cursor.query))
+      raise e
+    self.commit()
 
   """
   SUMMARY: retrieve the given column_dict from the given table
@@ -217,6 +866,105 @@ class DBInterface(object):
           first tuple is a list of the columns to give the ordering
   """
   def get_from_table(self, tablename, column_dict):
+    query_string, ordered_columns = self.build_select(tablename,column_dict)
+    self.connect()
+    try:
+      self.the_cursor.execute(query_string)
+    except psycopg2.Error as e:
+      print("Error in DatabaseInterface.get_from_table")
+      print("Query failed")
+      print("Attempted query: " + self.the_cursor.query)
+      raise e
+    results = [tuple(ordered_columns)]
+    results.extend(self.the_cursor.fetchall())
+    return results
+
+  """
+  SUMMARY: retrieve rows from the given table with a parameterized query,
+           used by ModelBase.Query
+  INPUT: tablename
+         columns, list of the columns to retrieve
+         where (optional), list of SQL conditions joined with AND, values
+           must be given as %(name)s placeholders
+         params (optional), dict of the values of the placeholders
+         order_by (optional), list of ORDER BY items such as "title DESC"
+         limit (optional), maximum number of rows
+  OUTPUT: list of tuples containing the columns
+          first tuple is the columns to give the ordering
+  """
+  def select_rows(self,tablename,columns,where=None,params=None,order_by=None,
+                  limit=None):
+    query_string = "SELECT " + ", ".join(columns) + " FROM " + tablename
+    if where:
+      query_string += " WHERE " + " AND ".join(where)
+    if order_by:
+      query_string += " ORDER BY " + ", ".join(order_by)
+    params = dict(params or {})
+    if limit is not None:
+      query_string += " LIMIT %(limit)s"
+      params["limit"] = int(limit)
+    query_string += ";"
+    self.connect()
+    try:
+      self.the_cursor.execute(query_string,params)
+    except psycopg2.Error as e:
+      print("Error in DatabaseInterface.select_rows")
+      print("Query failed")
+      print("Attempted query: " + query_string)
+      raise e
+    results = [tuple(columns)]
+    results.extend(self.the_cursor.fetchall())
+    return results
+
+  """
+  SUMMARY: like get_from_table, but streams the rows from a named server-side
+           cursor instead of loading them all into memory
+           rows are fetched from the server itersize at a time from a WITH
+           HOLD cursor, so no transaction is held open between them and
+           stopping the iteration early loses nothing
+  INPUT: tablename
+         column_dict, see get_from_table
+         itersize (optional), rows per round trip, defaults to
+           DB_SETTINGS["itersize"]
+  OUTPUT: generator, the first item is a tuple of the columns to give the
+          ordering, followed by one tuple per row
+  """
+  def iter_from_table(self, tablename, column_dict, itersize=None):
+    query_string, ordered_columns = self.build_select(tablename,column_dict)
+    if not itersize:
+      itersize = DB_SETTINGS.get("itersize",2000)
+    self.connect()
+    self.named_cursor_count += 1
+    #a WITH HOLD cursor outlives the transaction that opened it, so no
+    #transaction is kept open while the caller consumes the rows, and the
+    #caller can save, commit or roll back between them
+    cursor = self.the_connection.cursor("stream_%d" % self.named_cursor_count,
+                                        withhold=True)
+    cursor.itersize = itersize
+    try:
+      try:
+        cursor.execute(query_string)
+        self.commit()
+      except psycopg2.Error as e:
+        print("Error in DatabaseInterface.iter_from_table")
+        print("Query failed")
+        print("Attempted query: " + query_string)
+        raise e
+      yield tuple(ordered_columns)
+      for row in cursor:
+        yield row
+    finally:
+      if not self.the_connection.closed:
+        cursor.close()
+
+  """
+  SUMMARY: builds the SELECT statement used by get_from_table and 
+           iter_from_table
+  INPUT: tablename
+         column_dict, see get_from_table
+  OUTPUT: 2-tuple (query string, list of the selected columns in order)
+  """
+  def build_select(self, tablename, column_dict):
     #make sure column_dict is a dictionary
     if not isinstance(column_dict,dict):
       print("Error in DatabaseInterface.get_from_table")
@@ -241,20 +989,10 @@ class DBInterface(object):
       where_list.append(col)
     if has_values:
       where_string = " WHERE "
-      where_string += ", ".join([col+" "+column_dict[col] for col in where_list])
+      where_string += " AND ".join([col+" "+column_dict[col] for col in where_list])
       query_string += where_string
     query_string += ";"
-    self.connect()
-    try:
-      self.the_cursor.execute(query_string)
-    except psycopg2.Error as e:
-      print("Error in DatabaseInterface.get_from_table")
-      print("Query failed")
-      print("Attempted query: " + self.the_cursor.query)
-      raise e
-    results = self.the_cursor.fetchall()
-    results.insert(0,tuple(ordered_columns))
-    return results
+    return (query_string, ordered_columns)
   
 if __name__ == "__main__":
   DB = DBInterface()
@@ -265,6 +1003,81 @@ if __name__ == "__main__":
   print(DB.does_table_exist('test'))
   print("Does 'fake_table' exist?")
   print(DB.does_table_exist('fake_table'))
-  DB.create_table('test_table',{'id':'serial PRIMARY KEY','item1':'varchar','item2':'smallint'})
+  DB.create_table('test_table',{'id':'serial PRIMARY KEY','item1':'varchar','item2':'smallint'},
+                  [('item1',),('item1','item2')])
   assert (DB.does_table_exist('test_table'))
+  DB.the_cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'test_table';")
+  assert ('test_table_item1_item2_idx' in [row[0] for row in DB.the_cursor.fetchall()])
+  DB.add_columns('test_table',{'item3':'text'})
+  catalog = DB.get_catalog(['test_table','fake_table'])
+  assert (catalog['fake_table'] == None)
+  assert (catalog['test_table'][0] == set(['id','item1','item2','item3']))
+  assert ('test_table_item1_idx' in catalog['test_table'][1])
   DB.close_connection()
+  #pooled mode, every thread gets its own connection
+  DB_SETTINGS["pooled"] = True
+  DB_SETTINGS["max_connections"] = 2
+  pooled_db = DBInterface()
+  connections = []
+  def worker():
+    with pooled_db.thread_connection():
+      pooled_db.insert_row('test_table',{'item1':'threaded','item2':1})
+      connections.append(pooled_db.the_connection)
+  threads = [threading.Thread(target=worker) for i in range(4)]
+  for t in threads: t.start()
+  for t in threads: t.join()
+  assert (len(connections) == 4)
+  assert (pooled_db.get_statement_cache_stats()["misses"] == 1)
+  assert (pooled_db.get_statement_cache_stats()["hits"] == 3)
+  assert (pooled_db.the_connection == None)
+  #threads that exit without closing their connection give it back too, so
+  #more of them than max_connections can run one after another
+  def implicit_worker():
+    pooled_db.insert_row('test_table',{'item1':'implicit','item2':1})
+  for i in range(3):
+    t = threading.Thread(target=implicit_worker)
+    t.start()
+    t.join(10)
+    assert (not t.is_alive())
+  implicit = pooled_db.select_rows('test_table',['id'],['item1 = %(item1)s'],
+                                   {'item1':'implicit'})[1:]
+  assert (len(implicit) == 3)
+  pooled_db.delete_rows('test_table',[row[0] for row in implicit])
+  pooled_db.close_connection()
+  pooled_db.close_pool()
+  DB_SETTINGS["pooled"] = False
+  DB = DBInterface()
+  streamed = list(DB.iter_from_table('test_table',{'item1':None},itersize=2))
+  assert (streamed[0] == ('item1',))
+  assert (len(streamed) == 5)
+  assert (DB.transaction_depth == 0)
+  #stopping part way and saving must not leave a transaction open
+  for row in DB.iter_from_table('test_table',{'item1':None},itersize=2):
+    break
+  DB.insert_row('test_table',{'item1':'after break','item2':2})
+  assert (DB.transaction_depth == 0)
+  DB.the_connection.rollback()
+  assert (DB.select_rows('test_table',['id'],['item1 = %(item1)s'],
+                         {'item1':'after break'})[1:] != [])
+  #as must saving while a stream is still being read
+  stream = DB.iter_from_table('test_table',{'item1':None},itersize=1)
+  next(stream)
+  next(stream)
+  DB.insert_row('test_table',{'item1':'mid stream','item2':3})
+  DB.the_connection.rollback()
+  assert (len(list(stream)) == 4)
+  assert (DB.select_rows('test_table',['id'],['item1 = %(item1)s'],
+                         {'item1':'mid stream'})[1:] != [])
+  #and so must closing a generator that holds a transaction block
+  def saving_generator():
+    with DB.transaction():
+      DB.insert_row('test_table',{'item1':'closed early','item2':4})
+      yield
+      yield
+  generator = saving_generator()
+  next(generator)
+  generator.close()
+  assert (DB.transaction_depth == 0)
+  DB.the_connection.rollback()
+  assert (DB.select_rows('test_table',['id'],['item1 = %(item1)s'],
+                         {'item1':'closed early'})[1:] != [])
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib2
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import config
+
+#the outcome of fetching one url, status is None if the server could not be
+#reached and body is None unless the status is 200
+FetchResult = namedtuple("FetchResult",["url","status","body","from_cache"])
+
+class TokenBucket(object):
+  """
+  Thread-safe token bucket rate limiter
+
+    bucket = TokenBucket(10.0,5)
+    bucket.acquire()
+
+  Tokens are added at rate per second up to burst, acquire takes one and
+    waits until one is available, so callers run at most rate times a second
+    on average with bursts of up to burst
+  """
+  def __init__(self,rate,burst):
+    self.rate = float(rate)
+    self.burst = burst
+    self.tokens = float(burst)
+    self.last = time.time()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.time()
+        self.tokens = min(self.burst,self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+class ResponseCache(object):
+  """
+  On-disk cache of HTTP responses, one pair of files per url named after the
+    SHA-1 of the url: the body, and a JSON file with the validators (ETag and
+    Last-Modified) and the time it was fetched
+  Files are written to a temporary name and renamed, so threads and
+    interrupted runs never see half a response
+  """
+  def __init__(self,cache_dir=None):
+    if not cache_dir:
+      cache_dir = config.FETCH_CACHE_DIR
+    self.cache_dir = cache_dir
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+  def paths(self,url):
+    base = os.path.join(self.cache_dir,hashlib.sha1(url).hexdigest())
+    return (base + ".json",base + ".body")
+
+  def get(self,url):
+    """
+    returns a 2-tuple (dict of validators and fetched time, body) or None if
+      the url is not cached
+    """
+    meta_path, body_path = self.paths(url)
+    try:
+      with open(meta_path,"rb") as f:
+        meta = json.load(f)
+      with open(body_path,"rb") as f:
+        return (meta,f.read())
+    except (IOError,ValueError):
+      return None
+
+  def put(self,url,headers,body):
+    """
+    stores body with the ETag and Last-Modified of the response headers
+    """
+    meta = {"url":url,"etag":headers.get("ETag"),
+            "last_modified":headers.get("Last-Modified"),"fetched":time.time()}
+    meta_path, body_path = self.paths(url)
+    #the body goes first, the metadata file is what makes the entry visible
+    self.write(body_path,body)
+    self.write(meta_path,json.dumps(meta))
+
+  def touch(self,url,meta):
+    """
+    records that a cached response was revalidated now
+    """
+    meta = dict(meta)
+    meta["fetched"] = time.time()
+    self.write(self.paths(url)[0],json.dumps(meta))
+
+  def write(self,path,data):
+    handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+    with os.fdopen(handle,"wb") as f:
+      f.write(data)
+    os.rename(tmp_path,path)
+
+'''
+SUMMARY
+-------
+Fetch one url through the response cache
+A cached response younger than max_age is returned without a request, an
+older one is revalidated with If-None-Match/If-Modified-Since so an
+unchanged response costs a 304 and no body
+-------
+INPUT: url, ResponseCache, TokenBucket, max age in seconds, timeout in seconds
+OUTPUT: FetchResult
+'''
+def fetch_url(url,cache,bucket,max_age,timeout):
+  cached = cache.get(url)
+  request = urllib2.Request(url)
+  if cached is not None:
+    meta, body = cached
+    if time.time() - meta["fetched"] < max_age:
+      return FetchResult(url,200,body,True)
+    if meta.get("etag"):
+      request.add_header("If-None-Match",meta["etag"])
+    if meta.get("last_modified"):
+      request.add_header("If-Modified-Since",meta["last_modified"])
+  bucket.acquire()
+  try:
+    response = urllib2.urlopen(request,timeout=timeout)
+    try:
+      body = response.read()
+      cache.put(url,response.info(),body)
+    finally:
+      response.close()
+    return FetchResult(url,response.getcode(),body,False)
+  except urllib2.HTTPError as e:
+    if e.code == 304 and cached is not None:
+      cache.touch(url,cached[0])
+      return FetchResult(url,200,cached[1],True)
+    return FetchResult(url,e.code,None,False)
+  except IOError as e:
+    print("WARNING:Unable to fetch %s: %s" % (url,e))
+    return FetchResult(url,None,None,False)
+
+'''
+SUMMARY
+-------
+Fetch many urls concurrently, see fetch_url
+At most concurrency requests are in flight at once and requests are started
+at no more than rate a second, with bursts of up to burst
+-------
+INPUT: iterable of urls
+       optional concurrency, rate, burst, cache directory, max age and
+         timeout, default to the FETCH_ settings in config.py
+OUTPUT: generator of FetchResult, in the order of urls
+'''
+def fetch_urls(urls,concurrency=None,rate=None,burst=None,cache_dir=None,
+               max_age=None,timeout=None):
+  if not concurrency:
+    concurrency = config.FETCH_CONCURRENCY
+  if not rate:
+    rate = config.FETCH_RATE
+  if not burst:
+    burst = config.FETCH_BURST
+  if max_age is None:
+    max_age = config.FETCH_MAX_AGE
+  if not timeout:
+    timeout = config.FETCH_TIMEOUT
+  cache = ResponseCache(cache_dir)
+  bucket = TokenBucket(rate,burst)
+  pool = ThreadPool(concurrency)
+  try:
+    for result in pool.imap(lambda url: fetch_url(url,cache,bucket,max_age,
+                                                  timeout),urls):
+      yield result
+  finally:
+    pool.terminate()
+
+if __name__ == "__main__":
+  import shutil
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+
+  requests_seen = []
+
+  class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      requests_seen.append(self.path)
+      if self.path == "/missing":
+        self.send_response(404)
+        self.end_headers()
+        return
+      etag = '"%s"' % hashlib.sha1(self.path).hexdigest()
+      if self.headers.get("If-None-Match") == etag:
+        self.send_response(304)
+        self.end_headers()
+        return
+      body = json.dumps({"title":self.path[1:]})
+      self.send_response(200)
+      self.send_header("ETag",etag)
+      self.send_header("Content-Length",str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self,*args):
+      pass
+
+  class StubServer(ThreadingMixIn,HTTPServer):
+    daemon_threads = True
+
+  server = StubServer(("127.0.0.1",0),StubHandler)
+  threading.Thread(target=server.serve_forever).start()
+  base = "http://127.0.0.1:%d/" % server.server_port
+  cache_dir = tempfile.mkdtemp()
+  urls = [base + "title%d" % i for i in range(30)]
+  try:
+    start = time.time()
+    results = list(fetch_urls(urls,concurrency=4,rate=50,burst=5,
+                              cache_dir=cache_dir))
+    #25 requests after the burst at 50 a second
+    assert (time.time() - start >= 0.45)
+    assert ([json.loads(r.body)["title"] for r in results] ==
+            ["title%d" % i for i in range(30)])
+    assert (not any([r.from_cache for r in results]))
+    assert (len(requests_seen) == 30)
+    #fresh cache entries need no request at all
+    results = list(fetch_urls(urls,cache_dir=cache_dir))
+    assert (all([r.from_cache for r in results]) and len(requests_seen) == 30)
+    #stale ones are revalidated and the server answers 304
+    results = list(fetch_urls(urls,max_age=0,cache_dir=cache_dir))
+    assert (all([r.from_cache and r.status == 200 for r in results]))
+    assert (len(requests_seen) == 60)
+    assert (list(fetch_urls([base + "missing"],cache_dir=cache_dir)) ==
+            [FetchResult(base + "missing",404,None,False)])
+  finally:
+    server.shutdown()
+    shutil.rmtree(cache_dir)
@@ -0,0 +1,142 @@
+import hashlib
+import os
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from ModelBase import ModelBase
+from MovieModels import FileManifest, RawMediaFile
+
+#bytes read from each sampled part of a file
+SAMPLE_SIZE = 1 << 20
+
+#fingerprints already computed in this process
+#key is (inode, mtime, size) and value is the fingerprint
+FINGERPRINT_CACHE = {}
+
+#media files with the same title and year, copies maps each fingerprint to
+#the paths of the files that have it
+DuplicateGroup = namedtuple("DuplicateGroup",["title","year","copies"])
+
+'''
+SUMMARY
+-------
+Fingerprint a media file without reading all of it
+The file size and SAMPLE_SIZE bytes from the head, middle and tail of the
+file are hashed, so only a few MB are read however big the file is
+Files smaller than three samples are hashed whole
+-------
+INPUT: path to the file
+       optional size of the file in bytes, read with os.stat if not given
+OUTPUT: hex digest string
+'''
+def fingerprint_file(path,size=None):
+  if size is None:
+    size = os.stat(path).st_size
+  digest = hashlib.sha1(str(size))
+  with open(path,'rb') as f:
+    if size <= 3 * SAMPLE_SIZE:
+      digest.update(f.read())
+    else:
+      for offset in (0,(size - SAMPLE_SIZE) // 2,size - SAMPLE_SIZE):
+        f.seek(offset)
+        digest.update(f.read(SAMPLE_SIZE))
+  return digest.hexdigest()
+
+'''
+SUMMARY
+-------
+Fingerprint a file unless FINGERPRINT_CACHE already has it
+-------
+INPUT: FileManifest entry
+OUTPUT: 2-tuple (entry, hex digest string), the digest is None if the file
+        could not be read
+'''
+def fingerprint_entry(entry):
+  key = (entry.inode,entry.mtime,entry.size)
+  fingerprint = FINGERPRINT_CACHE.get(key)
+  if fingerprint:
+    return (entry,fingerprint)
+  try:
+    fingerprint = fingerprint_file(entry.path,entry.size)
+  except (IOError,OSError) as e:
+    print("WARNING:Unable to fingerprint %s: %s" % (entry.path,e))
+    return (entry,None)
+  FINGERPRINT_CACHE[key] = fingerprint
+  return (entry,fingerprint)
+
+'''
+SUMMARY
+-------
+Fingerprint every file in FileManifest that does not have a fingerprint yet
+Files are read by a pool of threads, Rescan.rescan clears the fingerprint of
+files whose inode, mtime or size changed so they are read again
+-------
+INPUT: optional path to directory, only files under it are fingerprinted
+       optional number of threads
+OUTPUT: the number of files fingerprinted
+'''
+def fingerprint_manifest(dir_path="",workers=8):
+  prefix = os.path.join(os.path.abspath(dir_path),"") if dir_path else ""
+  entries = [entry for entry in FileManifest.iterate()
+             if not entry.fingerprint and entry.path.startswith(prefix)]
+  if not entries:
+    return 0
+  pool = ThreadPool(workers)
+  count = 0
+  try:
+    with ModelBase.session():
+      for entry, fingerprint in pool.imap_unordered(fingerprint_entry,entries):
+        if fingerprint:
+          entry.fingerprint = fingerprint
+          count += 1
+  finally:
+    pool.terminate()
+  return count
+
+'''
+SUMMARY
+-------
+Find the media files that share a title and year and tell identical copies
+apart from different cuts using the fingerprints in FileManifest
+-------
+INPUT: None
+OUTPUT: list of DuplicateGroup, sorted by title and year
+'''
+def duplicate_report():
+  by_title = {}
+  for media in RawMediaFile.iterate():
+    by_title.setdefault((media.title,media.release_year),[]).append(media)
+  FileManifest.add_index("media_id")
+  #keep the manifest loaded so find_models can look entries up by media_id
+  entries = list(FileManifest.iterate())
+  groups = []
+  for (title,year), media_list in sorted(by_title.items()):
+    if len(media_list) < 2:
+      continue
+    copies = {}
+    for media in media_list:
+      for entry in FileManifest.find_models("media_id",media.id):
+        copies.setdefault(entry.fingerprint or None,[]).append(entry.path)
+    groups.append(DuplicateGroup(title,year,copies))
+  return groups
+
+if __name__ == "__main__":
+  import shutil, tempfile
+  from Rescan import rescan
+  scan_root = tempfile.mkdtemp()
+  big = os.urandom(4 * SAMPLE_SIZE)
+  for name, data in [("Heat (1995).mp4",big),("Heat (1995).avi",big),
+                     ("Heat (1995).m4v",big[:-1] + "x"),("Up (2009).mp4","up")]:
+    with open(os.path.join(scan_root,name),"wb") as f:
+      f.write(data)
+  assert (fingerprint_file(os.path.join(scan_root,"Heat (1995).mp4")) ==
+          fingerprint_file(os.path.join(scan_root,"Heat (1995).avi")))
+  rescan(scan_root)
+  assert (fingerprint_manifest(scan_root,workers=2) == 4)
+  assert (fingerprint_manifest(scan_root,workers=2) == 0)
+  heat = [group for group in duplicate_report() if group.title == "Heat"][0]
+  #the data is random, so only this run's files can have these fingerprints
+  ours = set([fingerprint_file(os.path.join(scan_root,name)) for name in
+              ["Heat (1995).mp4","Heat (1995).m4v"]])
+  assert (sorted([len(heat.copies[fingerprint]) for fingerprint in ours]) == [1,2])
+  shutil.rmtree(scan_root)
@@ -0,0 +1,253 @@
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+try:
+  import numpy
+except ImportError:
+  #without NumPy candidates are found from the rarest posting lists instead
+  numpy = None
+
+import config
+from ImdbIndex import normalize_title
+from ModelBase import ModelBase
+from MovieModels import RawMediaFile
+
+#a candidate title found by TrigramIndex.match, score is between 0 and 1
+Match = namedtuple("Match",["tconst","title","year","score"])
+
+'''
+SUMMARY
+-------
+Split a normalized title into its trigrams, the title is padded with a space
+at each end so short titles and word boundaries still give trigrams
+-------
+INPUT: normalized title string
+OUTPUT: set of 3 character strings
+'''
+def trigrams(title):
+  padded = " %s " % title
+  return set([padded[i:i + 3] for i in range(len(padded) - 2)])
+
+class TrigramIndex(object):
+  """
+  Fuzzy title matcher over an inverted index from trigrams to candidate titles
+
+    index = TrigramIndex.from_index_file()
+    index.match("Apocalypse Now Redux",1979)
+
+  Candidates are numbered in order of year, so every posting list is sorted by
+    year as well and a year window is a range of candidate numbers found by
+    binary search; only the part of each posting list inside the window is read
+  Candidates are scored by the Dice coefficient of their trigram sets,
+    2 * shared / (query trigrams + candidate trigrams)
+  The posting lists are NumPy arrays when NumPy is installed, see
+    score_candidates
+  """
+  def __init__(self,records):
+    """
+    records is an iterable of 3-tuples (normalized title, year, tconst), year
+      is 0 if it is not known
+    """
+    records = sorted(records,key=lambda record: record[1])
+    self.titles = [record[0] for record in records]
+    self.tconsts = [record[2] for record in records]
+    years = array('i',[record[1] for record in records])
+    sizes = array('i')
+    postings = {}
+    for number, title in enumerate(self.titles):
+      grams = trigrams(title)
+      sizes.append(len(grams))
+      for gram in grams:
+        postings.setdefault(gram,array('i')).append(number)
+    if numpy is not None:
+      years = numpy.array(years,dtype=numpy.int32)
+      sizes = numpy.array(sizes,dtype=numpy.int32)
+      for gram in postings:
+        postings[gram] = numpy.array(postings[gram],dtype=numpy.int32)
+    self.years = years
+    self.sizes = sizes
+    self.postings = postings
+
+  @classmethod
+  def from_index_file(cls,index_file=None):
+    """
+    returns a TrigramIndex of every record of an index written by
+      ImdbIndex.build_index
+    """
+    if not index_file:
+      index_file = config.IMDB_INDEX_FILE
+    records = []
+    with open(index_file,"rb") as f:
+      for line in f:
+        title, year, tconst = line.rstrip("\n").split("\t")
+        records.append((title,int(year or 0),tconst))
+    return cls(records)
+
+  def __len__(self):
+    return len(self.titles)
+
+  def candidate_range(self,year,year_window):
+    """
+    returns the 2-tuple (first, last + 1) of the candidate numbers from within
+      year_window years of year, or of every candidate if year is None
+    """
+    if not year:
+      return (0,len(self.titles))
+    if numpy is not None:
+      return (int(numpy.searchsorted(self.years,year - year_window,"left")),
+              int(numpy.searchsorted(self.years,year + year_window,"right")))
+    return (bisect_left(self.years,year - year_window),
+            bisect_right(self.years,year + year_window))
+
+  def score_candidates(self,grams,first,last,min_score):
+    """
+    returns a list of 2-tuples (score, candidate number) of the candidates
+      numbered first to last - 1 that score at least min_score against grams
+    with NumPy every posting list is counted with numpy.unique, without it
+      only the rarest posting lists are read, since a candidate that scores
+      min_score must share at least min_score * len(grams) / (2 - min_score)
+      trigrams and so must be in one of the len(grams) - that + 1 rarest
+      ones, and each of those candidates is then scored on its own trigrams
+    """
+    ranges = []
+    for gram in grams:
+      posting = self.postings.get(gram)
+      if posting is None:
+        continue
+      if numpy is not None:
+        ranges.append(posting[numpy.searchsorted(posting,first):
+                              numpy.searchsorted(posting,last)])
+      else:
+        ranges.append((posting,bisect_left(posting,first),
+                       bisect_left(posting,last)))
+    if not ranges:
+      return []
+    if numpy is not None:
+      numbers, shared = numpy.unique(numpy.concatenate(ranges),
+                                     return_counts=True)
+      scores = 2.0 * shared / (len(grams) + self.sizes[numbers])
+      keep = scores >= min_score
+      return zip(scores[keep].tolist(),numbers[keep].tolist())
+    needed = max(1,int(math.ceil(min_score * len(grams) / (2 - min_score))))
+    #grams without a posting list are the rarest of all
+    prefix = len(grams) - needed + 1 - (len(grams) - len(ranges))
+    ranges.sort(key=lambda posting_range: posting_range[2] - posting_range[1])
+    candidates = set()
+    for posting, i, j in ranges[:max(0,prefix)]:
+      candidates.update(posting[i:j])
+    smallest = min_score * len(grams) / (2 - min_score)
+    largest = (2 - min_score) * len(grams) / min_score
+    scored = []
+    for number in candidates:
+      size = self.sizes[number]
+      if size < smallest or size > largest:
+        continue
+      score = 2.0 * len(grams & trigrams(self.titles[number])) / \
+              (len(grams) + size)
+      if score >= min_score:
+        scored.append((score,number))
+    return scored
+
+  def match(self,title,year=None,year_window=1,limit=5,min_score=0.5):
+    """
+    returns a list of at most limit Match, best first, for the candidates
+      within year_window years of year that score at least min_score
+    """
+    query = normalize_title(title)
+    if not query:
+      return []
+    grams = trigrams(query)
+    first, last = self.candidate_range(year,year_window)
+    best = self.score_candidates(grams,first,last,min_score)
+    best.sort(key=lambda pair: (-pair[0],pair[1]))
+    return [Match(self.tconsts[number],self.titles[number],
+                  int(self.years[number]) or None,score)
+            for score, number in best[:limit]]
+
+  def match_many(self,queries,year_window=1,limit=5,min_score=0.5):
+    """
+    batch version of match for a whole library
+    queries is an iterable of 2-tuples (title, year or None), returns a list
+      with the list of Match for each query, in order
+    titles that normalize the same with the same year are only matched once
+    """
+    results = []
+    seen = {}
+    for title, year in queries:
+      key = (normalize_title(title),year)
+      if key not in seen:
+        seen[key] = self.match(title,year,year_window,limit,min_score)
+      results.append(seen[key])
+    return results
+
+'''
+SUMMARY
+-------
+Resolve the RawMediaFile rows that still have no imdb_id, after
+ImdbIndex.link_media, to the best fuzzy match in the local index
+-------
+INPUT: optional path to the index, defaults to config.IMDB_INDEX_FILE
+       optional lowest score accepted
+       optional TrigramIndex, built from the index file if not given
+OUTPUT: 2-tuple (number of rows linked, number of rows not matched)
+'''
+def fuzzy_link_media(index_file=None,min_score=0.6,index=None):
+  if index is None:
+    index = TrigramIndex.from_index_file(index_file)
+  unlinked = [media for media in RawMediaFile.iterate()
+              if not media.imdb_id and media.title]
+  matches = index.match_many([(media.title,media.release_year)
+                              for media in unlinked],
+                             limit=1,min_score=min_score)
+  linked = 0
+  with ModelBase.session():
+    for media, found in zip(unlinked,matches):
+      if found:
+        media.imdb_id = found[0].tconst
+        linked += 1
+  return (linked,len(unlinked) - linked)
+
+if __name__ == "__main__":
+  import random, string, time
+  records = [("apocalypse now",1979,"tt0078788"),("heat",1995,"tt0113277"),
+             ("heat",1963,"tt0061779"),("war inc",2008,"tt0884224"),
+             ("lord of rings fellowship of ring",2001,"tt0120737"),
+             ("up",2009,"tt1049413")]
+  #a library of random titles, then the same titles with a letter dropped
+  random.seed(7)
+  words = ["".join(random.choice(string.ascii_lowercase)
+                   for _ in range(random.randint(2,9))) for _ in range(3000)]
+  library = [(" ".join(random.sample(words,random.randint(1,5))),
+              random.randint(1920,2019),"tt9%06d" % i) for i in range(50000)]
+  index = TrigramIndex(records + library)
+  assert (len(index) == 50006)
+  assert (index.match("Apocalypse Now Redux",1979)[0].tconst == "tt0078788")
+  assert (index.match("Apocalypse Now Redux",2001) == [])
+  assert (index.match("Heat",1995)[0] == Match("tt0113277","heat",1995,1.0))
+  assert ([m.tconst for m in index.match("Heat",None)] ==
+          ["tt0061779","tt0113277"])
+  assert (index.match("War, Inc.",2008)[0].tconst == "tt0884224")
+  assert (index.match("The Lord of the Rings - Fellowship of the Ring",2001)
+          [0].tconst == "tt0120737")
+  assert (index.match("Up",2009)[0].tconst == "tt1049413")
+  queries = []
+  for title, year, tconst in library[:2000]:
+    if len(title) > 8:
+      cut = random.randint(0,len(title) - 1)
+      title = title[:cut] + title[cut + 1:]
+    queries.append((title,year))
+  start = time.time()
+  results = index.match_many(queries,limit=1)
+  elapsed = time.time() - start
+  found = sum([1 for (title, year, tconst), result in zip(library,results)
+               if result and result[0].tconst == tconst])
+  assert (found > 0.95 * len(queries))
+  #200k titles in minutes
+  assert (elapsed / len(queries) * 200000 < 600)
+  media = RawMediaFile.create()
+  media.title = "Apocalypse Now Redux"
+  media.release_year = 1979
+  media.save()
+  fuzzy_link_media(index=index)
+  assert (RawMediaFile.get(media.id).imdb_id == "tt0078788")
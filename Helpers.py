@@ -1,3 +1,6 @@
+import weakref
+from bisect import bisect_left, insort
+
 def bisect_by_attr(a_list,attr,value):
   """
   assumes a_list is sorted by attr
@@ -20,7 +23,7 @@ def bisect_by_attr(a_list,attr,value):
     if diff <= 1:
       if value <= lower_val: return lower_ind
       return upper_ind
-    middle_ind = lower_ind + diff/2
+    middle_ind = lower_ind + diff//2
     middle_val = getattr(a_list[middle_ind],attr)
     #print "lower: %d middle: %d upper: %d" % (lower_ind,middle_ind,upper_ind)
     if value <= middle_val:
@@ -28,6 +31,194 @@ def bisect_by_attr(a_list,attr,value):
     else:
       lower_ind = middle_ind
 
+
+
+class SortedKeyList(object):
+  """
+  Sorted list of comparable entries kept in buckets of at most 2 * LOAD
+    entries, with the last entry of each bucket in maxes
+
+  add and remove binary search maxes for the bucket and then the bucket, so
+    they cost O(log n) comparisons and only move the entries of one bucket
+    instead of the whole list as list.insert does
+  """
+  LOAD = 500
+
+  def __init__(self):
+    self.buckets = []
+    self.maxes = []
+    self.size = 0
+
+  def __len__(self):
+    return self.size
+
+  def __iter__(self):
+    for bucket in self.buckets:
+      for entry in bucket:
+        yield entry
+
+  def add(self,entry):
+    if not self.buckets:
+      self.buckets.append([entry])
+      self.maxes.append(entry)
+      self.size += 1
+      return
+    pos = bisect_left(self.maxes,entry)
+    if pos == len(self.maxes):
+      pos -= 1
+      self.buckets[pos].append(entry)
+      self.maxes[pos] = entry
+    else:
+      insort(self.buckets[pos],entry)
+    self.size += 1
+    bucket = self.buckets[pos]
+    if len(bucket) > 2 * self.LOAD:
+      self.buckets.insert(pos + 1,bucket[self.LOAD:])
+      del bucket[self.LOAD:]
+      self.maxes.insert(pos,bucket[-1])
+
+  def remove(self,entry):
+    """
+    removes entry, raises ValueError if it is not in the list
+    """
+    pos = bisect_left(self.maxes,entry)
+    if pos == len(self.maxes):
+      raise ValueError("%r is not in the list" % (entry,))
+    bucket = self.buckets[pos]
+    i = bisect_left(bucket,entry)
+    if i == len(bucket) or bucket[i] != entry:
+      raise ValueError("%r is not in the list" % (entry,))
+    del bucket[i]
+    self.size -= 1
+    if not bucket:
+      del self.buckets[pos]
+      del self.maxes[pos]
+    elif i == len(bucket):
+      self.maxes[pos] = bucket[-1]
+
+  def irange(self,low=None,high=None):
+    """
+    generator over the entries, which must be tuples, whose first item is
+      between low and high inclusive, in order
+    low or high of None leaves that end of the range open
+    """
+    pos = i = 0
+    if low is not None:
+      pos = bisect_left(self.maxes,(low,))
+      if pos == len(self.maxes):
+        return
+      i = bisect_left(self.buckets[pos],(low,))
+    for bucket in self.buckets[pos:]:
+      for entry in bucket[i:]:
+        if high is not None and entry[0] > high:
+          return
+        yield entry
+      i = 0
+
+
+class SortedIndex(object):
+  """
+  In-memory index of objects sorted by several attributes at once
+
+    index = SortedIndex(["release_year","title"])
+    index.add(movie)
+    index.irange("release_year",1990,1999)
+
+  Each attribute has its own SortedKeyList of (value, id(item)) entries, so
+    adding or removing an item costs O(log n) per attribute and range
+    queries never need the objects to be re-sorted
+  The values of an item are read once when it is added and kept in keys, so
+    an item is always found and removed under the values it was indexed with;
+    call update after changing an indexed attribute to re-index it
+  With weak set, items are held through weak references and released items
+    are dropped from the index the next time it is used
+  """
+  def __init__(self,attrs,weak=False):
+    self.attrs = tuple(attrs)
+    self.lists = dict([(attr,SortedKeyList()) for attr in self.attrs])
+    self.keys = {}
+    self.items = {}
+    self.weak = weak
+    self.released = []
+
+  def __len__(self):
+    self.purge()
+    return len(self.keys)
+
+  def __contains__(self,item):
+    return self.get_item(id(item)) is item
+
+  def add(self,item):
+    """
+    adds item, or re-indexes it if it is already in the index
+    """
+    self.purge()
+    item_id = id(item)
+    if item_id in self.keys:
+      self.discard_id(item_id)
+    keys = tuple([getattr(item,attr) for attr in self.attrs])
+    self.keys[item_id] = keys
+    if self.weak:
+      released = self.released
+      self.items[item_id] = weakref.ref(item,
+                                        lambda ref: released.append(item_id))
+    else:
+      self.items[item_id] = item
+    for attr, key in zip(self.attrs,keys):
+      self.lists[attr].add((key,item_id))
+
+  def remove(self,item):
+    """
+    removes item if it is in the index
+    """
+    self.purge()
+    if item in self:
+      self.discard_id(id(item))
+
+  def update(self,item):
+    """
+    re-indexes item under the current values of its attributes
+    """
+    self.add(item)
+
+  def discard_id(self,item_id):
+    keys = self.keys.pop(item_id,None)
+    if keys is None:
+      return
+    del self.items[item_id]
+    for attr, key in zip(self.attrs,keys):
+      self.lists[attr].remove((key,item_id))
+
+  def purge(self):
+    """
+    drops the items released since the index was last used
+    """
+    while self.released:
+      self.discard_id(self.released.pop())
+
+  def get_item(self,item_id):
+    item = self.items.get(item_id)
+    if self.weak and item is not None:
+      return item()
+    return item
+
+  def irange(self,attr,low=None,high=None):
+    """
+    generator over the items whose attr is between low and high inclusive,
+      sorted by attr, see SortedKeyList.irange
+    """
+    self.purge()
+    for key, item_id in self.lists[attr].irange(low,high):
+      item = self.get_item(item_id)
+      if item is not None:
+        yield item
+
+  def find(self,attr,value):
+    """
+    returns a list of the items whose attr equals value
+    """
+    return list(self.irange(attr,value,value))
+
 if __name__ == "__main__":
   import random
   nums = []
@@ -56,5 +247,41 @@ if __name__ == "__main__":
   for i in range(100):
     item = TestClass(i,random.randint(0,5))
     this_list.insert(bisect_by_attr(this_list,'value',item.value),item)
-  print ["%d %d" % (x.id,x.value) for x in this_list]
-  assert verify(this_list)
\ No newline at end of file
+  print(["%d %d" % (x.id,x.value) for x in this_list])
+  assert verify(this_list)
+
+  index = SortedIndex(["value","id"])
+  for item in this_list:
+    index.add(item)
+  assert ([x.value for x in index.irange("value")] ==
+          sorted([x.value for x in this_list]))
+  assert ([x.id for x in index.irange("id",10,19)] == range(10,20))
+  in_range = index.irange("value",2,3)
+  assert (sorted([x.id for x in in_range]) ==
+          sorted([x.id for x in this_list if 2 <= x.value <= 3]))
+  item = this_list[0]
+  item.value = 42
+  index.update(item)
+  assert (index.find("value",42) == [item])
+  index.remove(item)
+  assert (item not in index and len(index) == 99)
+  assert (index.find("value",42) == [])
+
+  keys = SortedKeyList()
+  keys.LOAD = 4
+  values = [(random.randint(0,50),i) for i in range(200)]
+  for value in values:
+    keys.add(value)
+  assert (list(keys) == sorted(values))
+  for value in values[::2]:
+    keys.remove(value)
+  assert (list(keys) == sorted(values[1::2]) and len(keys) == 100)
+  assert (list(keys.irange(10,20)) ==
+          [v for v in sorted(values[1::2]) if 10 <= v[0] <= 20])
+
+  weak_index = SortedIndex(["value"],weak=True)
+  temp = TestClass(1000,7)
+  weak_index.add(temp)
+  assert (weak_index.find("value",7) == [temp])
+  del temp
+  assert (len(weak_index) == 0)
@@ -0,0 +1,315 @@
+import gzip
+import heapq
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import unicodedata
+
+import config
+from ModelBase import ModelBase
+from MovieModels import RawMediaFile
+
+#articles dropped from the start, or the ", The" style end, of titles
+ARTICLES = frozenset(["the","a","an"])
+NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+'''
+SUMMARY
+-------
+Normalize a title so that file names and IMDb titles compare equal
+Accents are folded to ASCII, case and punctuation are dropped, "&" becomes
+"and" and a leading or trailing article is removed
+-------
+INPUT: title string, UTF-8 encoded or unicode
+OUTPUT: normalized title string, words separated by single spaces
+'''
+def normalize_title(title):
+  if isinstance(title,str):
+    title = title.decode("utf-8","replace")
+  title = unicodedata.normalize("NFKD",title).encode("ascii","ignore")
+  words = NON_ALNUM.sub(" ",title.lower().replace("&"," and ")).split()
+  if len(words) > 1 and words[0] in ARTICLES:
+    words = words[1:]
+  elif len(words) > 1 and words[-1] in ARTICLES:
+    words = words[:-1]
+  return " ".join(words)
+
+'''
+SUMMARY
+-------
+Open an IMDb dump, gzipped or not
+-------
+INPUT: path to the .tsv or .tsv.gz file
+OUTPUT: open file
+'''
+def open_dump(path):
+  if path.endswith(".gz"):
+    return gzip.open(path,"rb")
+  return open(path,"rb")
+
+'''
+SUMMARY
+-------
+Stream the index records out of an IMDb title.basics dump
+Each record is the line "normalized title<TAB>year<TAB>tconst", the year is
+empty if IMDb has none; a title whose original title normalizes differently
+gets a record for each
+-------
+INPUT: path to the dump
+       optional collection of title types, defaults to config.IMDB_TITLE_TYPES
+OUTPUT: generator of record strings, without the newline
+'''
+def iter_basics_records(basics_file,title_types=None):
+  if title_types is None:
+    title_types = config.IMDB_TITLE_TYPES
+  title_types = frozenset(title_types)
+  with open_dump(basics_file) as f:
+    header = f.readline().rstrip("\n").split("\t")
+    tconst_col = header.index("tconst")
+    type_col = header.index("titleType")
+    primary_col = header.index("primaryTitle")
+    original_col = header.index("originalTitle")
+    year_col = header.index("startYear")
+    for line in f:
+      fields = line.rstrip("\n").split("\t")
+      if len(fields) < len(header) or fields[type_col] not in title_types:
+        continue
+      year = fields[year_col]
+      if year == "\\N":
+        year = ""
+      primary = normalize_title(fields[primary_col])
+      if primary:
+        yield "%s\t%s\t%s" % (primary,year,fields[tconst_col])
+      original = normalize_title(fields[original_col])
+      if original and original != primary:
+        yield "%s\t%s\t%s" % (original,year,fields[tconst_col])
+
+'''
+SUMMARY
+-------
+Build the lookup index from an IMDb title.basics dump
+The dump is streamed and sorted externally: runs of run_size records are
+sorted in memory and written to temporary files, which are then merged into
+the index, so memory stays bounded however big the dump is
+The index is a sorted text file of records, see iter_basics_records, that
+ImdbIndex memory-maps and binary searches
+-------
+INPUT: optional path to the dump, defaults to config.IMDB_BASICS_FILE
+       optional path to the index, defaults to config.IMDB_INDEX_FILE
+       optional records per sorted run, defaults to config.IMDB_SORT_RUN_SIZE
+OUTPUT: the number of records in the index
+'''
+def build_index(basics_file=None,index_file=None,run_size=None):
+  if not basics_file:
+    basics_file = config.IMDB_BASICS_FILE
+  if not index_file:
+    index_file = config.IMDB_INDEX_FILE
+  if not run_size:
+    run_size = config.IMDB_SORT_RUN_SIZE
+  run_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(index_file)))
+  try:
+    run_files = []
+    records = []
+    for record in iter_basics_records(basics_file):
+      records.append(record + "\n")
+      if len(records) >= run_size:
+        run_files.append(write_run(run_dir,len(run_files),records))
+        records = []
+    if records:
+      run_files.append(write_run(run_dir,len(run_files),records))
+      records = []
+    runs = [open(run_file,"rb") for run_file in run_files]
+    count = 0
+    tmp_file = index_file + ".tmp"
+    try:
+      with open(tmp_file,"wb") as out:
+        last = None
+        for record in heapq.merge(*runs):
+          if record != last:
+            out.write(record)
+            count += 1
+            last = record
+    finally:
+      for run in runs:
+        run.close()
+    os.rename(tmp_file,index_file)
+  finally:
+    shutil.rmtree(run_dir)
+  return count
+
+'''
+SUMMARY
+-------
+Sort one run of records and write it to a temporary file for build_index
+-------
+INPUT: directory for the run, run number, list of records
+OUTPUT: path to the run file
+'''
+def write_run(run_dir,number,records):
+  records.sort()
+  run_file = os.path.join(run_dir,"run%d" % number)
+  with open(run_file,"wb") as f:
+    f.writelines(records)
+  return run_file
+
+class ImdbIndex(object):
+  """
+  Read-only lookup of IMDb tconst ids by normalized title and year over an
+    index file written by build_index
+
+    index = ImdbIndex()
+    index.lookup("The Matrix",1999) -> ["tt0133093"]
+
+  The file is memory-mapped and binary searched, so a lookup touches a few
+    pages and opening the index costs nothing however big it is
+  """
+  def __init__(self,index_file=None):
+    if not index_file:
+      index_file = config.IMDB_INDEX_FILE
+    self.index_file = index_file
+    self.the_file = open(index_file,"rb")
+    self.size = os.fstat(self.the_file.fileno()).st_size
+    self.the_map = None
+    if self.size:
+      self.the_map = mmap.mmap(self.the_file.fileno(),0,access=mmap.ACCESS_READ)
+
+  def close(self):
+    if self.the_map is not None:
+      self.the_map.close()
+      self.the_map = None
+    self.the_file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exc_type,exc_value,traceback):
+    self.close()
+
+  def find_first(self,key):
+    """
+    returns the offset of the first record that is not less than key
+    """
+    the_map = self.the_map
+    lo, hi = 0, self.size
+    while lo < hi:
+      mid = (lo + hi) // 2
+      start = the_map.rfind("\n",0,mid) + 1
+      end = the_map.find("\n",start)
+      if the_map[start:end] < key:
+        lo = end + 1
+      else:
+        hi = start
+    return lo
+
+  def iter_prefix(self,prefix):
+    """
+    generator over the records that start with prefix, as lists of fields
+    """
+    if self.the_map is None:
+      return
+    offset = self.find_first(prefix)
+    while offset < self.size:
+      end = self.the_map.find("\n",offset)
+      record = self.the_map[offset:end]
+      if not record.startswith(prefix):
+        return
+      yield record.split("\t")
+      offset = end + 1
+
+  def lookup(self,title,year=None,year_window=0):
+    """
+    returns a list of the tconst ids of the titles that normalize to the same
+      title, empty if there are none
+    with a year, only titles from year, or within year_window years of it, are
+      returned, nearest year first
+    """
+    key = normalize_title(title)
+    if not key:
+      return []
+    if not year:
+      return [fields[2] for fields in self.iter_prefix(key + "\t")]
+    year = int(year)
+    for delta in sorted(range(-year_window,year_window + 1),key=abs):
+      found = [fields[2] for fields in
+               self.iter_prefix("%s\t%d\t" % (key,year + delta))]
+      if found:
+        return found
+    return []
+
+'''
+SUMMARY
+-------
+Resolve RawMediaFile rows without an imdb_id to IMDb tconst ids using the
+local index, no network access is needed
+A title found for its year, or a year either side of it since release dates
+differ between countries, gets the first matching tconst
+-------
+INPUT: optional path to the index, defaults to config.IMDB_INDEX_FILE
+OUTPUT: 2-tuple (number of rows linked, number of rows not found)
+'''
+def link_media(index_file=None):
+  linked = 0
+  missing = 0
+  with ImdbIndex(index_file) as index:
+    with ModelBase.session():
+      for media in RawMediaFile.iterate():
+        if media.imdb_id or not media.title:
+          continue
+        found = index.lookup(media.title,media.release_year,year_window=1)
+        if found:
+          media.imdb_id = found[0]
+          linked += 1
+        else:
+          missing += 1
+  return (linked,missing)
+
+if __name__ == "__main__":
+  import time
+  assert (normalize_title("The Matrix") == "matrix")
+  assert (normalize_title("Matrix, The") == "matrix")
+  assert (normalize_title("Am\xc3\xa9lie") == "amelie")
+  assert (normalize_title("Fast & Furious") == "fast and furious")
+  work_dir = tempfile.mkdtemp()
+  basics_file = os.path.join(work_dir,"title.basics.tsv.gz")
+  index_file = os.path.join(work_dir,"titles.idx")
+  rows = [("tt0133093","movie","The Matrix","The Matrix","1999"),
+          ("tt0113277","movie","Heat","Heat","1995"),
+          ("tt0061779","movie","Heat","Heat","1963"),
+          ("tt0211915","movie","Amelie","Le fabuleux destin d'Am\xc3\xa9lie Poulain",
+           "2001"),
+          ("tt0000001","short","Unknown Year","Unknown Year","\\N"),
+          ("tt0583459","tvEpisode","Heat","Heat","1995")]
+  rows += [("tt9%06d" % i,"movie","Filler %d" % i,"Filler %d" % i,"2000")
+           for i in range(5000)]
+  with gzip.open(basics_file,"wb") as f:
+    f.write("tconst\ttitleType\tprimaryTitle\toriginalTitle\tisAdult\t"
+            "startYear\tendYear\truntimeMinutes\tgenres\n")
+    for tconst, title_type, primary, original, year in rows:
+      f.write("\t".join([tconst,title_type,primary,original,"0",year,"\\N",
+                         "120","Drama"]) + "\n")
+  assert (build_index(basics_file,index_file,run_size=1000) == 5006)
+  with ImdbIndex(index_file) as index:
+    assert (index.lookup("The Matrix",1999) == ["tt0133093"])
+    assert (index.lookup("Heat",1995) == ["tt0113277"])
+    assert (sorted(index.lookup("Heat")) == ["tt0061779","tt0113277"])
+    assert (index.lookup("Heat",1996) == [])
+    assert (index.lookup("Heat",1996,year_window=1) == ["tt0113277"])
+    assert (index.lookup("Le Fabuleux Destin d'Amelie Poulain",2001) ==
+            ["tt0211915"])
+    assert (index.lookup("Unknown Year") == ["tt0000001"])
+    assert (index.lookup("Filler 4999",2000) == ["tt9004999"])
+    assert (index.lookup("Nowhere",2000) == [])
+    start = time.time()
+    for i in range(1000):
+      index.lookup("Filler %d" % i,2000)
+    assert ((time.time() - start) / 1000 < 0.001)
+  media = RawMediaFile.create()
+  media.title = "Matrix, The"
+  media.release_year = 1999
+  media.save()
+  linked, missing = link_media(index_file)
+  assert (linked >= 1)
+  assert (RawMediaFile.get(media.id).imdb_id == "tt0133093")
+  shutil.rmtree(work_dir)
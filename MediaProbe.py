@@ -0,0 +1,435 @@
+import os
+import re
+import struct
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from ModelBase import ModelBase
+from MovieModels import FileManifest, MediaInfo
+
+#metadata read from a container, fields that could not be read are None
+ProbeResult = namedtuple("ProbeResult",["container","duration","width",
+                                        "height","video_codec","audio_codec"])
+
+#bytes read from the head and tail of MPEG files
+MPEG_PROBE_BYTES = 64 * 1024
+
+#short codec names for the fourccs and format tags found in containers
+CODEC_NAMES = {"avc1":"h264","avc3":"h264","h264":"h264","x264":"h264",
+               "hvc1":"hevc","hev1":"hevc","mp4v":"mpeg4","xvid":"mpeg4",
+               "divx":"mpeg4","dx50":"mpeg4","fmp4":"mpeg4","mp4a":"aac",
+               "ac-3":"ac3","ec-3":"eac3","jpeg":"mjpeg","mjpg":"mjpeg",
+               0x0001:"pcm",0x0050:"mp2",0x0055:"mp3",0x00ff:"aac",
+               0x2000:"ac3",0x2001:"dts"}
+
+PACK_START = "\x00\x00\x01\xba"
+SEQUENCE_START = "\x00\x00\x01\xb3"
+SEQUENCE_EXTENSION = "\x00\x00\x01\xb5"
+MPEG_AUDIO_START = re.compile("\x00\x00\x01[\xc0-\xdf]")
+PRIVATE_STREAM_START = "\x00\x00\x01\xbd"
+
+'''
+SUMMARY
+-------
+Look up the short name of a codec
+-------
+INPUT: fourcc string or numeric format tag
+OUTPUT: short name, or the fourcc/tag itself if it is not in CODEC_NAMES
+'''
+def codec_name(code):
+  if isinstance(code,str):
+    code = code.strip("\x00 ").lower()
+    if not code:
+      return None
+  return CODEC_NAMES.get(code,str(code))
+
+'''
+SUMMARY
+-------
+Walk the boxes of an MP4/QuickTime file between two offsets
+Only the box headers are read, the caller seeks to and reads the payloads it
+needs, so large boxes such as mdat are skipped over
+-------
+INPUT: open file, start offset, end offset
+OUTPUT: generator of 3-tuples (box type, payload start, payload end)
+'''
+def iter_boxes(f,start,end):
+  offset = start
+  while offset + 8 <= end:
+    f.seek(offset)
+    header = f.read(8)
+    if len(header) < 8:
+      return
+    size, kind = struct.unpack(">I4s",header)
+    header_size = 8
+    if size == 1:
+      size = struct.unpack(">Q",f.read(8))[0]
+      header_size = 16
+    elif size == 0:
+      size = end - offset
+    if size < header_size:
+      return
+    yield (kind,offset + header_size,min(offset + size,end))
+    offset += size
+
+'''
+SUMMARY
+-------
+Find a box by its path of box types, such as ["mdia","minf","stbl","stsd"]
+-------
+INPUT: open file, start offset, end offset, list of box types
+OUTPUT: 2-tuple (payload start, payload end), or None if there is no such box
+'''
+def find_box(f,start,end,path):
+  for kind, box_start, box_end in iter_boxes(f,start,end):
+    if kind == path[0]:
+      if len(path) == 1:
+        return (box_start,box_end)
+      return find_box(f,box_start,box_end,path[1:])
+  return None
+
+'''
+SUMMARY
+-------
+Read the start of a box's payload
+-------
+INPUT: open file, 2-tuple (payload start, payload end), number of bytes
+OUTPUT: string of at most length bytes
+'''
+def read_box(f,box,length):
+  f.seek(box[0])
+  return f.read(min(length,box[1] - box[0]))
+
+'''
+SUMMARY
+-------
+Probe an MP4, M4V or QuickTime file
+The top level boxes are walked to the moov box and only the mvhd, tkhd, hdlr
+and stsd boxes inside it are read, a few hundred bytes whatever the size of
+the file
+-------
+INPUT: open file, size of the file in bytes
+OUTPUT: ProbeResult, or None if the file has no moov box
+'''
+def probe_mp4(f,size):
+  moov = find_box(f,0,size,["moov"])
+  if moov is None:
+    return None
+  info = dict.fromkeys(ProbeResult._fields)
+  info["container"] = "mp4"
+  mvhd = find_box(f,moov[0],moov[1],["mvhd"])
+  if mvhd is not None:
+    data = read_box(f,mvhd,32)
+    if ord(data[0]) == 1:
+      timescale, duration = struct.unpack(">IQ",data[20:32])
+    else:
+      timescale, duration = struct.unpack(">II",data[12:20])
+    if timescale:
+      info["duration"] = float(duration) / timescale
+  for kind, start, end in iter_boxes(f,moov[0],moov[1]):
+    if kind != "trak":
+      continue
+    hdlr = find_box(f,start,end,["mdia","hdlr"])
+    stsd = find_box(f,start,end,["mdia","minf","stbl","stsd"])
+    if hdlr is None or stsd is None:
+      continue
+    handler = read_box(f,hdlr,12)[8:12]
+    codec = codec_name(read_box(f,stsd,16)[12:16])
+    if handler == "vide" and info["video_codec"] is None:
+      info["video_codec"] = codec
+      tkhd = find_box(f,start,end,["tkhd"])
+      if tkhd is not None:
+        data = read_box(f,tkhd,96)
+        #16.16 fixed point width and height end the box
+        width, height = struct.unpack(">II",data[-8:])
+        info["width"] = width >> 16
+        info["height"] = height >> 16
+    elif handler == "soun" and info["audio_codec"] is None:
+      info["audio_codec"] = codec
+  return ProbeResult(**info)
+
+'''
+SUMMARY
+-------
+Walk the chunks of a RIFF file between two offsets, see iter_boxes
+-------
+INPUT: open file, start offset, end offset
+OUTPUT: generator of 3-tuples (chunk id, payload start, payload end)
+'''
+def iter_chunks(f,start,end):
+  offset = start
+  while offset + 8 <= end:
+    f.seek(offset)
+    header = f.read(8)
+    if len(header) < 8:
+      return
+    chunk_id, size = struct.unpack("<4sI",header)
+    yield (chunk_id,offset + 8,min(offset + 8 + size,end))
+    #chunks are padded to an even size
+    offset += 8 + size + (size & 1)
+
+'''
+SUMMARY
+-------
+Probe an AVI file
+Only the hdrl list at the start of the file is read: the avih main header
+and the strh/strf headers of each stream
+-------
+INPUT: open file, size of the file in bytes
+OUTPUT: ProbeResult, or None if the file is not a RIFF AVI
+'''
+def probe_avi(f,size):
+  f.seek(0)
+  header = f.read(12)
+  if len(header) < 12 or header[:4] != "RIFF" or header[8:12] != "AVI ":
+    return None
+  info = dict.fromkeys(ProbeResult._fields)
+  info["container"] = "avi"
+  for chunk_id, start, end in iter_chunks(f,12,size):
+    if chunk_id != "LIST" or read_box(f,(start,end),4) != "hdrl":
+      continue
+    for sub_id, sub_start, sub_end in iter_chunks(f,start + 4,end):
+      if sub_id == "avih":
+        data = read_box(f,(sub_start,sub_end),40)
+        usec_per_frame, total_frames = struct.unpack("<I12xI",data[:20])
+        info["duration"] = usec_per_frame * total_frames / 1000000.0
+        info["width"], info["height"] = struct.unpack("<II",data[32:40])
+      elif sub_id == "LIST" and read_box(f,(sub_start,sub_end),4) == "strl":
+        probe_avi_stream(f,sub_start + 4,sub_end,info)
+    break
+  return ProbeResult(**info)
+
+'''
+SUMMARY
+-------
+Read the codec of one AVI stream from its strl list into info
+-------
+INPUT: open file, start and end offsets of the strl list contents, dict of
+       ProbeResult fields
+OUTPUT: None
+'''
+def probe_avi_stream(f,start,end,info):
+  stream_type = handler = None
+  for chunk_id, chunk_start, chunk_end in iter_chunks(f,start,end):
+    if chunk_id == "strh":
+      stream_type, handler = struct.unpack("<4s4s",
+                                           read_box(f,(chunk_start,chunk_end),8))
+    elif chunk_id == "strf" and stream_type == "vids":
+      #biCompression of the BITMAPINFOHEADER
+      data = read_box(f,(chunk_start,chunk_end),20)
+      if info["video_codec"] is None:
+        info["video_codec"] = codec_name(data[16:20]) or codec_name(handler)
+    elif chunk_id == "strf" and stream_type == "auds":
+      #wFormatTag of the WAVEFORMATEX
+      data = read_box(f,(chunk_start,chunk_end),2)
+      if info["audio_codec"] is None:
+        info["audio_codec"] = codec_name(struct.unpack("<H",data)[0])
+
+'''
+SUMMARY
+-------
+Read the system clock reference of an MPEG pack header
+-------
+INPUT: string of data, offset of the pack start code in it
+OUTPUT: clock reference in 90kHz ticks, or None if the header is cut off or
+        not an MPEG-1 or MPEG-2 pack header
+'''
+def read_scr(data,offset):
+  b = bytearray(data[offset + 4:offset + 9])
+  if len(b) < 5:
+    return None
+  if b[0] & 0xc0 == 0x40:
+    return (((b[0] & 0x38) << 27) | ((b[0] & 0x03) << 28) | (b[1] << 20) |
+            ((b[2] & 0xf8) << 12) | ((b[2] & 0x03) << 13) | (b[3] << 5) |
+            (b[4] >> 3))
+  if b[0] & 0xf0 == 0x20:
+    return (((b[0] & 0x0e) << 29) | (b[1] << 22) | ((b[2] >> 1) << 15) |
+            (b[3] << 7) | (b[4] >> 1))
+  return None
+
+'''
+SUMMARY
+-------
+Probe an MPEG program stream, or an MPEG video elementary stream
+Only MPEG_PROBE_BYTES are read from the head of the file, for the sequence
+header and the first pack header, and from the tail, for the last pack
+header; the duration is the difference between their clock references
+-------
+INPUT: open file, size of the file in bytes
+OUTPUT: ProbeResult, or None if neither a pack nor a sequence header is found
+'''
+def probe_mpeg(f,size):
+  f.seek(0)
+  head = f.read(MPEG_PROBE_BYTES)
+  pack = head.find(PACK_START)
+  sequence = head.find(SEQUENCE_START)
+  if pack < 0 and sequence < 0:
+    return None
+  info = dict.fromkeys(ProbeResult._fields)
+  info["container"] = "mpeg"
+  if sequence >= 0 and len(head) >= sequence + 7:
+    b = bytearray(head[sequence + 4:sequence + 7])
+    info["width"] = (b[0] << 4) | (b[1] >> 4)
+    info["height"] = ((b[1] & 0x0f) << 8) | b[2]
+    if head.find(SEQUENCE_EXTENSION,sequence) >= 0:
+      info["video_codec"] = "mpeg2"
+    else:
+      info["video_codec"] = "mpeg1"
+  if MPEG_AUDIO_START.search(head):
+    info["audio_codec"] = "mp2"
+  elif head.find(PRIVATE_STREAM_START) >= 0:
+    info["audio_codec"] = "ac3"
+  first_scr = read_scr(head,pack) if pack >= 0 else None
+  if first_scr is not None:
+    f.seek(max(0,size - MPEG_PROBE_BYTES))
+    tail = f.read(MPEG_PROBE_BYTES)
+    last = tail.rfind(PACK_START)
+    while last >= 0:
+      last_scr = read_scr(tail,last)
+      if last_scr is not None:
+        if last_scr > first_scr:
+          info["duration"] = (last_scr - first_scr) / 90000.0
+        break
+      last = tail.rfind(PACK_START,0,last)
+  return ProbeResult(**info)
+
+#probe for each file extension in config.MOVIE_FILE_EXTENSIONS that has one
+PROBES = {"mp4":probe_mp4,"m4v":probe_mp4,"m4p":probe_mp4,"mov":probe_mp4,
+          "avi":probe_avi,"mpg":probe_mpeg,"mpeg":probe_mpeg,
+          "mpe":probe_mpeg,"mpv":probe_mpeg}
+
+'''
+SUMMARY
+-------
+Read the container metadata of a media file, chosen by its extension
+-------
+INPUT: path to the file
+       optional size of the file in bytes, read with os.stat if not given
+OUTPUT: ProbeResult, or None if the file type has no probe or the file could
+        not be read
+'''
+def probe_file(path,size=None):
+  probe = PROBES.get(os.path.splitext(path)[1][1:].lower())
+  if probe is None:
+    return None
+  try:
+    if size is None:
+      size = os.stat(path).st_size
+    with open(path,'rb') as f:
+      return probe(f,size)
+  except (IOError,OSError) as e:
+    print("WARNING:Unable to probe %s: %s" % (path,e))
+  except struct.error:
+    print("WARNING:Unable to probe %s: truncated header" % path)
+  return None
+
+'''
+SUMMARY
+-------
+Probe one FileManifest entry for probe_manifest
+-------
+INPUT: FileManifest entry
+OUTPUT: 2-tuple (entry, ProbeResult or None)
+'''
+def probe_entry(entry):
+  return (entry,probe_file(entry.path,entry.size))
+
+'''
+SUMMARY
+-------
+Bring MediaInfo up to date with FileManifest
+Files that have no MediaInfo yet, or whose size or mtime changed since they
+were probed, are probed by a pool of threads; MediaInfo rows of files that
+are no longer in the manifest are deleted
+-------
+INPUT: optional path to directory, only files under it are probed
+       optional number of threads
+OUTPUT: the number of files probed
+'''
+def probe_manifest(dir_path="",workers=8):
+  prefix = os.path.join(os.path.abspath(dir_path),"") if dir_path else ""
+  infos = dict([(info.manifest_id,info) for info in MediaInfo.iterate()])
+  entries = list(FileManifest.iterate())
+  manifest_ids = set([entry.id for entry in entries])
+  stale = [entry for entry in entries if entry.path.startswith(prefix) and
+           (entry.id not in infos or (infos[entry.id].size,infos[entry.id].mtime)
+            != (entry.size,entry.mtime))]
+  pool = ThreadPool(workers)
+  count = 0
+  try:
+    with ModelBase.session():
+      for entry, result in pool.imap_unordered(probe_entry,stale):
+        info = infos.get(entry.id)
+        if info is None:
+          info = MediaInfo.create()
+          info.manifest_id = entry.id
+        info.size = entry.size
+        info.mtime = entry.mtime
+        if result is not None:
+          for field, value in zip(ProbeResult._fields,result):
+            if value is not None:
+              setattr(info,field,value)
+        count += 1
+      MediaInfo.delete_ids([info.id for manifest_id, info in infos.items()
+                            if manifest_id not in manifest_ids])
+  finally:
+    pool.terminate()
+  return count
+
+if __name__ == "__main__":
+  import shutil, tempfile
+  from Rescan import rescan
+
+  def box(kind,payload):
+    return struct.pack(">I4s",8 + len(payload),kind) + payload
+
+  def chunk(chunk_id,payload):
+    return struct.pack("<4sI",chunk_id,len(payload)) + payload
+
+  def mp4_track(handler,fourcc,width=0,height=0):
+    tkhd = box("tkhd","\x00" * 76 + struct.pack(">II",width << 16,height << 16))
+    hdlr = box("hdlr","\x00" * 8 + handler + "\x00" * 12)
+    stsd = box("stsd","\x00" * 4 + struct.pack(">I",1) + box(fourcc,"\x00" * 8))
+    return box("trak",tkhd + box("mdia",hdlr + box("minf",box("stbl",stsd))))
+
+  mvhd = box("mvhd","\x00" * 12 + struct.pack(">II",600,600 * 5400) + "\x00" * 80)
+  moov = box("moov",mvhd + mp4_track("vide","avc1",1920,800) +
+             mp4_track("soun","mp4a"))
+  #moov after a large mdat, as written by most encoders
+  mp4_data = box("ftyp","isom") + box("mdat","\x00" * (8 << 20)) + moov
+
+  avih = struct.pack("<IIIIIIIIII",41708,0,0,0,1000,0,2,0,720,304) + "\x00" * 16
+  vids = chunk("LIST","strl" + chunk("strh","vidsxvid" + "\x00" * 48) +
+               chunk("strf",struct.pack("<IiiHH4s",40,720,304,1,24,"XVID")))
+  auds = chunk("LIST","strl" + chunk("strh","auds" + "\x00" * 52) +
+               chunk("strf",struct.pack("<H",0x55) + "\x00" * 16))
+  avi_data = ("RIFF" + struct.pack("<I",0) + "AVI " +
+              chunk("LIST","hdrl" + chunk("avih",avih) + vids + auds) +
+              chunk("LIST","movi" + "\x00" * 1000))
+
+  def pack_header(scr):
+    return PACK_START + struct.pack(">BBBBBBBBB",
+      0x44 | ((scr >> 27) & 0x38) | ((scr >> 28) & 0x03),(scr >> 20) & 0xff,
+      0x04 | ((scr >> 12) & 0xf8) | ((scr >> 13) & 0x03),(scr >> 5) & 0xff,
+      0x04 | ((scr << 3) & 0xf8),0x01,0x89,0xc3,0xf8)
+  mpeg_data = (pack_header(90000) + SEQUENCE_START + "\x2d\x02\x40\x33" +
+               SEQUENCE_EXTENSION + "\x00\x00\x01\xc0" + "\x00" * (1 << 20) +
+               pack_header(90000 * 61))
+
+  scan_root = tempfile.mkdtemp()
+  for name, data in [("Heat (1995).mp4",mp4_data),("Ronin (1998).avi",avi_data),
+                     ("Alien (1979).mpg",mpeg_data),("Up (2009).wmv","")]:
+    with open(os.path.join(scan_root,name),"wb") as f:
+      f.write(data)
+  mp4_info = probe_file(os.path.join(scan_root,"Heat (1995).mp4"))
+  assert (mp4_info == ProbeResult("mp4",5400.0,1920,800,"h264","aac"))
+  avi_info = probe_file(os.path.join(scan_root,"Ronin (1998).avi"))
+  assert (avi_info[:1] + avi_info[2:] == ("avi",720,304,"mpeg4","mp3"))
+  assert (abs(avi_info.duration - 41.708) < 0.001)
+  mpeg_info = probe_file(os.path.join(scan_root,"Alien (1979).mpg"))
+  assert (mpeg_info == ProbeResult("mpeg",60.0,720,576,"mpeg2","mp2"))
+  assert (probe_file(os.path.join(scan_root,"Up (2009).wmv")) is None)
+  rescan(scan_root)
+  assert (probe_manifest(scan_root,workers=2) == 4)
+  assert (probe_manifest(scan_root,workers=2) == 0)
+  shutil.rmtree(scan_root)
@@ -1,8 +1,356 @@
+from contextlib import contextmanager
 from inspect import getmembers
+from weakref import WeakSet, WeakValueDictionary
 from DatabaseInterface import DBInterface
+from Helpers import SortedIndex
 from config import TYPE_MAPPING
 
 
+#every SQL type a specification tuple may use, lowercase
+SQL_TYPES = ["serial primary key"]
+for sql_type in TYPE_MAPPING.values():
+  if isinstance(sql_type,list):
+    SQL_TYPES += [t.lower() for t in sql_type]
+  else:
+    SQL_TYPES.append(sql_type.lower())
+
+#keys the options dict at the end of a specification tuple may use
+#  indexed - create an index on the column with the table
+#  unique - create a unique index on the column and use it as the natural key
+#           of the model, saving a new model whose value is already in the
+#           table updates that row instead of inserting another, at most one
+#           column of a model can be unique
+#  references - the name of the model class whose ids the column holds, so
+#               that rows merged by ModelBase.merge_duplicates keep their
+#               references
+COLUMN_OPTIONS = frozenset(["indexed","unique","references"])
+
+
+class ModelSchema(object):
+  """
+  The compiled specification tuples of one model class
+
+  Built once by ModelMeta when the class is defined, so that creating models
+    and setting attributes never has to inspect the class again
+
+    columns - tuple of the column names in a fixed order
+    positions - dict of column name to its index in columns
+    defaults - dict of column name to default value
+    python_types - dict of column name to Python type
+    sql_types - dict of column name to SQL type string
+    validators - dict of column name to validation function, or None
+    options - dict of column name to the options dict of its specification
+              tuple, empty if it has none
+    indexes - list of tuples of the column names of each index of the table,
+              from the indexed option and ModelBase.table_indexes
+    unique_indexes - list of tuples of the column names of each unique index
+    natural_key - the column with the unique option, or None
+    default_values - tuple of the default values in column order
+    all_columns_mask - dirty bitmask with the bit of every column set
+    check_result - True if the specification tuples are valid, otherwise
+                   the error message explaining the problem
+  """
+  def __init__(self,model_class):
+    self.model_class = model_class
+    self.columns = tuple(self.find_columns(model_class))
+    self.positions = dict([(col,i) for (i,col) in enumerate(self.columns)])
+    self.specs = dict([(col,getattr(model_class,col)) for col in self.columns])
+    self.check_result = self.check()
+    self.default_values = ()
+    self.all_columns_mask = 0
+    self.defaults = {}
+    self.python_types = {}
+    self.sql_types = {}
+    self.validators = {}
+    self.options = {}
+    self.indexes = []
+    self.unique_indexes = []
+    self.natural_key = None
+    if self.check_result != True:
+      return
+    for col, spec_tuple in self.specs.items():
+      self.defaults[col] = spec_tuple[0]
+      self.python_types[col] = spec_tuple[1]
+      self.sql_types[col] = spec_tuple[2]
+      extras, self.options[col] = self.split_extras(spec_tuple)
+      self.validators[col] = extras[0] if extras else None
+    self.indexes = [(col,) for col in self.columns
+                    if self.options[col].get("indexed")]
+    self.indexes += [tuple(index) for index in model_class.table_indexes]
+    for col in self.columns:
+      if self.options[col].get("unique"):
+        self.unique_indexes.append((col,))
+        self.natural_key = col
+    self.default_values = tuple([self.defaults[col] for col in self.columns])
+    self.all_columns_mask = (1 << len(self.columns)) - 1
+
+  @staticmethod
+  def find_columns(model_class):
+    """
+    returns the sorted names of the specification tuples of model_class, 
+    which are all of its attributes that are not builtins or part of ModelBase
+    """
+    model_base_attrs = set([x[0] for x in getmembers(ModelBase)])
+    columns = []
+    for attr, value in getmembers(model_class):
+      if attr.startswith('__') or attr in model_base_attrs:
+        continue
+      columns.append(attr)
+    return columns
+
+  @staticmethod
+  def split_extras(spec_tuple):
+    """
+    returns a 2-tuple (the items of spec_tuple after the SQL type without the
+    options dict, the options dict or an empty dict)
+    """
+    extras = spec_tuple[3:]
+    if extras and isinstance(extras[-1],dict):
+      return (extras[:-1],extras[-1])
+    return (extras,{})
+
+  def check(self):
+    """
+    checks the format of the specification tuples
+    returns True or an error message
+    """
+    this_func_name = "ModelBase.check_model"
+    cls = self.model_class
+    for col in self.columns:
+      spec_tuple = self.specs[col]
+      if type(spec_tuple[0]) not in TYPE_MAPPING:
+        #error message 0
+        return error_message(this_func_name,0,(cls,spec_tuple[0],type(spec_tuple[0])))
+      if spec_tuple[1] not in TYPE_MAPPING:
+        #error message 1
+        return error_message(this_func_name,1,(cls,spec_tuple[1]))
+      if spec_tuple[2].lower() not in SQL_TYPES:
+        #error message 2
+        return error_message(this_func_name,2,(cls,spec_tuple[2]))
+      extras, options = self.split_extras(spec_tuple)
+      for extra in extras[:1]:
+        if not hasattr(extra,'__call__'):
+          #error message 3
+          return error_message(this_func_name,3,(cls,extra))
+      if len(extras) > 1:
+        #error message 8
+        return error_message(this_func_name,8,(cls,extras[1]))
+      for option in options:
+        if option not in COLUMN_OPTIONS:
+          #error message 8
+          return error_message(this_func_name,8,(cls,option))
+      if "references" in options and not isinstance(options["references"],str):
+        #error message 12
+        return error_message(this_func_name,12,(cls,col,options["references"]))
+      if spec_tuple[0] != None:
+        if type(spec_tuple[0]) != spec_tuple[1]:
+          #error message 4
+          return error_message(this_func_name,4,(cls,spec_tuple[0],spec_tuple[1]))
+    unique = [col for col in self.columns
+              if self.split_extras(self.specs[col])[1].get("unique")]
+    if len(unique) > 1:
+      #error message 11
+      return error_message(this_func_name,11,(cls,", ".join(unique)))
+    for index in cls.table_indexes:
+      for col in index:
+        if col not in self.positions:
+          #error message 9
+          return error_message(this_func_name,9,(cls,index,col))
+    return True
+
+
+class ModelRegistry(object):
+  """
+  The tracked instances of one model class, kept in ModelBase.all_models
+
+  Instances are held through weak references, so models that are no longer
+    used anywhere else are released, dirty or not
+  Dirty instances are also kept in the dirty set until they are saved, and
+    in the set of the innermost open ModelBase.session, which holds them
+    until it flushes them so changes made inside a session are never lost
+  Hash indexes can be added on columns with add_index, after which find
+    looks up instances by the value of that column in O(1)
+  Sorted indexes can be added with add_sorted_index, after which in_range
+    returns the instances with a column in a range of values, in order
+
+    models - WeakSet of every tracked instance
+    dirty - WeakSet of the tracked instances that are dirty
+    indexes - dict of column name to a dict of value to WeakSet of instances
+    sorted_index - Helpers.SortedIndex holding weak references, or None
+  """
+  def __init__(self):
+    self.models = WeakSet()
+    self.dirty = WeakSet()
+    self.indexes = {}
+    self.sorted_index = None
+
+  def __iter__(self):
+    """
+    iterates over the tracked instances without copying them
+    models must not be tracked while the iteration is running
+    """
+    return iter(self.models)
+
+  def __len__(self):
+    return len(self.models)
+
+  def __contains__(self,model):
+    return model in self.models
+
+  def add(self,model):
+    """
+    starts tracking an instance
+    """
+    self.models.add(model)
+    if model._is_dirty:
+      self.mark_dirty(model)
+    self.index(model)
+
+  def remove(self,model):
+    """
+    stops tracking an instance
+    """
+    self.unindex(model)
+    self.models.discard(model)
+    self.dirty.discard(model)
+
+  def set_dirty(self,model,dirty):
+    """
+    records that the _is_dirty flag of model was set to dirty
+    """
+    if dirty:
+      self.mark_dirty(model)
+    else:
+      self.dirty.discard(model)
+
+  def mark_dirty(self,model):
+    """
+    adds model to the dirty set and to the models of the innermost open
+    ModelBase.session
+    """
+    self.dirty.add(model)
+    if ModelBase.open_sessions:
+      ModelBase.open_sessions[-1].add(model)
+
+  def value_changed(self,model,name,old_value,new_value):
+    """
+    records that column name of model was set from old_value to new_value
+    """
+    self.mark_dirty(model)
+    if self.sorted_index is not None and name in self.sorted_index.attrs:
+      self.sorted_index.update(model)
+    index = self.indexes.get(name)
+    if index is None or old_value == new_value:
+      return
+    models = index.get(old_value)
+    if models is not None:
+      models.discard(model)
+    index.setdefault(new_value,WeakSet()).add(model)
+
+  def add_index(self,name):
+    """
+    adds a hash index on the column name of the tracked instances
+    """
+    if name in self.indexes:
+      return
+    self.indexes[name] = {}
+    for model in self.models:
+      self.indexes[name].setdefault(getattr(model,name),WeakSet()).add(model)
+
+  def add_sorted_index(self,names):
+    """
+    adds a sorted index on each of the columns names of the tracked instances,
+    keeping the columns of any sorted index added before
+    """
+    if self.sorted_index is not None:
+      names = list(self.sorted_index.attrs) + \
+              [name for name in names if name not in self.sorted_index.attrs]
+      if len(names) == len(self.sorted_index.attrs):
+        return
+    self.sorted_index = SortedIndex(names,weak=True)
+    for model in self.models:
+      self.sorted_index.add(model)
+
+  def index(self,model):
+    """
+    adds model to every index under its current values
+    """
+    for name, index in self.indexes.items():
+      index.setdefault(getattr(model,name),WeakSet()).add(model)
+    if self.sorted_index is not None:
+      self.sorted_index.add(model)
+
+  def unindex(self,model):
+    """
+    removes model from every index
+    """
+    for name, index in self.indexes.items():
+      models = index.get(getattr(model,name))
+      if models is not None:
+        models.discard(model)
+    if self.sorted_index is not None:
+      self.sorted_index.remove(model)
+
+  def find(self,name,value):
+    """
+    returns a list of the tracked instances whose column name equals value
+    uses the index on name if there is one, otherwise scans every instance
+    """
+    index = self.indexes.get(name)
+    if index is None:
+      return [model for model in self.models if getattr(model,name) == value]
+    models = index.get(value)
+    if models is None:
+      return []
+    if not models:
+      #every instance with this value has been released
+      del index[value]
+      return []
+    return list(models)
+
+  def in_range(self,name,low=None,high=None):
+    """
+    returns a list of the tracked instances whose column name is between low
+    and high inclusive, sorted by that column
+    uses the sorted index if it covers name, otherwise sorts every instance
+    """
+    if self.sorted_index is not None and name in self.sorted_index.attrs:
+      return list(self.sorted_index.irange(name,low,high))
+    models = [model for model in self.models if
+              (low is None or getattr(model,name) >= low) and
+              (high is None or getattr(model,name) <= high)]
+    return sorted(models,key=lambda model: getattr(model,name))
+
+
+class ModelMeta(type):
+  """
+  metaclass of ModelBase
+  compiles the specification tuples of each model class into a ModelSchema,
+  stored as cls._schema, and sets up its ModelBase.model_data entry when the
+  class is defined
+  for models with compact set, also generates the class their instances use,
+  stored as cls._storage_class, see CompactModelBase
+  """
+  def __init__(cls,name,bases,namespace):
+    super(ModelMeta,cls).__init__(name,bases,namespace)
+    #ModelBase itself has no specification tuples
+    if not [base for base in bases if isinstance(base,ModelMeta)]:
+      return
+    #neither do the storage classes, which are the only ones using __slots__
+    if "__slots__" in namespace:
+      return
+    cls._schema = ModelSchema(cls)
+    cls.get_class_tablename()
+    ModelBase.all_models[cls] = ModelRegistry()
+    if cls._schema.check_result == True:
+      ModelBase.model_data[cls]["has_been_checked"] = True
+      if cls.compact:
+        cls._storage_class = ModelMeta(name + "Storage",(CompactModelBase,),
+                                       {"__slots__":(),
+                                        "child_class":cls,
+                                        "_schema":cls._schema})
+
+
 class ModelBase(object):
   """
   The Base Model class
@@ -22,24 +370,58 @@ class ModelBase(object):
         used when saving the value to the database or creating the table
       validationFunction (optional) a function that takes one argument and
         returns either True or an error message
+      an options dict (optional) can end the tuple, see COLUMN_OPTIONS, such as
+        title = (None,str,"varchar",{"indexed":True})
+  
+  Indexes on several columns are declared in table_indexes
+  
+    table_indexes = [("title","release_year")]
         
   Instances should only be created using the "create" method of the model, such as
     
     the_class_instance = TheClass.create()
     
+  Models declared with compact = True keep their columns in a list in column
+    order and their dirty state in a bitmask instead, see CompactModelBase
+    
   __dict__ structure
     ['status'] - data not needed in the database`
       ['_is_dirty'] - if the model has been updated since its last save
+      ['_dirty_mask'] - int with bit n set if column n of ModelSchema.columns
+                        changed since the last save or load
     ['attrs'] - data NEEDED in the database
       ['id'] - the primary key of the model in the database
       columns defined in the child class
   """
+  __metaclass__ = ModelMeta
+
   #holds the one database connection for all models
   db_interface = DBInterface.get_interface()
+
+  #the compiled ModelSchema of a model class, set by ModelMeta
+  _schema = None
+
+  #set compact = True in a model class to store its instances in a generated
+  #CompactModelBase subclass instead of the __dict__ structure below
+  compact = False
+  _storage_class = None
+
+  #tuples of column names to create an index on with the table, indexes on
+  #one column can use the indexed option of the specification tuple instead
+  table_indexes = ()
   
   #dict to track all model instances
-  #key is the class and value is a list of all instances
+  #key is the class and value is a ModelRegistry of its instances
   all_models = {}
+
+  #identity map of the models that have been saved or loaded
+  #key is (class, id) and value is the model instance, so that a row is only
+  #ever materialized once
+  identity_map = WeakValueDictionary()
+
+  #one set per open ModelBase.session, innermost last, of the models made
+  #dirty inside it
+  open_sessions = []
   
   """
   holds model-specific information
@@ -50,9 +432,16 @@ class ModelBase(object):
                        and found it
     ['has_been_checked'] - stores True if the model has successfully passed the 
                            tests in ModelBase.check_model
+  model_data is filled in by ModelMeta when the model class is defined
   """
   model_data = {}
 
+  #columns and index names of the table of every registered model, see
+  #ModelBase.load_catalog
+  #key is the tablename and value is the 2-tuple (set of columns, set of index
+  #names), or None if the table does not exist yet
+  catalog = None
+
 
   @classmethod
   def get_all_models(cls):
@@ -60,84 +449,361 @@ class ModelBase(object):
     returns a list of all instances of a given model class
     instances are tracked in ModelBase.all_models
     """
-    if not ModelBase.all_models.has_key(cls):
+    if cls not in ModelBase.all_models:
       return []
-    #return a copy of the list so that the actual list cannot be altered 
-    #by the caller
-    return ModelBase.all_models[cls][:]
+    #return a copy so that the registry cannot be altered by the caller
+    return list(ModelBase.all_models[cls])
+
+  @classmethod
+  def iter_models(cls):
+    """
+    iterates over all tracked instances of a given model class without 
+    copying them
+    """
+    if cls not in ModelBase.all_models:
+      return iter(())
+    return iter(ModelBase.all_models[cls])
+
+  @classmethod
+  def add_index(cls,attr):
+    """
+    adds a hash index on attr to the tracked instances of the model class so
+    that find_models can look them up in O(1)
+    """
+    ModelBase.all_models[cls].add_index(attr)
+
+  @classmethod
+  def find_models(cls,attr,value):
+    """
+    returns a list of the tracked instances of the model class whose attr
+    equals value
+    """
+    return ModelBase.all_models[cls].find(attr,value)
+
+  @classmethod
+  def add_sorted_index(cls,*attrs):
+    """
+    adds a sorted index on each of attrs to the tracked instances of the model
+    class so that find_models_in_range can return them in O(log n) plus the
+    number of instances found
+    """
+    ModelBase.all_models[cls].add_sorted_index(attrs)
+
+  @classmethod
+  def find_models_in_range(cls,attr,low=None,high=None):
+    """
+    returns a list of the tracked instances of the model class whose attr
+    is between low and high inclusive, sorted by attr
+    low or high of None leaves that end of the range open
+    """
+    return ModelBase.all_models[cls].in_range(attr,low,high)
     
   @classmethod
   def track_model(cls,model):
     """
     adds an instance of a model to the tracking dictionary, ModelBase.all_models
     """
-    if not ModelBase.all_models.has_key(cls):
-      ModelBase.all_models[cls] = [model]
+    ModelBase.all_models[cls].add(model)
+
+  @classmethod
+  def register_identity(cls,model,row=None):
+    """
+    adds a model with an id to ModelBase.identity_map
+    row is the dict of values an upsert left in the table, loaded into model
+      first so that the columns it did not set show what the row holds
+    if another live instance already holds that row, as when a new model is
+      upserted onto a natural key that was loaded or saved before, that
+      instance stays the one in the map: it gets the values the save wrote
+      and model gets the rest of its values, so both show the same row
+    """
+    if not model.id:
       return
-    ModelBase.all_models[cls].append(model)
+    registry = ModelBase.all_models[model.child_class]
+    if row:
+      registry.unindex(model)
+      model.load_values(row)
+      registry.index(model)
+    key = (model.child_class,model.id)
+    existing = ModelBase.identity_map.get(key)
+    if existing is None or existing is model:
+      ModelBase.identity_map[key] = model
+      return
+    #the upsert kept the saved value of every column that model left None
+    saved = dict([(col,value) for col, value in model.get_columns().items()
+                  if value is not None])
+    registry.unindex(existing)
+    existing.load_values(saved)
+    registry.index(existing)
+    registry.unindex(model)
+    model.load_values(existing.get_columns())
+    registry.index(model)
 
   @classmethod
   def create(cls):
     """
     returns a new instance of the Model
-    initializes the __dict__ attribute using the specification tuple from the 
+    initializes the __dict__ attribute using the compiled ModelSchema of the
     class from which it is called
     """
-    result = cls.check_model()
-    if result != True:
-      print(result)
+    schema = cls._schema
+    if schema.check_result != True:
+      print(schema.check_result)
       return None
-    m = ModelBase()
-    m.__dict__['status'] = {'_is_dirty':True}
-    m.__dict__['status']['child_class'] = cls
-    m.__dict__['attrs'] = {}
-    for attr in cls.get_super_attrs():
-      m.__dict__['attrs'][attr] = getattr(cls,attr)[0]
+    m = cls.new_instance({},True)
     cls.track_model(m)
-    m.set_tablename()
     return m
+
+  @classmethod
+  def new_instance(cls,values,dirty):
+    """
+    returns a new, untracked instance of the Model holding the given column
+    values without validating them
+    columns missing from values get their default
+    """
+    if cls._storage_class:
+      return cls._storage_class.from_values(values,dirty)
+    m = ModelBase()
+    m.__dict__['status'] = {'_is_dirty':dirty,'child_class':cls}
+    if dirty:
+      m.__dict__['status']['_dirty_mask'] = cls._schema.all_columns_mask
+    else:
+      m.__dict__['status']['_dirty_mask'] = 0
+    attrs = cls._schema.defaults.copy()
+    attrs.update(values)
+    m.__dict__['attrs'] = attrs
+    return m
+
+  def load_values(self,values):
+    """
+    stores column values that came from the database, without validation
+    """
+    self.__dict__['attrs'].update(values)
+
+  def set_dirty_mask(self,mask):
+    """
+    sets _dirty_mask, and _is_dirty to match, without validation
+    """
+    status = self.__dict__['status']
+    status['_dirty_mask'] = mask
+    status['_is_dirty'] = mask != 0
+    ModelBase.all_models[self.child_class].set_dirty(self,mask != 0)
   
+  @classmethod
+  def bulk_save(cls,models):
+    """
+    save many models to the database at once
+    new models are inserted with DBInterface.bulk_insert, one batch per table,
+      and the returned ids are recorded on each model in order
+    if the model has a natural key, new models whose key is already in the
+      table update that row and get its id, in the same statements
+    models that already have an id are updated with DBInterface.bulk_update
+      if they are dirty, sending only the columns that changed
+    everything is committed in one transaction
+    sets _is_dirty to False on every model, if the transaction is rolled back,
+      here or in an enclosing block, the ids and dirty state are put back
+    """
+    by_class = {}
+    for m in models:
+      by_class.setdefault(m.child_class,[]).append(m)
+    with ModelBase.db_interface.transaction():
+      ModelBase.restore_on_rollback(models)
+      for the_class, class_models in by_class.items():
+        class_models[0].verify_table_exists()
+        tablename = class_models[0].get_tablename()
+        natural_key = the_class._schema.natural_key
+        new_models = [m for m in class_models if not m.id]
+        rows = []
+        for m in new_models:
+          columns = m.get_columns()
+          columns.pop("id",None)
+          rows.append(columns)
+        ids = ModelBase.db_interface.bulk_insert(tablename,rows,
+                conflict_column=natural_key)
+        for m, the_id, row in zip(new_models,ids,rows):
+          m.id = the_id
+          m._is_dirty = False
+          ModelBase.register_identity(m,row if natural_key else None)
+        dirty_rows = [m.get_dirty_columns() for m in class_models if m._is_dirty]
+        if dirty_rows:
+          ModelBase.db_interface.bulk_update(tablename,dirty_rows)
+        for m in class_models:
+          m._is_dirty = False
+
+  @classmethod
+  def restore_on_rollback(cls,models):
+    """
+    records the id and dirty state of models and registers with
+    DBInterface.on_rollback to put them back if the open transaction is
+    rolled back, so that models saved in it are saved again next time
+    """
+    snapshots = [(m,m.id,m._dirty_mask) for m in models]
+    ModelBase.db_interface.on_rollback(
+      lambda: ModelBase.restore_saved_state(snapshots))
+
+  @staticmethod
+  def restore_saved_state(snapshots):
+    """
+    puts back the ids and dirty state recorded by restore_on_rollback
+    changes made since are kept dirty as well
+    """
+    for m, the_id, mask in snapshots:
+      if m.id != the_id:
+        key = (m.child_class,m.id)
+        if ModelBase.identity_map.get(key) is m:
+          del ModelBase.identity_map[key]
+        registry = ModelBase.all_models[m.child_class]
+        registry.unindex(m)
+        m.load_values({"id":the_id})
+        registry.index(m)
+      m.set_dirty_mask(m._dirty_mask | mask)
+
+  @classmethod
+  def flush(cls):
+    """
+    saves every tracked model that is dirty, grouped per table
+    uses ModelBase.bulk_save so each table costs a few batched statements
+    session only saves the models made dirty inside it instead
+    """
+    dirty_models = []
+    for registry in ModelBase.all_models.values():
+      dirty_models += list(registry.dirty)
+    if dirty_models:
+      ModelBase.bulk_save(dirty_models)
+
+  @classmethod
+  @contextmanager
+  def session(cls):
+    """
+    unit of work context manager
+
+      with ModelBase.session():
+        m.title = "Something else"
+        ...
+
+    when the block exits the models created or changed inside it that are
+    still dirty are saved with ModelBase.bulk_save and the whole block is
+    committed once, models made dirty before or outside the block are left
+    alone
+    if the block raises, nothing is flushed and the transaction is rolled back
+    a nested session flushes its own models, anything it leaves dirty is
+    flushed by the enclosing one
+    """
+    touched = set()
+    ModelBase.open_sessions.append(touched)
+    try:
+      with ModelBase.db_interface.transaction():
+        yield
+        dirty_models = [m for m in touched if m._is_dirty]
+        if dirty_models:
+          ModelBase.bulk_save(dirty_models)
+    finally:
+      ModelBase.open_sessions.pop()
+      if ModelBase.open_sessions:
+        ModelBase.open_sessions[-1].update([m for m in touched if m._is_dirty])
+
+  @classmethod
+  def iterate(cls,column_dict=None,itersize=None):
+    """
+    generator over the rows of the model's table as model instances
+    rows are streamed with DBInterface.iter_from_table, so only about itersize
+      rows are held in memory at a time
+    column_dict (optional) is passed on for the WHERE clause, see 
+      DBInterface.get_from_table, every column of the model is selected
+    """
+    cls.verify_class_table()
+    query_dict = dict([(col,None) for col in cls.get_super_attrs()])
+    if column_dict:
+      query_dict.update(column_dict)
+    rows = ModelBase.db_interface.iter_from_table(cls.get_class_tablename(),
+                                                  query_dict,itersize)
+    for m in cls.hydrate(rows):
+      yield m
+
+  @classmethod
+  def query(cls):
+    """
+    returns a Query over the model's table, the filtering, ordering and
+    paging are done by the database
+
+      RawMediaFile.query().where("release_year",">=",1990).order_by("title")
+    """
+    return Query(cls)
+
+  @classmethod
+  def load_many(cls,rows,columns=None):
+    """
+    returns a list of model instances built from database rows
+    rows is a list of tuples, if columns is not given the first tuple must be
+      the column names, as returned by DBInterface.get_from_table
+    see ModelBase.hydrate
+    """
+    return list(cls.hydrate(rows,columns))
+
+  @classmethod
+  def get(cls,the_id):
+    """
+    returns the model with the given id, or None if there is no such row
+    a model already in ModelBase.identity_map is returned without a query
+    """
+    the_id = int(the_id)
+    m = ModelBase.identity_map.get((cls,the_id))
+    if m is not None:
+      return m
+    cls.verify_class_table()
+    query_dict = dict([(col,None) for col in cls.get_super_attrs()])
+    query_dict["id"] = "= " + str(the_id)
+    loaded = cls.load_many(ModelBase.db_interface.get_from_table(
+                             cls.get_class_tablename(),query_dict))
+    if not loaded:
+      return None
+    return loaded[0]
+
+  @classmethod
+  def hydrate(cls,rows,columns=None):
+    """
+    generator that builds model instances from database rows in bulk
+    the values came from the database, so they are stored directly without
+      the validation done in __setattr__ and the models are not dirty
+    rows whose (class, id) is already in ModelBase.identity_map give back the
+      existing instance, refreshed with the row unless it has unsaved changes
+    """
+    result = cls.check_model()
+    if result != True:
+      print(result)
+      return
+    rows = iter(rows)
+    if columns is None:
+      columns = next(rows,None)
+      if columns is None:
+        return
+    columns = tuple(columns)
+    identity_map = ModelBase.identity_map
+    registry = ModelBase.all_models[cls]
+    for row in rows:
+      values = dict(zip(columns,row))
+      key = (cls,values.get("id"))
+      m = identity_map.get(key)
+      if m is not None:
+        if not m._is_dirty:
+          registry.unindex(m)
+          m.load_values(values)
+          registry.index(m)
+        yield m
+        continue
+      m = cls.new_instance(values,False)
+      cls.track_model(m)
+      if key[1]:
+        identity_map[key] = m
+      yield m
+
   @classmethod
   def check_model(cls):
     """
-    checks the format of the specification tuples in the child class definition
+    returns True if the specification tuples in the child class definition
+    are valid, otherwise an error message
+    the check is done once by ModelSchema when the class is defined
     """
-    this_func_name = "ModelBase.check_model"
-    if ModelBase.model_data.has_key(cls) and  \
-       ModelBase.model_data[cls].has_key("has_been_checked") and \
-       ModelBase.model_data[cls]["has_been_checked"] == True:
-        return True
-    for attr in cls.get_super_attrs():
-      spec_tuple = getattr(cls,attr)
-      if type(spec_tuple[0]) not in TYPE_MAPPING.keys():
-        #error message 0
-        return error_message(this_func_name,0,(cls,spec_tuple[0],type(spec_tuple[0])))
-      if spec_tuple[1] not in TYPE_MAPPING.keys():
-        #error message 1
-        return error_message(this_func_name,1,(cls,spec_tuple[1]))
-      sql_types = []
-      for val in TYPE_MAPPING.values():
-        if isinstance(val,list):
-          sql_types += [v.lower() for v in val] 
-        else:
-          sql_types.append(val.lower())
-      sql_types.append("serial primary key")
-      if spec_tuple[2].lower() not in sql_types:
-        #error message 2
-        return error_message(this_func_name,2,(cls,spec_tuple[2]))
-      if len(spec_tuple) > 3:
-        if not hasattr(spec_tuple[3],'__call__'):
-          #error message 3
-          return error_message(this_func_name,3,(cls,spec_tuple[3]))
-      if spec_tuple[0] != None:
-        if type(spec_tuple[0]) != spec_tuple[1]:
-          #error message 4
-          return error_message(this_func_name,4,(cls,spec_tuple[0],spec_tuple[1]))
-    if not ModelBase.model_data.has_key(cls):
-      ModelBase.model_data[cls] = {}
-    if not ModelBase.model_data[cls].has_key("has_been_checked"): 
-      ModelBase.model_data[cls]["has_been_checked"] = True
-    return True
+    return cls._schema.check_result
   
   @classmethod
   def get_super_attrs(cls):
@@ -145,33 +811,29 @@ class ModelBase(object):
     returns strings representing the attribute names of the calling class
     only returns attributes that are not part of ModelClass
     it should only return the names of the specification tuples
-    uses inspect.getmembers
-    """
-    all_attrs = [x[0] for x in getmembers(cls)]
-    model_base_attrs = [x[0] for x in getmembers(ModelBase)]
-    super_attrs = []
-    for attr in all_attrs:
-      #skip it if it's a builtin
-      if attr.startswith('__'):
-        continue
-      #skip it if it's in ModelBase
-      if attr in model_base_attrs:
-        continue
-      super_attrs.append(attr)
-    return super_attrs
+    these are found once by ModelSchema when the class is defined
+    """
+    return list(cls._schema.columns)
 
-  def set_tablename(self):
+  @classmethod
+  def get_class_tablename(cls):
     """
     creates the tablename and saves it into the ModelBase.model_data dict at 
-    model_data['tablename']
+    model_data['tablename'], then returns it
     the tablename is just the all lowercase classname with '_table' appended
     """
-    the_class = self.child_class
-    if not ModelBase.model_data.has_key(the_class):
-      ModelBase.model_data[the_class] = {}
-    if not ModelBase.model_data[the_class].has_key("tablename"):
-      the_name = the_class.__name__.lower() + "_table"
-      ModelBase.model_data[the_class]["tablename"] = the_name
+    if not ModelBase.model_data.has_key(cls):
+      ModelBase.model_data[cls] = {}
+    if not ModelBase.model_data[cls].has_key("tablename"):
+      the_name = cls.__name__.lower() + "_table"
+      ModelBase.model_data[cls]["tablename"] = the_name
+    return ModelBase.model_data[cls]["tablename"]
+
+  def set_tablename(self):
+    """
+    makes sure the tablename for the model is saved in ModelBase.model_data
+    """
+    self.child_class.get_class_tablename()
     
   def get_tablename(self):
     """
@@ -201,80 +863,527 @@ class ModelBase(object):
   def __setattr__(self,name,value):
     """
     overrides base __setattr__ functionality to use __dict__
-    uses the Python type defined in the specification tuple of the class for 
+    uses the Python type defined in the compiled ModelSchema of the class for 
       validation and will case the 'value' as the Python type if necessary
     uses the optional custom validation function defined in the specification
       tuple if it exists
+    records which column changed in _dirty_mask, setting a column to the value
+      it already has does not make the model dirty
     prints error messages if it encounters an issue
     """
     #don't allow direct setting of __dict__
-    this_func_name = "ModelBase.__setattr__"
     if name == "__dict__":
       return
-    if self.__dict__['status'].has_key(name):
-      self.__dict__['status'][name] = value
+    status = self.__dict__['status']
+    if name in status:
+      status[name] = value
+      if name == '_is_dirty':
+        child_class = status['child_class']
+        if value:
+          status['_dirty_mask'] = child_class._schema.all_columns_mask
+        else:
+          status['_dirty_mask'] = 0
+        ModelBase.all_models[child_class].set_dirty(self,value)
       return None
-    if not self.__dict__['attrs'].has_key(name):
-      #error message 5
-      print(error_message(this_func_name,5,(name,self.child_class)))
+    child_class = status['child_class']
+    valid, value = ModelBase.clean_value(child_class,name,value)
+    if not valid:
+      return None
+    attrs = self.__dict__['attrs']
+    old_value = attrs[name]
+    #setting a column to the value it already has changes nothing
+    if value == old_value and type(value) == type(old_value):
       return None
+    attrs[name] = value
+    #the value has been set and the object is now different from that in the
+    #database
+    status['_is_dirty'] = True
+    status['_dirty_mask'] |= 1 << child_class._schema.positions[name]
+    ModelBase.all_models[child_class].value_changed(self,name,old_value,value)
+
+  @staticmethod
+  def clean_value(child_class,name,value):
+    """
+    validates a value for the column name of child_class as described in 
+      __setattr__
+    returns (True, the value cast to the column's Python type) if it is valid
+    prints an error message and returns (False, None) if it is not
+    """
+    this_func_name = "ModelBase.__setattr__"
+    schema = child_class._schema
+    if name not in schema.positions:
+      #error message 5
+      print(error_message(this_func_name,5,(name,child_class)))
+      return (False,None)
     #TYPE VALIDATION
-    specification = getattr(self.child_class,name)
-    correct_type = specification[1]
+    correct_type = schema.python_types[name]
     if not isinstance(value,correct_type):
       try:
         value = correct_type(value)
       except:
         #error message 6
-        print(error_message(this_func_name,6,(value,correct_type,self.child_class)))
-        return None
-    if len(specification) <= 3:
-      #set the value if there is not custom validation
-      self.__dict__['attrs'][name] = value
-      return None
+        print(error_message(this_func_name,6,(value,correct_type,child_class)))
+        return (False,None)
+    validator = schema.validators[name]
+    if validator is None:
+      return (True,value)
     #CUSTOM VALIDATION
-    validator = specification[3]
     result = validator(value)
-    if result == True:
-      self.__dict__['attrs'][name] = value
-    else:
-        #error message 7
-        print(error_message(this_func_name,7,(value,validator,result,self.child_class)))
-        return None
-    #if we make it all the way to the end, the value has been set and the object
-    #is now different from that in the database
-    self.__dict__['status']['_is_dirty'] = True
+    if result != True:
+      #error message 7
+      print(error_message(this_func_name,7,(value,validator,result,child_class)))
+      return (False,None)
+    return (True,value)
     
   def verify_table_exists(self):
     """
     check if the table for this model exists in the database and create it
     if necessary
-    once it exists, set the model_data[class]['table_exists'] flag to True
-    """
-    if ModelBase.model_data[self.child_class].get('table_exists'): return True
-    if ModelBase.db_interface.does_table_exist(self.get_tablename()):
-      ModelBase.model_data[self.child_class]['table_exists'] = True
-      return True
-    col_dict = {}
-    for col in self.get_columns():
-      col_dict[col] = getattr(self.child_class,col)[2]
-    ModelBase.db_interface.create_table(self.get_tablename(),col_dict)
-    ModelBase.model_data[self.child_class]['table_exists'] = True
+    see ModelBase.verify_class_table
+    """
+    return self.child_class.verify_class_table()
+
+  @classmethod
+  def verify_class_table(cls):
+    """
+    check if the table for the model class exists in the database and create
+    it if necessary
+    an existing table missing columns or indexes of the model gets them with
+    ALTER TABLE ADD COLUMN and CREATE INDEX, columns are never dropped or
+    changed
+    rows sharing a value of the natural key, saved before it was declared
+    unique, are merged before its unique index is created, see
+    merge_duplicates
+    the table is looked up in ModelBase.catalog, so checking every model costs
+    one query, see ModelBase.load_catalog
+    once it is up to date, set the model_data[class]['table_exists'] flag to
+    True
+    """
+    if ModelBase.model_data[cls].get('table_exists'): return True
+    tablename = cls.get_class_tablename()
+    if ModelBase.catalog is None or tablename not in ModelBase.catalog:
+      ModelBase.load_catalog()
+    schema = cls._schema
+    db_interface = ModelBase.db_interface
+    entry = ModelBase.catalog[tablename]
+    if entry is None:
+      col_dict = schema.sql_types.copy()
+      db_interface.create_table(tablename,col_dict,schema.indexes,
+                                schema.unique_indexes)
+    else:
+      columns, index_names = entry
+      missing = dict([(col,schema.sql_types[col]) for col in schema.columns
+                      if col not in columns])
+      with db_interface.transaction():
+        db_interface.add_columns(tablename,missing)
+        for index_columns, unique in [(index,False) for index in schema.indexes] + \
+                                     [(index,True) for index in schema.unique_indexes]:
+          if db_interface.index_name(tablename,index_columns,unique) in index_names:
+            continue
+          if unique:
+            cls.merge_duplicates(index_columns[0])
+          db_interface.create_index(tablename,index_columns,unique)
+    #from now on the table_exists flag stands in for the catalog entry
+    del ModelBase.catalog[tablename]
+    ModelBase.model_data[cls]['table_exists'] = True
     return True
+
+  @classmethod
+  def merge_duplicates(cls,column):
+    """
+    merges the rows of the model's table that share a value of column into
+    the one with the lowest id, so a unique index can be created on it
+    columns of other models with the references option naming this model
+      are pointed at the row that is kept first
+    prints what was merged
+    returns the number of rows deleted
+    """
+    tablename = cls.get_class_tablename()
+    db_interface = ModelBase.db_interface
+    count, duplicates = db_interface.find_duplicates(tablename,[column])
+    if not count:
+      return 0
+    print("WARNING:%d values of %s are in more than one row of %s, merging "
+          "each into its first row" % (count,column,tablename))
+    for values, copies in duplicates:
+      print("  %r - %d rows" % (values[0],copies))
+    references = []
+    for model_class in ModelBase.all_models:
+      schema = model_class._schema
+      if schema.check_result != True:
+        continue
+      for col in schema.columns:
+        if schema.options[col].get("references") == cls.__name__:
+          references.append((model_class.get_class_tablename(),col))
+    #only tables that already have the column can hold references
+    catalog = db_interface.get_catalog([ref[0] for ref in references])
+    references = [(ref_table,col) for (ref_table,col) in references
+                  if catalog[ref_table] and col in catalog[ref_table][0]]
+    return db_interface.merge_duplicates(tablename,column,references)
+
+  @classmethod
+  def load_catalog(cls):
+    """
+    loads the columns and indexes of the tables of every registered model
+    class that has not been checked yet into ModelBase.catalog with one
+    query, see DBInterface.get_catalog
+    model classes defined after the catalog was loaded are added to it the
+    first time one of them is used
+    """
+    tablenames = [model_class.get_class_tablename() for model_class in
+                  ModelBase.all_models
+                  if model_class._schema.check_result == True and
+                  not ModelBase.model_data[model_class].get('table_exists')]
+    if ModelBase.catalog is None:
+      ModelBase.catalog = {}
+    ModelBase.catalog.update(ModelBase.db_interface.get_catalog(tablenames))
+
+  @classmethod
+  def delete_ids(cls,ids):
+    """
+    deletes the rows with the given ids from the model's table in one 
+    statement and stops tracking any instances of them
+    """
+    ids = [int(the_id) for the_id in ids]
+    if not ids:
+      return
+    cls.verify_class_table()
+    ModelBase.db_interface.delete_rows(cls.get_class_tablename(),ids)
+    registry = ModelBase.all_models[cls]
+    for the_id in ids:
+      m = ModelBase.identity_map.pop((cls,the_id),None)
+      if m is not None:
+        registry.remove(m)
   
   def save(self):
     """
     save the model to the database
     if it's the first save, record the returned ID
-    set _is_dirty to False
+    if the model has a natural key that is already in the table, the first
+      save updates that row and records its ID instead
+    later saves only UPDATE the columns that changed, or skip the database if
+      nothing did
+    set _is_dirty to False, see bulk_save for what happens on a rollback
     """
     self.verify_table_exists()
+    ModelBase.restore_on_rollback([self])
     if not self.id:
-      self.id = ModelBase.db_interface.save_to_table(self.tablename,self.get_columns())
+      natural_key = self.child_class._schema.natural_key
+      columns = self.get_columns()
+      self.id = ModelBase.db_interface.save_to_table(self.tablename,columns,
+                                                     natural_key)
+      ModelBase.register_identity(self,columns if natural_key else None)
     elif self._is_dirty:
-      ModelBase.db_interface.save_to_table(self.tablename,self.get_columns())
+      changed_columns = self.get_dirty_columns()
+      #the id is always there, so only go to the database if anything else is
+      if len(changed_columns) > 1:
+        ModelBase.db_interface.save_to_table(self.tablename,changed_columns)
     self._is_dirty = False
 
+  def get_dirty_columns(self):
+    """
+    returns a dict of only the columns that changed since the last save or 
+    load, plus the id
+    """
+    columns = self.get_columns()
+    mask = self._dirty_mask
+    changed_columns = {}
+    for position, col in enumerate(self.child_class._schema.columns):
+      if mask & (1 << position):
+        changed_columns[col] = columns[col]
+    if "id" in columns:
+      changed_columns["id"] = columns["id"]
+    return changed_columns
+
+
+class CompactModelBase(ModelBase):
+  """
+  Storage for the instances of models declared with compact = True
+
+  ModelMeta generates one subclass of this per compact model, with the model
+    as its child_class and the model's ModelSchema as its _schema
+    
+    class TheClass(ModelBase):
+      compact = True
+      title = (default,pythonType,SQLType,validationFunction)
+
+  Instead of the two dicts in __dict__, each instance holds
+    _values - list of the column values, in ModelSchema.columns order
+    _dirty_mask - int with bit n set if column n changed since the last save
+  The attribute API is the same as for other models
+  ModelBase itself has no __slots__, since its own instances keep their
+    columns in __dict__, so instances of this class still have the __dict__
+    and __weakref__ pointers; the weak reference is what ModelRegistry and
+    ModelBase.identity_map hold, and the __dict__ is never created
+  """
+  __slots__ = ("_values","_dirty_mask")
+
+  @classmethod
+  def from_values(storage_class,values,dirty):
+    """
+    returns a new instance holding the given column values
+    see ModelBase.new_instance
+    """
+    schema = storage_class._schema
+    m = storage_class()
+    column_values = list(schema.default_values)
+    for name, value in values.items():
+      if name in schema.positions:
+        column_values[schema.positions[name]] = value
+    object.__setattr__(m,"_values",column_values)
+    if dirty:
+      object.__setattr__(m,"_dirty_mask",schema.all_columns_mask)
+    else:
+      object.__setattr__(m,"_dirty_mask",0)
+    return m
+
+  def load_values(self,values):
+    """
+    stores column values that came from the database, without validation
+    """
+    positions = self._schema.positions
+    for name, value in values.items():
+      if name in positions:
+        self._values[positions[name]] = value
+
+  def set_dirty_mask(self,mask):
+    """
+    sets _dirty_mask without validation
+    """
+    object.__setattr__(self,"_dirty_mask",mask)
+    ModelBase.all_models[self.child_class].set_dirty(self,mask != 0)
+
+  def __getattr__(self,attr):
+    """
+    reads columns from _values
+    """
+    if attr.lower() == 'tablename':
+      return self.get_tablename()
+    if attr == '_is_dirty':
+      return self._dirty_mask != 0
+    position = self._schema.positions.get(attr)
+    if position is None:
+      return None
+    return self._values[position]
+
+  def get_columns(self):
+    """
+    returns a dict of the column values, which contains the data that the
+    database cares about
+    """
+    return dict(zip(self._schema.columns,self._values))
+
+  def __setattr__(self,name,value):
+    """
+    validates the value as in ModelBase.__setattr__ and stores it in _values
+    setting _is_dirty sets or clears every bit of _dirty_mask
+    """
+    if name == "_is_dirty":
+      if value:
+        object.__setattr__(self,"_dirty_mask",self._schema.all_columns_mask)
+      else:
+        object.__setattr__(self,"_dirty_mask",0)
+      ModelBase.all_models[self.child_class].set_dirty(self,value)
+      return None
+    if name == "child_class":
+      return None
+    valid, value = ModelBase.clean_value(self.child_class,name,value)
+    if not valid:
+      return None
+    position = self._schema.positions[name]
+    old_value = self._values[position]
+    #setting a column to the value it already has changes nothing
+    if value == old_value and type(value) == type(old_value):
+      return None
+    self._values[position] = value
+    object.__setattr__(self,"_dirty_mask",self._dirty_mask | (1 << position))
+    ModelBase.all_models[self.child_class].value_changed(self,name,old_value,
+                                                         value)
+
+
+class Query(object):
+  """
+  Builds a SELECT on the table of a model class and returns model instances
+
+    page = RawMediaFile.query().where("release_year","between",(1990,1999))\
+             .order_by("release_year","-title").limit(50).all()
+    next_page = RawMediaFile.query().where(...).order_by(...).limit(50)\
+                  .after(page[-1]).all()
+
+  Every value is sent as a query parameter and every column name is checked
+    against the model's ModelSchema, so nothing from the caller is pasted into
+    the SQL
+  The builder methods return the query itself so they can be chained
+  Results are always ordered by id last, so that the order is total and
+    after can continue from any instance (keyset pagination): the next page
+    starts from the ordered values of the last instance, which an index on
+    the ordered columns finds without reading the skipped rows as OFFSET would
+    the ordered columns must not be NULL for keyset pagination
+  """
+  #operator accepted by where to the SQL it becomes, %s is the value
+  OPERATORS = {"=":"= %s","!=":"<> %s","<>":"<> %s","<":"< %s","<=":"<= %s",
+               ">":"> %s",">=":">= %s","like":"LIKE %s","ilike":"ILIKE %s",
+               "in":"= ANY(%s)"}
+
+  def __init__(self,model_class):
+    self.model_class = model_class
+    self.predicates = []
+    self.params = {}
+    self.ordering = []
+    self.row_limit = None
+    self.keyset = None
+
+  def copy(self):
+    other = Query(self.model_class)
+    other.predicates = list(self.predicates)
+    other.params = dict(self.params)
+    other.ordering = list(self.ordering)
+    other.row_limit = self.row_limit
+    other.keyset = self.keyset
+    return other
+
+  def check_column(self,name):
+    if name not in self.model_class._schema.positions:
+      raise ValueError(error_message("Query",5,(name,self.model_class)))
+    return name
+
+  def param(self,value):
+    """
+    stores value as a query parameter and returns its placeholder
+    """
+    name = "p%d" % len(self.params)
+    self.params[name] = value
+    return "%%(%s)s" % name
+
+  def where(self,column,operator,value=None):
+    """
+    adds the condition column operator value, conditions are joined with AND
+    operator is a key of OPERATORS or "between" with a 2-tuple value
+    "=" or "!=" with None become IS NULL and IS NOT NULL
+    """
+    self.check_column(column)
+    operator = operator.lower()
+    if value is None and operator in ("=","!=","<>"):
+      self.predicates.append(column + (" IS NULL" if operator == "=" else
+                                       " IS NOT NULL"))
+    elif operator == "between":
+      self.predicates.append("%s BETWEEN %s AND %s" %
+                             (column,self.param(value[0]),self.param(value[1])))
+    elif operator in self.OPERATORS:
+      if operator == "in":
+        value = list(value)
+      self.predicates.append(column + " " +
+                             self.OPERATORS[operator] % self.param(value))
+    else:
+      raise ValueError(error_message("Query",10,(operator,)))
+    return self
+
+  def filter_by(self,**values):
+    """
+    adds a column = value condition for each keyword argument
+    """
+    for column in sorted(values):
+      self.where(column,"=",values[column])
+    return self
+
+  def order_by(self,*columns):
+    """
+    orders the results by columns, a column starting with "-" is descending
+    """
+    for column in columns:
+      descending = column.startswith("-")
+      self.ordering.append((self.check_column(column.lstrip("-")),descending))
+    return self
+
+  def limit(self,row_limit):
+    self.row_limit = row_limit
+    return self
+
+  def after(self,model):
+    """
+    continues after model, the last instance of the previous page
+    """
+    self.keyset = dict([(column,getattr(model,column)) for column, descending
+                        in self.full_ordering()])
+    return self
+
+  def full_ordering(self):
+    """
+    returns the ordering with id added last if it is not ordered on already
+    """
+    if "id" in [column for column, descending in self.ordering]:
+      return list(self.ordering)
+    return self.ordering + [("id",False)]
+
+  def keyset_predicate(self,ordering):
+    """
+    returns the condition selecting the rows after self.keyset
+    when every column has the same direction this is one row comparison that
+    an index on the columns can answer, otherwise it is expanded into
+      (a > x) OR (a = x AND b < y) OR ...
+    """
+    directions = set([descending for column, descending in ordering])
+    if len(directions) == 1:
+      columns = [column for column, descending in ordering]
+      return "(%s) %s (%s)" % (", ".join(columns),
+                               "<" if directions.pop() else ">",
+                               ", ".join([self.param(self.keyset[column])
+                                          for column in columns]))
+    clauses = []
+    for i, (column, descending) in enumerate(ordering):
+      terms = ["%s = %s" % (equal,self.param(self.keyset[equal]))
+               for equal, equal_descending in ordering[:i]]
+      terms.append("%s %s %s" % (column,"<" if descending else ">",
+                                 self.param(self.keyset[column])))
+      clauses.append("(" + " AND ".join(terms) + ")")
+    return "(" + " OR ".join(clauses) + ")"
+
+  def all(self):
+    """
+    runs the query and returns a list of model instances, see
+    ModelBase.load_many
+    """
+    cls = self.model_class
+    cls.verify_class_table()
+    query = self.copy()
+    ordering = query.full_ordering()
+    predicates = list(query.predicates)
+    if query.keyset is not None:
+      predicates.append(query.keyset_predicate(ordering))
+    order_by = [column + (" DESC" if descending else "")
+                for column, descending in ordering]
+    rows = ModelBase.db_interface.select_rows(cls.get_class_tablename(),
+                                              cls.get_super_attrs(),predicates,
+                                              query.params,order_by,
+                                              query.row_limit)
+    return cls.load_many(rows)
+
+  def __iter__(self):
+    return iter(self.all())
+
+  def first(self):
+    """
+    returns the first model instance, or None if there are no results
+    """
+    found = self.copy().limit(1).all()
+    if found:
+      return found[0]
+    return None
+
+  def pages(self,page_size):
+    """
+    generator over the results as lists of at most page_size instances,
+    each page is one query continuing after the last, see after
+    """
+    query = self.copy().limit(page_size)
+    while True:
+      page = query.all()
+      if page:
+        yield page
+      if len(page) < page_size:
+        return
+      query = self.copy().limit(page_size).after(page[-1])
+
 
 def error_message(caller,err_num,tup):
   err_dict = {}
@@ -295,6 +1404,16 @@ def error_message(caller,err_num,tup):
   err_dict[7] = ["Value '%s' failed custom validation in '%s'", \
                  "Error message from validator: %s", \
                  "Class: %s"]
+  err_dict[8] = ["Class: %s has specification tuple item %s, which is not supported", \
+                 "Item 4 may be a validator and the last item a dict of COLUMN_OPTIONS"]
+  err_dict[9] = ["Class: %s has table index %s on %s, which is not a column", \
+                 "table_indexes must be tuples of column names"]
+  err_dict[10] = ["Operator '%s' is not supported", \
+                  "Supported operators are the keys in Query.OPERATORS"]
+  err_dict[11] = ["Class: %s has the unique option on columns %s", \
+                  "Only one column can be the natural key of a model"]
+  err_dict[12] = ["Class: %s has column %s referencing %s, which is not a string", \
+                  "The references option must be the name of a model class"]
   final_message = "ERROR in " + caller + "\n"
   for line in err_dict[err_num]:
     final_message += "\t" + line + "\n"
@@ -333,6 +1452,28 @@ if __name__ == "__main__":
   class BadModel4(ModelBase):
     invalid_attr4 = (17,str,"integer")
 
+  class BadModel5(ModelBase):
+    invalid_attr5 = (None,str,"varchar",{"not_an_option":True})
+
+  class BadModel6(ModelBase):
+    table_indexes = [("title","not_a_column")]
+    title = (None,str,"varchar")
+
+  class BadModel7(ModelBase):
+    title = (None,str,"varchar",{"unique":True})
+    path = (None,str,"varchar",{"unique":True})
+
+  class KeyedClass(ModelBase):
+    id = (None,int,"serial PRIMARY KEY")
+    path = (None,str,"varchar",{"unique":True})
+    title = (None,str,"varchar")
+
+  class IndexedClass(ModelBase):
+    table_indexes = [("title","year")]
+    id = (None,int,"serial PRIMARY KEY")
+    title = (None,str,"varchar",{"indexed":True})
+    year = (None,int,"integer",year_validator,{"indexed":True})
+
   m1 = RealClass.create()
   m2 = RealClass.create()
   m1.title = "Back to the Future"
@@ -350,10 +1491,274 @@ if __name__ == "__main__":
   assert (m1._is_dirty)
   assert (m2._is_dirty)
   assert (m1.get_tablename() == "realclass_table")
+  m2._is_dirty = False
+  m2.year = 2000
+  assert (not m2._is_dirty)
+  m2.title = "Blade Runner"
+  assert (m2.get_dirty_columns() == {"title":"Blade Runner","id":None})
+  m2._is_dirty = True
   assert (GoodModel.check_model() == True)
   assert (BadModel1.create() == None)
   assert (BadModel2.create() == None)
   assert (BadModel3.create() == None)
   assert (BadModel4.create() == None)
+  assert (BadModel5.create() == None)
+  assert (BadModel6.create() == None)
+  assert (BadModel7.create() == None)
+  assert (KeyedClass._schema.natural_key == "path")
+  assert (IndexedClass._schema.validators["year"] == year_validator)
+  assert (IndexedClass._schema.indexes == [("title",),("year",),("title","year")])
   m1.save()
   assert (m1.id != None)
+  m3 = RealClass.create()
+  m3.title = "Brazil"
+  m4 = RealClass.create()
+  m4.title = "Alien"
+  m2.title = "Blade Runner"
+  RealClass.bulk_save([m2,m3,m4])
+  assert (m2.id != None and m3.id == m2.id + 1 and m4.id == m3.id + 1)
+  assert (not m2._is_dirty and not m3._is_dirty and not m4._is_dirty)
+  with ModelBase.session():
+    m3.year = 1985
+    m4.year = 1979
+    m5 = RealClass.create()
+    m5.title = "Aliens"
+  assert (m5.id != None)
+  assert (not m3._is_dirty and not m4._is_dirty and not m5._is_dirty)
+  loaded = list(RealClass.iterate(itersize=2))
+  assert (len(loaded) == 5)
+  assert (m3 in loaded)
+  assert (RealClass.get(m3.id) is m3)
+  rows = [("id","title","year"),(100,"Heat",1995),(101,"Ronin",1998)]
+  heat, ronin = RealClass.load_many(rows)
+  assert (heat.title == "Heat" and ronin.year == 1998)
+  assert (not heat._is_dirty)
+  assert (RealClass.load_many(rows)[0] is heat)
+  assert (RealClass.get(100) is heat)
+  assert (RealClass.get(999) == None)
+  #a rolled back transaction puts back the ids and dirty state it saved
+  m6 = RealClass.create()
+  m6.title = "Ran"
+  m3.year = 1986
+  try:
+    with ModelBase.session():
+      RealClass.bulk_save([m6,m3])
+      assert (m6.id != None and not m3._is_dirty)
+      raise ValueError("rolled back")
+  except ValueError:
+    pass
+  assert (m6.id == None and m6._is_dirty and m3._is_dirty)
+  m6.save()
+  m3.save()
+  assert (RealClass.get(m6.id) is m6)
+  assert (ModelBase.db_interface.select_rows("realclass_table",["title","year"],
+            ["id IN (%(ran)s,%(brazil)s)"],{"ran":m6.id,"brazil":m3.id},
+            ["id"])[1:] == [("Brazil",1986),("Ran",None)])
+  #a session only saves the models made dirty inside it
+  stray = RealClass.create()
+  stray.title = "Stray"
+  with ModelBase.session():
+    m6.year = 1985
+  assert (stray.id == None and stray._is_dirty and not m6._is_dirty)
+  #and a dirty model that is no longer used is released, not saved later
+  import weakref
+  stray_ref = weakref.ref(stray)
+  del stray
+  assert (stray_ref() == None)
+  rows = len(RealClass.query().all())
+  with ModelBase.session():
+    pass
+  assert (len(RealClass.query().all()) == rows)
+
+  indexed = []
+  for i in range(10):
+    m = IndexedClass.create()
+    m.title = "Movie %d" % (i % 4)
+    m.year = 1990 + i % 5
+    indexed.append(m)
+  IndexedClass.bulk_save(indexed)
+  ModelBase.db_interface.the_cursor.execute(
+    "SELECT indexname FROM pg_indexes WHERE tablename = 'indexedclass_table';")
+  assert ("indexedclass_table_title_year_idx" in
+          [row[0] for row in ModelBase.db_interface.the_cursor.fetchall()])
+  found = IndexedClass.query().where("year","between",(1991,1992))\
+            .order_by("-year","title").all()
+  assert (found == sorted([m for m in indexed if 1991 <= m.year <= 1992],
+                          key=lambda m: (-m.year,m.title,m.id)))
+  assert (IndexedClass.query().filter_by(title="Movie 1",year=1991).all() ==
+          [indexed[1]])
+  assert (len(IndexedClass.query().where("title","in",["Movie 1","Movie 2"])
+              .all()) == 5)
+  assert (IndexedClass.query().where("title","=",None).all() == [])
+  assert (IndexedClass.query().order_by("year").first() is indexed[0])
+  for ordering in [("year","title"),("-year","title")]:
+    expected = IndexedClass.query().order_by(*ordering).all()
+    pages = list(IndexedClass.query().order_by(*ordering).pages(3))
+    assert ([len(page) for page in pages] == [3,3,3,1])
+    assert (sum(pages,[]) == expected)
+  #an older version of a table gets the new columns and indexes
+  ModelBase.db_interface.create_table("evolvedclass_table",
+                                      {"id":"serial PRIMARY KEY",
+                                       "title":"varchar"})
+  class EvolvedClass(ModelBase):
+    id = (None,int,"serial PRIMARY KEY")
+    title = (None,str,"varchar",{"indexed":True})
+    path = (None,str,"varchar",{"unique":True})
+  e1 = EvolvedClass.create()
+  e1.title = "Heat"
+  e1.path = "/movies/heat.mp4"
+  e1.save()
+  catalog = ModelBase.db_interface.get_catalog(["evolvedclass_table"])
+  columns, index_names = catalog["evolvedclass_table"]
+  assert (columns == set(["id","title","path"]))
+  assert ("evolvedclass_table_title_idx" in index_names and
+          "evolvedclass_table_path_key" in index_names)
+  assert ("evolvedclass_table" not in ModelBase.catalog)
+  #rows saved before a column became unique are merged into the first of them
+  #before its unique index is added, and references to the others follow
+  ModelBase.db_interface.create_table("legacyclass_table",
+                                      {"id":"serial PRIMARY KEY",
+                                       "path":"varchar"})
+  for path in ["/movies/heat.mp4","/movies/heat.mp4","/movies/up.mp4"]:
+    ModelBase.db_interface.insert_row("legacyclass_table",{"path":path})
+  ModelBase.db_interface.create_table("legacyentry_table",
+                                      {"id":"serial PRIMARY KEY",
+                                       "legacy_id":"integer"})
+  for legacy_id in [1,2,3]:
+    ModelBase.db_interface.insert_row("legacyentry_table",
+                                      {"legacy_id":legacy_id})
+  class LegacyClass(ModelBase):
+    id = (None,int,"serial PRIMARY KEY")
+    path = (None,str,"varchar",{"unique":True})
+  class LegacyEntry(ModelBase):
+    id = (None,int,"serial PRIMARY KEY")
+    legacy_id = (None,int,"integer",{"references":"LegacyClass"})
+  class BadReference(ModelBase):
+    legacy_id = (None,int,"integer",{"references":LegacyClass})
+  assert (BadReference._schema.check_result != True)
+  assert (ModelBase.db_interface.find_duplicates("legacyclass_table",["path"]) ==
+          (1,[(("/movies/heat.mp4",),2)]))
+  l1 = LegacyClass.create()
+  l1.path = "/movies/up.mp4"
+  l1.save()
+  assert (l1.id == 3)
+  assert (sorted([l.id for l in LegacyClass.iterate()]) == [1,3])
+  assert (sorted([e.legacy_id for e in LegacyEntry.iterate()]) == [1,1,3])
+  index_names = ModelBase.db_interface.get_catalog(["legacyclass_table"]) \
+                  ["legacyclass_table"][1]
+  assert ("legacyclass_table_path_key" in index_names)
+
+  k1 = KeyedClass.create()
+  k1.path = "/movies/heat.mp4"
+  k1.title = "Heat"
+  k1.save()
+  k2 = KeyedClass.create()
+  k2.path = "/movies/heat.mp4"
+  k2.save()
+  assert (k2.id == k1.id)
+  #the row is still only materialized once, and both instances show it
+  assert (KeyedClass.get(k1.id) is k1)
+  assert (k2.title == "Heat")
+  #a column the new model does not set keeps its saved value
+  assert (KeyedClass.query().filter_by(id=k1.id).all()[0].title == "Heat")
+  #with no instance of the row left, the new model gets its saved columns
+  k3 = KeyedClass.create()
+  k3.path = "/movies/ronin.avi"
+  k3.title = "Ronin"
+  k3.save()
+  ronin_id = k3.id
+  k3_ref = weakref.ref(k3)
+  del k3
+  assert (k3_ref() == None)
+  k4 = KeyedClass.create()
+  k4.path = "/movies/ronin.avi"
+  k4.save()
+  assert (k4.id == ronin_id and k4.title == "Ronin")
+  assert (KeyedClass.get(ronin_id) is k4)
+  k4_ref = weakref.ref(k4)
+  del k4
+  assert (k4_ref() == None)
+  k5 = KeyedClass.create()
+  k5.path = "/movies/ronin.avi"
+  KeyedClass.bulk_save([k5])
+  assert (k5.id == ronin_id and k5.title == "Ronin")
+  assert (KeyedClass.get(ronin_id) is k5)
+  batch = []
+  for path, title in [("/movies/heat.mp4","Heat (1995)"),("/movies/up.mp4","Up"),
+                      ("/movies/up.mp4","Up!"),(None,"No path")]:
+    k = KeyedClass.create()
+    if path:
+      k.path = path
+    k.title = title
+    batch.append(k)
+  KeyedClass.bulk_save(batch)
+  assert (batch[0].id == k1.id and batch[1].id == batch[2].id)
+  assert (len(set([k.id for k in batch])) == 3)
+  KeyedClass.bulk_save([KeyedClass.create() for i in range(2)])
+  assert (len(KeyedClass.query().where("path","!=",None).all()) == 3)
+  assert (KeyedClass.get(batch[1].id).title == "Up!")
+  assert (KeyedClass.get(k1.id) is k1 and k1.title == "Heat (1995)")
+  for bad_query in [lambda: IndexedClass.query().where("bogus","=",1),
+                    lambda: IndexedClass.query().where("year","~",1)]:
+    try:
+      bad_query()
+      assert False
+    except ValueError:
+      pass
+
+  class CompactClass(ModelBase):
+    compact = True
+    id = (None,int,"serial PRIMARY KEY")
+    title = (None,str,"varchar")
+    year = (None,int,"integer",year_validator)
+
+  c1 = CompactClass.create()
+  assert (isinstance(c1,CompactModelBase))
+  assert (c1.child_class == CompactClass)
+  assert (c1._is_dirty)
+  c1.year = 1850
+  c1.year = "1999"
+  c1.title = "The Matrix"
+  assert (c1.year == 1999 and c1.title == "The Matrix" and c1.id == None)
+  assert (c1.get_tablename() == "compactclass_table")
+  c1.save()
+  assert (c1.id != None and not c1._is_dirty)
+  c1.title = "The Matrix Reloaded"
+  assert (c1._is_dirty)
+  assert (c1.get_dirty_columns() == {"title":"The Matrix Reloaded","id":c1.id})
+  c1.save()
+  c1.title = "The Matrix Reloaded"
+  assert (not c1._is_dirty)
+  CompactClass.load_many([("id","title","year"),(c1.id,"The Matrix",1999)])
+  assert (c1.title == "The Matrix")
+  assert (CompactClass.get(c1.id) is c1)
+
+  import gc
+  #the columns live in the slots, no __dict__ is ever made for them
+  assert (dict not in [type(ref) for ref in gc.get_referents(c1)])
+  CompactClass.add_index("title")
+  assert (CompactClass.find_models("title","The Matrix") == [c1])
+  c1.title = "The Matrix Revolutions"
+  assert (CompactClass.find_models("title","The Matrix") == [])
+  assert (CompactClass.find_models("title","The Matrix Revolutions") == [c1])
+  assert (RealClass.find_models("title","Brazil") == [m3])
+  CompactClass.add_sorted_index("year","title")
+  c2 = CompactClass.create()
+  c2.year = 1985
+  c2.title = "Brazil"
+  assert (CompactClass.find_models_in_range("year",1980,1999)[-2:] == [c2,c1])
+  c2.year = 2005
+  assert (c2 not in CompactClass.find_models_in_range("year",1980,1999))
+  assert (CompactClass.find_models_in_range("year",2000)[-1] is c2)
+  assert (CompactClass.find_models_in_range("title","Brazil","Brazil") == [c2])
+  c2._is_dirty = False
+  del c2
+  gc.collect()
+  assert (CompactClass.find_models_in_range("year",2000) == [])
+  temp = RealClass.create()
+  temp._is_dirty = False
+  temp_count = len(RealClass.get_all_models())
+  del temp
+  gc.collect()
+  assert (len(RealClass.get_all_models()) == temp_count - 1)
+  assert (m1 in RealClass.iter_models())
@@ -15,11 +15,53 @@ def year_validator(year):
 class RawMediaFile(ModelBase):
   """
   Class methods and variables to track all media objects
+  imdb_id is the IMDb tconst of the title, see ImdbIndex.link_media
+  filename is the natural key, saving a file that is already in the table
+    updates its row
   """
+  table_indexes = [("title","release_year")]
   id = (None,int,"serial PRIMARY KEY")
   title = (None,str,"varchar")
   release_year = (None,int,"integer",year_validator)
-  filename = (None,str,"varchar")
+  filename = (None,str,"varchar",{"unique":True})
+  imdb_id = (None,str,"varchar")
+
+class FileManifest(ModelBase):
+  """
+  The size, modification time and inode of every media file seen by the last
+  scan, so that rescans only have to process files that were added, changed
+  or removed since
+  media_id is the id of the RawMediaFile parsed from the file
+  fingerprint is the sampled content hash from Fingerprint.fingerprint_file,
+    empty until Fingerprint.fingerprint_manifest has read the file
+  """
+  compact = True
+  id = (None,int,"serial PRIMARY KEY")
+  path = (None,str,"varchar")
+  size = (None,long,"bigint")
+  mtime = (None,float,"double precision")
+  inode = (None,long,"bigint")
+  media_id = (None,int,"integer",{"references":"RawMediaFile"})
+  fingerprint = (None,str,"varchar")
+
+class MediaInfo(ModelBase):
+  """
+  Container metadata of a media file read by MediaProbe.probe_file
+  manifest_id is the id of the FileManifest entry of the file, size and mtime
+    are the entry's when the file was probed so changed files are probed again
+  duration is in seconds, codecs are short names such as h264 or aac
+  """
+  compact = True
+  id = (None,int,"serial PRIMARY KEY")
+  manifest_id = (None,int,"integer",{"references":"FileManifest"})
+  size = (None,long,"bigint")
+  mtime = (None,float,"double precision")
+  container = (None,str,"varchar")
+  duration = (None,float,"double precision")
+  width = (None,int,"integer")
+  height = (None,int,"integer")
+  video_codec = (None,str,"varchar")
+  audio_codec = (None,str,"varchar")
 
 if __name__ == "__main__":
   m = RawMediaFile.create()
@@ -30,4 +72,6 @@ if __name__ == "__main__":
   m.release_year = 1850
   assert (m.release_year == None)
   m.release_year = "2000"
-  assert (m.release_year == 2000)
\ No newline at end of file
+  assert (m.release_year == 2000)
+  assert (RawMediaFile._schema.indexes == [("title","release_year")])
+  assert (RawMediaFile._schema.natural_key == "filename")
@@ -0,0 +1,264 @@
+import threading
+from multiprocessing.pool import Pool
+from Queue import Queue, Full, Empty
+
+import config
+import getTitles
+from MovieModels import RawMediaFile
+
+#put on a queue after the last item of a stage
+END_OF_STAGE = object()
+
+class PipelineStage(threading.Thread):
+  """
+  One stage of a pipeline, running in its own thread
+
+  Takes items from in_queue, or from the iterable source for the first stage,
+    runs them through func and puts the results on out_queue
+  func returns the result for one item, if it is None items are passed on as
+    they are
+  END_OF_STAGE is passed on once the input runs out
+  If func raises, the error is kept in self.error and the stop event is set
+    so that the other stages give up instead of waiting on full queues
+  """
+  def __init__(self,func,out_queue,stop,in_queue=None,source=None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.func = func
+    self.in_queue = in_queue
+    self.out_queue = out_queue
+    self.source = source
+    self.stop = stop
+    self.error = None
+
+  def run(self):
+    try:
+      for item in self.items():
+        if self.func is not None:
+          item = self.func(item)
+        if not put_item(self.out_queue,item,self.stop):
+          return
+    except Exception as e:
+      self.error = e
+      self.stop.set()
+    put_item(self.out_queue,END_OF_STAGE,self.stop)
+
+  def items(self):
+    if self.source is not None:
+      for item in self.source:
+        yield item
+      return
+    while True:
+      item = get_item(self.in_queue,self.stop)
+      if item is END_OF_STAGE or self.stop.is_set():
+        return
+      yield item
+
+'''
+SUMMARY
+-------
+Put an item on a bounded queue, waiting while it is full unless the pipeline
+is stopped
+-------
+INPUT: queue, item, stop event
+OUTPUT: True if the item was put on the queue, False if the pipeline stopped
+'''
+def put_item(queue,item,stop):
+  while not stop.is_set():
+    try:
+      queue.put(item,timeout=0.1)
+      return True
+    except Full:
+      continue
+  return False
+
+'''
+SUMMARY
+-------
+Take an item from a queue, waiting while it is empty unless the pipeline is
+stopped
+-------
+INPUT: queue, stop event
+OUTPUT: the item, or END_OF_STAGE if the pipeline stopped
+'''
+def get_item(queue,stop):
+  while not stop.is_set():
+    try:
+      return queue.get(timeout=0.1)
+    except Empty:
+      continue
+  return END_OF_STAGE
+
+'''
+SUMMARY
+-------
+Parse one raw title, keeping the raw title alongside the result
+-------
+INPUT: raw title
+OUTPUT: 2-tuple (raw title, (title,year,file extension))
+'''
+def parse_raw_title(raw_title):
+  return (raw_title,getTitles.parse_title(raw_title))
+
+'''
+SUMMARY
+-------
+Build an unsaved RawMediaFile from a raw title and its parsed 3-tuple
+-------
+INPUT: 2-tuple (raw title, (title,year,file extension))
+OUTPUT: RawMediaFile
+'''
+def build_media(item):
+  raw_title, parsed = item
+  media = RawMediaFile.create()
+  media.title = parsed[0]
+  if parsed[1]:
+    media.release_year = parsed[1]
+  media.filename = raw_title
+  return media
+
+'''
+SUMMARY
+-------
+Stream raw titles into RawMediaFile rows
+The stages are
+  source -> parse -> model construction -> batched database writes
+and each runs in its own thread with a bounded queue in between, so memory
+stays flat however long the listing is and parsing overlaps with the writes
+-------
+INPUT: iterable of raw titles, such as getTitles.iter_titles_from_file()
+       optional rows per bulk insert, defaults to config.INGEST_BATCH_SIZE
+       optional queue size between stages, defaults to config.INGEST_QUEUE_SIZE
+       optional number of processes for the parse stage, see 
+         getTitles.iter_parse_titles
+OUTPUT: the number of RawMediaFile rows saved
+'''
+def ingest_titles(raw_titles,batch_size=None,queue_size=None,jobs=1):
+  pool = None
+  if jobs > 1:
+    #start the processes before any of the threads
+    pool = Pool(jobs)
+    parsed_titles = getTitles.iter_parse_titles(raw_titles,jobs,pool=pool)
+  else:
+    parsed_titles = (parse_raw_title(raw_title) for raw_title in raw_titles)
+  return ingest_parsed_titles(parsed_titles,batch_size,queue_size,pool)
+
+'''
+SUMMARY
+-------
+Stream a title listing file into RawMediaFile rows, see ingest_titles
+The file is memory-mapped, with jobs > 1 each parse process maps it and
+parses its own byte ranges, see getTitles.iter_parse_title_file
+-------
+INPUT: path to titles file
+       optional rows per bulk insert, defaults to config.INGEST_BATCH_SIZE
+       optional queue size between stages, defaults to config.INGEST_QUEUE_SIZE
+       optional number of processes for the parse stage
+OUTPUT: the number of RawMediaFile rows saved
+'''
+def ingest_file(titles_file,batch_size=None,queue_size=None,jobs=1):
+  pool = None
+  if jobs > 1:
+    pool = Pool(jobs)
+    parsed_titles = getTitles.iter_parse_title_file(titles_file,jobs,pool=pool)
+  else:
+    parsed_titles = (parse_raw_title(raw_title) for raw_title in
+                     getTitles.iter_titles_mmap(titles_file))
+  return ingest_parsed_titles(parsed_titles,batch_size,queue_size,pool)
+
+'''
+SUMMARY
+-------
+Run the pipeline behind ingest_titles and ingest_file
+The first stage pulls (raw title, parsed 3-tuple) pairs from parsed_titles
+-------
+INPUT: iterable of 2-tuples (raw title, (title,year,file extension))
+       optional rows per bulk insert, defaults to config.INGEST_BATCH_SIZE
+       optional queue size between stages, defaults to config.INGEST_QUEUE_SIZE
+       optional multiprocessing Pool used by parsed_titles, terminated at the end
+OUTPUT: the number of RawMediaFile rows saved
+'''
+def ingest_parsed_titles(parsed_titles,batch_size=None,queue_size=None,
+                         pool=None):
+  if not batch_size:
+    batch_size = config.INGEST_BATCH_SIZE
+  if not queue_size:
+    queue_size = config.INGEST_QUEUE_SIZE
+  stop = threading.Event()
+  parsed_queue = Queue(queue_size)
+  media_queue = Queue(queue_size)
+  stages = [PipelineStage(None,parsed_queue,stop,source=parsed_titles),
+            PipelineStage(build_media,media_queue,stop,in_queue=parsed_queue)]
+  for stage in stages:
+    stage.start()
+  saved = 0
+  batch = []
+  try:
+    while True:
+      media = get_item(media_queue,stop)
+      if media is END_OF_STAGE:
+        break
+      batch.append(media)
+      if len(batch) >= batch_size:
+        RawMediaFile.bulk_save(batch)
+        saved += len(batch)
+        batch = []
+    if batch and not stop.is_set():
+      RawMediaFile.bulk_save(batch)
+      saved += len(batch)
+  finally:
+    stop.set()
+    for stage in stages:
+      stage.join()
+    if pool:
+      pool.terminate()
+  for stage in stages:
+    if stage.error:
+      raise stage.error
+  return saved
+
+if __name__ == "__main__":
+  from itertools import islice
+  from ModelBase import ModelBase
+  from MovieModels import FileManifest
+  #a table filled before filename was unique, holding two rows per file, is
+  #merged down to one row per file the first time it is written to
+  db_interface = ModelBase.db_interface
+  if not db_interface.get_catalog(["rawmediafile_table"])["rawmediafile_table"]:
+    db_interface.create_table("rawmediafile_table",
+                              RawMediaFile._schema.sql_types.copy())
+  db_interface.connect()
+  db_interface.the_cursor.execute("DROP INDEX IF EXISTS "
+                                  "rawmediafile_table_filename_key;")
+  db_interface.commit()
+  seeded = list(islice(getTitles.iter_titles_mmap("AllMovies.txt"),50))
+  for raw_title in seeded:
+    kept_id = db_interface.insert_row("rawmediafile_table",{"filename":raw_title})
+    dropped_id = db_interface.insert_row("rawmediafile_table",
+                                         {"filename":raw_title})
+  manifest = FileManifest.create()
+  manifest.path = "/movies/" + seeded[-1]
+  manifest.media_id = dropped_id
+  manifest.save()
+  assert (db_interface.find_duplicates("rawmediafile_table",["filename"])[0] == 50)
+  raw_titles = ["Heat (1995).mp4","Ronin (1998).avi","Alien (1979)"] * 5
+  assert (ingest_titles(iter(raw_titles),batch_size=4,queue_size=2) == 15)
+  assert (ingest_titles(iter(raw_titles),batch_size=4,jobs=2) == 15)
+  assert (ingest_file("AllMovies.txt") == 401)
+  assert (ingest_file("AllMovies.txt",jobs=2) == 401)
+  #re-ingesting updates the rows saved the first time
+  rows = len(RawMediaFile.query().all())
+  assert (ingest_file("AllMovies.txt") == 401)
+  assert (len(RawMediaFile.query().all()) == rows)
+  assert (db_interface.find_duplicates("rawmediafile_table",["filename"])[0] == 0)
+  assert (db_interface.select_rows("filemanifest_table",["media_id"],
+                                   ["id = %(id)s"],{"id":manifest.id})[1:] ==
+          [(kept_id,)])
+  def broken_source():
+    yield "Heat (1995).mp4"
+    raise IOError("listing went away")
+  try:
+    ingest_titles(broken_source())
+    assert False
+  except IOError:
+    pass
@@ -0,0 +1,139 @@
+import os
+
+import config
+import getTitles
+from ModelBase import ModelBase
+from MovieModels import FileManifest, RawMediaFile
+
+'''
+SUMMARY
+-------
+Scan a directory tree and bring RawMediaFile up to date using FileManifest
+Only files that were added, changed or removed since the last scan are
+processed, unchanged files cost nothing beyond the scan itself
+  added - parsed into a new RawMediaFile and recorded in the manifest
+  changed - (size, mtime or inode differ) the manifest entry is updated and
+            its fingerprint cleared
+  removed - the manifest entry and its RawMediaFile are deleted, only files
+            under the scanned directory are considered, and files under a
+            directory that could not be listed are kept
+Everything is written in one transaction
+-------
+INPUT: optional path to directory, defaults to config.MOVIE_TITLES_FILE
+       optional number of scanner threads
+OUTPUT: 3-tuple of lists of paths (added, changed, removed)
+'''
+def rescan(dir_path="",workers=8):
+  if not dir_path:
+    dir_path = config.MOVIE_TITLES_FILE
+  #the manifest holds absolute paths, however the directory was given
+  dir_path = os.path.abspath(dir_path)
+  #only files under dir_path can have been removed from it
+  prefix = os.path.join(dir_path,"")
+  known = {}
+  for entry in FileManifest.iterate():
+    if entry.path.startswith(prefix):
+      known[entry.path] = entry
+  added = []
+  changed = []
+  new_entries = []
+  new_media = []
+  failed = []
+  with ModelBase.session():
+    for scanned in getTitles.scan_media_files(dir_path,workers,failed=failed):
+      entry = known.pop(scanned.path,None)
+      if entry is None:
+        added.append(scanned.path)
+        entry = FileManifest.create()
+        new_entries.append(entry)
+        new_media.append(media_from_path(scanned.path))
+      elif (entry.size,entry.mtime,entry.inode) == \
+           (scanned.size,scanned.mtime,scanned.inode):
+        continue
+      else:
+        changed.append(scanned.path)
+        entry.fingerprint = ""
+      entry.path = scanned.path
+      entry.size = scanned.size
+      entry.mtime = scanned.mtime
+      entry.inode = scanned.inode
+    #the new media files need their ids before the manifest can point to them
+    RawMediaFile.bulk_save(new_media)
+    for entry, media in zip(new_entries,new_media):
+      entry.media_id = media.id
+    #files that were not seen because their directory could not be listed
+    #have not been removed
+    failed_prefixes = tuple([os.path.join(path,"") for path in failed])
+    for path in [path for path in known if path.startswith(failed_prefixes)]:
+      del known[path]
+    if failed:
+      print("WARNING:%d directories could not be scanned, files under them "
+            "were kept: %s" % (len(failed),", ".join(sorted(failed))))
+    removed = sorted(known.keys())
+    RawMediaFile.delete_ids([entry.media_id for entry in known.values()
+                             if entry.media_id])
+    FileManifest.delete_ids([entry.id for entry in known.values()])
+  return (added,changed,removed)
+
+'''
+SUMMARY
+-------
+Build a RawMediaFile from the path of a media file
+-------
+INPUT: path to the file
+OUTPUT: unsaved RawMediaFile
+'''
+def media_from_path(path):
+  title, year, ext = getTitles.parse_title(os.path.basename(path))
+  media = RawMediaFile.create()
+  media.title = title
+  if year:
+    media.release_year = year
+  media.filename = path
+  return media
+
+if __name__ == "__main__":
+  import shutil, tempfile
+  scan_root = tempfile.mkdtemp()
+  for name in ["Heat (1995).mp4","Ronin (1998).avi"]:
+    open(os.path.join(scan_root,name),"w").close()
+  added, changed, removed = rescan(scan_root)
+  assert (len(added) == 2 and not changed and not removed)
+  assert (rescan(scan_root) == ([],[],[]))
+  with open(os.path.join(scan_root,"Heat (1995).mp4"),"w") as f:
+    f.write("longer now")
+  os.remove(os.path.join(scan_root,"Ronin (1998).avi"))
+  open(os.path.join(scan_root,"Alien (1979).m4v"),"w").close()
+  added, changed, removed = rescan(scan_root)
+  assert (added == [os.path.join(scan_root,"Alien (1979).m4v")])
+  assert (changed == [os.path.join(scan_root,"Heat (1995).mp4")])
+  assert (removed == [os.path.join(scan_root,"Ronin (1998).avi")])
+  #the same directory given as a relative path is the same files
+  os.chdir(os.path.dirname(scan_root))
+  assert (rescan(os.path.basename(scan_root)) == ([],[],[]))
+  #files under a directory that cannot be listed are not removed
+  os.makedirs(os.path.join(scan_root,"locked"))
+  open(os.path.join(scan_root,"locked","Ran (1985).mp4"),"w").close()
+  added, changed, removed = rescan(scan_root)
+  assert (added == [os.path.join(scan_root,"locked","Ran (1985).mp4")])
+  scandir = getTitles.scandir
+  listdir = getTitles.listdir
+  def failing(lister):
+    def list_dir(path):
+      if path.endswith("locked"):
+        raise OSError(13,"Permission denied",path)
+      return lister(path)
+    return list_dir
+  getTitles.scandir = scandir and failing(scandir)
+  getTitles.listdir = failing(listdir)
+  try:
+    assert (rescan(scan_root) == ([],[],[]))
+  finally:
+    getTitles.scandir = scandir
+    getTitles.listdir = listdir
+  #as are files under a directory that has gone, such as an unmounted share
+  moved_root = scan_root + "_moved"
+  os.rename(scan_root,moved_root)
+  assert (rescan(scan_root) == ([],[],[]))
+  os.rename(moved_root,scan_root)
+  shutil.rmtree(scan_root)
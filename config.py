@@ -3,16 +3,43 @@ import datetime
 MOVIE_TITLES_FILE = "./Movies/"
 MOVIE_FILE_EXTENSIONS = ['avi','mov','wmv','mp4','m4p','m4v','mpg','mpeg', \
                          'mpe','mpv']
+#rows per database write and items waiting between stages in Pipeline.py
+INGEST_BATCH_SIZE = 1000
+INGEST_QUEUE_SIZE = 10000
+#offline IMDb title.basics dump and the lookup index built from it by
+#ImdbIndex.py, only the listed title types are indexed
+IMDB_BASICS_FILE = "./title.basics.tsv.gz"
+IMDB_INDEX_FILE = "./imdb_titles.idx"
+IMDB_TITLE_TYPES = ['movie','tvMovie','video','short','tvSeries',
+                    'tvMiniSeries','tvSpecial']
+#records sorted in memory at a time while building the index
+IMDB_SORT_RUN_SIZE = 1000000
+#metadata requests made by Fetcher.py: requests in flight at once, requests
+#per second with bursts of up to FETCH_BURST, and where responses are cached
+#cached responses younger than FETCH_MAX_AGE seconds are used without asking
+#the server, older ones are revalidated with their ETag/Last-Modified
+FETCH_CONCURRENCY = 8
+FETCH_RATE = 10.0
+FETCH_BURST = 10
+FETCH_CACHE_DIR = "./fetch_cache/"
+FETCH_MAX_AGE = 7 * 24 * 60 * 60
+FETCH_TIMEOUT = 30
 DB_SETTINGS = {
   "hostname": "localhost",
   "db_name": "movies",
   "username": "ubuntu",
-  "password": "foobar"
+  "password": "foobar",
+  #set pooled to True to give every thread its own connection from a pool
+  "pooled": False,
+  "min_connections": 1,
+  "max_connections": 10,
+  #rows fetched per round trip when streaming query results
+  "itersize": 2000
 }
 TYPE_MAPPING = {
   type(None):'NULL',
   bool:'bool',
-  float:['real','double'],
+  float:['real','double','double precision'],
   int:['smallint','integer','bigint'],
   long:['smallint','integer','bigint'],
   str:['varchar','text'],
@@ -1,5 +1,54 @@
 import config
+import mmap
+import os
+import re
+import time
+from collections import deque, namedtuple
+from itertools import islice
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool, ThreadPool
 from os import listdir
+try:
+  from os import scandir
+except ImportError:
+  #Python 2 needs the scandir package, without it os.lstat is used instead
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+#a media file found by scan_media_files
+ScannedFile = namedtuple("ScannedFile",["path","size","mtime","inode"])
+
+#a raw title parsed by parse_media_name
+ParsedTitle = namedtuple("ParsedTitle",["title","year","ext","season","episode",
+                                        "tags"])
+
+#quality and source tags recognized by parse_media_name, lowercase
+TITLE_TAGS = frozenset(["2160p","1080p","720p","576p","480p","4k","uhd","hdr",
+                        "bluray","blu-ray","brrip","bdrip","web-dl","webdl",
+                        "webrip","hdtv","hdrip","dvdrip","dvdscr","remux",
+                        "x264","x265","h264","h.264","h265","h.265","hevc",
+                        "xvid","divx","aac","ac3","dts"])
+
+#the file extensions recognized by parse_media_name, lowercase
+TITLE_EXTENSIONS = frozenset([ext.lower() for ext in
+                              config.MOVIE_FILE_EXTENSIONS])
+
+#the years parse_media_name accepts, keyed by their string, a dict lookup is
+#much faster than checking the digits and calling int
+TITLE_YEARS = dict([(str(year),year) for year in range(1870,2100)])
+
+#a TV episode marker word, "S01E02", or the season half of "S01 E02"
+EPISODE_WORD = re.compile(r"[Ss](\d{1,2})(?:[Ee](\d{1,3}))?$")
+EPISODE_HALF = re.compile(r"[Ee](\d{1,3})$")
+
+#builds a ParsedTitle from a tuple, faster than calling ParsedTitle
+new_tuple = tuple.__new__
+
+#results of parse_media_name, cleared when it reaches PARSE_CACHE_SIZE
+PARSE_CACHE = {}
+PARSE_CACHE_SIZE = 100000
 
 '''
 SUMMARY
@@ -23,6 +72,106 @@ def get_titles_from_file(titles_file=""):
   f.close()
   return raw_titles
 
+'''
+SUMMARY
+-------
+Read file names from a plain text file with one file name per line, one at a
+time, so the whole file is never held in memory
+-------
+INPUT: optional path to titles file, defaults to config.MOVIE_TITLES_FILE
+OUTPUT: generator of strings stripped of white space
+'''
+def iter_titles_from_file(titles_file=""):
+  if not titles_file:
+    titles_file = config.MOVIE_TITLES_FILE
+  try:
+    f = open(titles_file,'r')
+  except IOError:
+    print("No such file as %s" % titles_file)
+    return
+  try:
+    for line in f:
+      yield line.strip()
+  finally:
+    f.close()
+
+'''
+SUMMARY
+-------
+Read file names from a plain text file with one file name per line by
+memory-mapping it and finding the line boundaries in the mapped buffer
+Titles start flowing immediately and the file is never read into memory as
+a whole, which matters for multi-gigabyte listings
+-------
+INPUT: optional path to titles file, defaults to config.MOVIE_TITLES_FILE
+       optional byte offsets to read only the lines in [start,end), start must
+         be the beginning of a line, see iter_title_ranges
+OUTPUT: generator of strings stripped of white space
+'''
+def iter_titles_mmap(titles_file="",start=0,end=None):
+  if not titles_file:
+    titles_file = config.MOVIE_TITLES_FILE
+  try:
+    f = open(titles_file,'rb')
+  except IOError:
+    print("No such file as %s" % titles_file)
+    return
+  try:
+    size = os.fstat(f.fileno()).st_size
+    #empty files cannot be mapped
+    if size == 0:
+      return
+    mapped = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    try:
+      if end is None or end > size:
+        end = size
+      pos = start
+      while pos < end:
+        newline = mapped.find(b"\n",pos,end)
+        if newline == -1:
+          newline = end
+        yield mapped[pos:newline].strip()
+        pos = newline + 1
+    finally:
+      mapped.close()
+  finally:
+    f.close()
+
+'''
+SUMMARY
+-------
+Split a titles file into byte ranges of about chunk_bytes each, ending on
+line boundaries, for parsing in parallel
+-------
+INPUT: path to titles file
+       optional approximate number of bytes per range
+OUTPUT: generator of 2-tuples (start offset, end offset)
+'''
+def iter_title_ranges(titles_file,chunk_bytes=1<<20):
+  try:
+    f = open(titles_file,'rb')
+  except IOError:
+    print("No such file as %s" % titles_file)
+    return
+  try:
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+      return
+    mapped = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    try:
+      start = 0
+      while start < size:
+        end = min(start + chunk_bytes,size)
+        if end < size:
+          newline = mapped.find(b"\n",end)
+          end = size if newline == -1 else newline + 1
+        yield (start,end)
+        start = end
+    finally:
+      mapped.close()
+  finally:
+    f.close()
+
 '''
 SUMMARY
 -------
@@ -42,25 +191,387 @@ def get_titles_from_dir(dir_path=""):
     return None
   return [d.strip() for d in dirs]
 
+'''
+SUMMARY
+-------
+Recursively walk a directory tree and yield every media file in it
+Directories are listed in parallel by a pool of threads, so a deep tree on
+network mounts is bounded by parallel I/O rather than one thread's syscalls
+Files are filtered by extension while walking, symlinks are not followed
+Directories that cannot be listed are skipped with a warning and appended to
+failed, so callers can tell a missing file from one that was not seen
+-------
+INPUT: optional path to directory, defaults to config.MOVIE_TITLES_FILE
+       optional number of threads
+       optional list of file extensions, defaults to config.MOVIE_FILE_EXTENSIONS
+       optional list that the paths of unreadable directories are appended to
+OUTPUT: generator of ScannedFile (path,size,mtime,inode), in no particular order
+'''
+def scan_media_files(dir_path="",workers=8,extensions=None,failed=None):
+  if not dir_path:
+    dir_path = config.MOVIE_TITLES_FILE
+  if failed is None:
+    failed = []
+  if not os.path.isdir(dir_path):
+    print("No such directory as %s" % dir_path)
+    failed.append(dir_path)
+    return
+  if extensions is None:
+    extensions = config.MOVIE_FILE_EXTENSIONS
+  extensions = frozenset([ext.lower() for ext in extensions])
+  pool = ThreadPool(workers)
+  pending = deque([pool.apply_async(scan_directory,(dir_path,extensions))])
+  try:
+    while pending:
+      files, subdirs, error = pending.popleft().get()
+      if error:
+        failed.append(error)
+      for subdir in subdirs:
+        pending.append(pool.apply_async(scan_directory,(subdir,extensions)))
+      for scanned_file in files:
+        yield scanned_file
+  finally:
+    pool.terminate()
+
+'''
+SUMMARY
+-------
+List one directory for scan_media_files
+-------
+INPUT: path to directory
+       frozenset of lowercase file extensions to keep
+OUTPUT: 3-tuple (list of ScannedFile for the media files, list of subdirectory
+        paths, dir_path if it could not be listed or None), the lists hold
+        what was found before any error
+'''
+def scan_directory(dir_path,extensions):
+  files = []
+  subdirs = []
+  error = None
+  try:
+    if scandir:
+      for entry in scandir(dir_path):
+        if entry.is_dir(follow_symlinks=False):
+          subdirs.append(entry.path)
+        elif entry.is_file(follow_symlinks=False) and \
+             has_extension(entry.name,extensions):
+          stat = entry.stat(follow_symlinks=False)
+          files.append(ScannedFile(entry.path,stat.st_size,stat.st_mtime,
+                                   stat.st_ino))
+    else:
+      for name in listdir(dir_path):
+        path = os.path.join(dir_path,name)
+        stat = os.lstat(path)
+        if os.path.stat.S_ISDIR(stat.st_mode):
+          subdirs.append(path)
+        elif os.path.stat.S_ISREG(stat.st_mode) and \
+             has_extension(name,extensions):
+          files.append(ScannedFile(path,stat.st_size,stat.st_mtime,stat.st_ino))
+  except OSError as e:
+    print("WARNING:Unable to scan %s: %s" % (dir_path,e))
+    error = dir_path
+  return (files,subdirs,error)
+
+def has_extension(name,extensions):
+  last_period_ind = name.rfind('.')
+  if last_period_ind == -1:
+    return False
+  return name[last_period_ind+1:].lower() in extensions
+
 '''
 SUMMARY
 -------
 Take in a list of raw titles and return 3-tuples with the title, year, and 
 file extension
+Prints one warning with the number of titles that have no year
 -------
 INPUT: list of raw title strings
+       optional number of processes, more than 1 parses in parallel with
+         iter_parse_titles
 OUTPUT: list of 3-tuples (title,year,file extension)
 '''
-def parse_titles(title_list):
-  parsed_titles = []
-  for raw_title in title_list:
-    raw_title, ext = parse_extension(raw_title)
-    raw_title, year = parse_year(raw_title)
-    raw_title = raw_title.strip()
-    parsed_titles.append((raw_title,year,ext))
-    if not year:
-      print("WARNING:File %s does not appear to have a year" % raw_title)
+def parse_titles(title_list,jobs=1):
+  if jobs > 1:
+    parsed_titles = [parsed for (raw_title,parsed) in 
+                     iter_parse_titles(title_list,jobs)]
+  else:
+    parsed_titles = [parse_title(raw_title) for raw_title in title_list]
+  missing_years = len([1 for parsed in parsed_titles if not parsed[1]])
+  if missing_years:
+    print("WARNING:%d files do not appear to have a year" % missing_years)
   return parsed_titles
+
+'''
+SUMMARY
+-------
+Parse raw titles in a pool of processes
+The input is split into chunks that are parsed in parallel, only a few chunks
+per process are in flight at a time and results come back in input order
+-------
+INPUT: iterable of raw title strings
+       optional number of processes, defaults to the number of cores
+       optional number of titles per chunk
+       optional multiprocessing Pool to use instead of starting one
+OUTPUT: generator of 2-tuples (raw title, (title,year,file extension))
+'''
+def iter_parse_titles(raw_titles,jobs=None,chunk_size=10000,pool=None):
+  raw_titles = iter(raw_titles)
+  chunks = iter(lambda: list(islice(raw_titles,chunk_size)),[])
+  for chunk, parsed_chunk in iter_pool_results(parse_title_chunk,chunks,jobs,
+                                               pool):
+    for raw_title, parsed in zip(chunk,parsed_chunk):
+      yield (raw_title,parsed)
+
+'''
+SUMMARY
+-------
+Parse a title listing file in a pool of processes
+The file is split into byte ranges on line boundaries and each process 
+memory-maps the file and parses its own ranges, so titles are never copied 
+between processes on the way in
+Results come back in file order
+-------
+INPUT: path to titles file
+       optional number of processes, defaults to the number of cores
+       optional approximate number of bytes per chunk
+       optional multiprocessing Pool to use instead of starting one
+OUTPUT: generator of 2-tuples (raw title, (title,year,file extension))
+'''
+def iter_parse_title_file(titles_file,jobs=None,chunk_bytes=1<<20,pool=None):
+  ranges = ((titles_file,start,end) for (start,end) in
+            iter_title_ranges(titles_file,chunk_bytes))
+  for args, parsed_chunk in iter_pool_results(parse_title_range,ranges,jobs,
+                                              pool):
+    for item in parsed_chunk:
+      yield item
+
+'''
+SUMMARY
+-------
+Run func over the items of an iterable in a pool of processes, keeping only
+a few items per process in flight, and yield the results in input order
+-------
+INPUT: function taking one argument
+       iterable of arguments
+       optional number of processes, defaults to the number of cores
+       optional multiprocessing Pool to use instead of starting one
+OUTPUT: generator of 2-tuples (argument, result)
+'''
+def iter_pool_results(func,args_iterable,jobs=None,pool=None):
+  own_pool = pool is None
+  if own_pool:
+    pool = Pool(jobs or cpu_count())
+  max_pending = 2 * (jobs or cpu_count())
+  pending = deque()
+  args_iterable = iter(args_iterable)
+  try:
+    while True:
+      for args in islice(args_iterable,max_pending - len(pending)):
+        pending.append((args,pool.apply_async(func,(args,))))
+      if not pending:
+        break
+      args, result = pending.popleft()
+      yield (args,result.get())
+  finally:
+    if own_pool:
+      pool.terminate()
+
+'''
+SUMMARY
+-------
+Parse the titles in one byte range of a titles file, run in the worker 
+processes of iter_parse_title_file
+-------
+INPUT: 3-tuple (path to titles file, start offset, end offset)
+OUTPUT: list of 2-tuples (raw title, (title,year,file extension))
+'''
+def parse_title_range(args):
+  titles_file, start, end = args
+  return [(raw_title,parse_title(raw_title)) for raw_title in 
+          iter_titles_mmap(titles_file,start,end)]
+
+'''
+SUMMARY
+-------
+Parse one chunk of raw titles, run in the worker processes of 
+iter_parse_titles
+-------
+INPUT: list of raw title strings
+OUTPUT: list of 3-tuples (title,year,file extension)
+'''
+def parse_title_chunk(chunk):
+  return [parse_title(raw_title) for raw_title in chunk]
+
+'''
+SUMMARY
+-------
+Take in one raw title and return a 3-tuple with the title, year, and file
+extension, see parse_media_name
+-------
+INPUT: raw title string
+OUTPUT: 3-tuple (title,year,file extension)
+'''
+def parse_title(raw_title):
+  return tuple(parse_media_name(raw_title)[:3])
+
+'''
+SUMMARY
+-------
+Parse a raw title in a single pass over its words, finding
+  the file extension, if it is one of config.MOVIE_FILE_EXTENSIONS
+  the year in parentheses, "Title (1999)", the title is everything before it
+  TV episode markers, "Show S01E02"
+  quality and source tags, "1080p", "BluRay", "x264", ...
+  a bare year, "Title.1999.1080p", only when it is directly followed by an
+    episode marker or a tag, or ends a name that uses dots or underscores
+    instead of spaces, so "Class of 1999" keeps its title
+Without a year in parentheses the title is the words before the first marker,
+the first word always belongs to the title and dots or underscores used as
+separators are turned into spaces
+Results are cached in PARSE_CACHE, since the same names come up repeatedly
+-------
+INPUT: raw title string
+       optional use_cache, False to skip PARSE_CACHE
+OUTPUT: ParsedTitle (title,year,ext,season,episode,tags)
+        year, season and episode are 0 and ext is "" when not found
+        ie ParsedTitle("This movie",1999,"mp4",0,0,("1080p",))
+'''
+def parse_media_name(raw_title,use_cache=True):
+  if use_cache:
+    parsed = PARSE_CACHE.get(raw_title)
+    if parsed is not None:
+      return parsed
+  stem, period, ext = raw_title.rpartition('.')
+  if not period or (ext not in TITLE_EXTENSIONS and
+                    ext.lower() not in TITLE_EXTENSIONS):
+    stem = raw_title
+    ext = ""
+  year = season = episode = 0
+  tags = ()
+  #the usual "Title (1999)", with anything after the year read as words
+  title, left_par, rest = stem.rpartition('(')
+  right_par_ind = rest.find(')')
+  if left_par and right_par_ind != -1:
+    year = TITLE_YEARS.get(rest[:right_par_ind].strip(),0)
+    if year:
+      rest = rest[right_par_ind+1:]
+      if rest and not rest.isspace():
+        season, episode, tags = parse_title_words(split_title_words(rest),0)[1:4]
+  if not year:
+    words = split_title_words(stem)
+    if len(words) > 1:
+      title_end, season, episode, tags, year = \
+        parse_title_words(words,1," " not in stem)
+      words = words[:title_end]
+    title = " ".join(words)
+  title = title.strip(" _-[(")
+  if " " not in title:
+    title = title.replace("."," ").replace("_"," ").strip()
+  parsed = new_tuple(ParsedTitle,(title,year,ext,season,episode,tags))
+  if use_cache:
+    if len(PARSE_CACHE) >= PARSE_CACHE_SIZE:
+      PARSE_CACHE.clear()
+    PARSE_CACHE[raw_title] = parsed
+  return parsed
+
+'''
+SUMMARY
+-------
+Split the part of a raw title without the extension into words, on spaces or,
+for scene style names without spaces, on dots and underscores
+-------
+INPUT: string
+OUTPUT: list of words
+'''
+def split_title_words(stem):
+  if " " in stem:
+    return stem.split()
+  return stem.replace("_",".").split(".")
+
+'''
+SUMMARY
+-------
+Find the episode marker, tags and bare year among the words of a title for
+parse_media_name
+-------
+INPUT: list of words
+       index of the first word that can be a marker
+       optional allow_last_year, True if a bare year can end the words
+OUTPUT: 5-tuple (index of the first marker or the number of words, season,
+        episode, tuple of tags, bare year)
+        season, episode and year are 0 when not found
+'''
+def parse_title_words(words,first,allow_last_year=False):
+  title_end = len(words)
+  season = episode = year = 0
+  tags = []
+  i = first
+  while i < len(words):
+    start = i
+    word = words[i].strip("[]()")
+    lower_word = word.lower()
+    if lower_word in TITLE_TAGS:
+      tags.append(word)
+      title_end = min(title_end,i)
+    elif word[:1] in "Ss" and word[1:2].isdigit():
+      match = EPISODE_WORD.match(word)
+      if match:
+        episode_num = match.group(2)
+        if episode_num is None and i + 1 < len(words):
+          half = EPISODE_HALF.match(words[i+1])
+          if half:
+            episode_num = half.group(1)
+            i += 1
+        if episode_num is not None:
+          season = int(match.group(1))
+          episode = int(episode_num)
+          title_end = min(title_end,start)
+    elif word in TITLE_YEARS and i < title_end and not year:
+      #a bare year is only one if what follows it is not part of the title
+      next_word = words[i+1].strip("[]()") if i + 1 < len(words) else ""
+      if (not next_word and allow_last_year) or \
+         next_word.lower() in TITLE_TAGS or EPISODE_WORD.match(next_word):
+        year = TITLE_YEARS[word]
+        title_end = i
+    i += 1
+  return (title_end,season,episode,tuple(tags),year)
+
+'''
+SUMMARY
+-------
+Time parse_media_name against the two step parse_extension and parse_year
+on the titles of a file repeated a number of times
+-------
+INPUT: optional path to titles file, defaults to AllMovies.txt
+       optional number of times to repeat the titles
+       optional number of rounds, the fastest round of each parser is kept
+         so that other load on the machine does not skew the comparison
+OUTPUT: dict of seconds per title for "two_step", "single_pass" and 
+        "single_pass_cached"
+'''
+def benchmark_parsers(titles_file="AllMovies.txt",copies=2500,rounds=3):
+  titles = get_titles_from_file(titles_file) * copies
+  results = {}
+  for i in range(rounds):
+    times = {}
+    start = time.time()
+    for raw_title in titles:
+      title, ext = parse_extension(raw_title)
+      title, year = parse_year(title)
+      title.strip()
+    times["two_step"] = (time.time() - start) / len(titles)
+    start = time.time()
+    for raw_title in titles:
+      parse_media_name(raw_title,use_cache=False)
+    times["single_pass"] = (time.time() - start) / len(titles)
+    PARSE_CACHE.clear()
+    start = time.time()
+    for raw_title in titles:
+      parse_media_name(raw_title)
+    times["single_pass_cached"] = (time.time() - start) / len(titles)
+    for name, seconds in times.items():
+      results[name] = min(results.get(name,seconds),seconds)
+  return results
   
 '''
 SUMMARY
@@ -111,6 +622,52 @@ def parse_year(title):
   return (title,year)
 
 if __name__ == "__main__":
+  import shutil, sys, tempfile
+  scan_root = tempfile.mkdtemp()
+  os.makedirs(os.path.join(scan_root,"a","b"))
+  for name in ["a/Heat (1995).mp4","a/b/Ronin (1998).AVI","a/notes.txt","x.m4v"]:
+    open(os.path.join(scan_root,name),"w").close()
+  scanned = sorted([f.path for f in scan_media_files(scan_root,workers=2)])
+  assert (scanned == [os.path.join(scan_root,name) for name in 
+                      ["a/Heat (1995).mp4","a/b/Ronin (1998).AVI","x.m4v"]])
+  shutil.rmtree(scan_root)
+  listing = get_titles_from_file("AllMovies.txt")
+  assert (list(iter_titles_mmap("AllMovies.txt")) == listing)
+  ranges = list(iter_title_ranges("AllMovies.txt",chunk_bytes=1000))
+  assert (len(ranges) > 1)
+  assert ([t for (s,e) in ranges for t in iter_titles_mmap("AllMovies.txt",s,e)] 
+          == listing)
+  assert ([raw for (raw,parsed) in iter_parse_title_file("AllMovies.txt",2,1000)]
+          == listing)
+  for raw_title in listing:
+    old_title, ext = parse_extension(raw_title)
+    old_title, year = parse_year(old_title)
+    assert (parse_title(raw_title) == (old_title.strip(),year,ext))
+  assert (parse_media_name("Blade Runner 2049 (2017).mp4")[:3] == 
+          ("Blade Runner 2049",2017,"mp4"))
+  assert (parse_media_name("The.Matrix.1999.1080p.BluRay.x264.MP4") ==
+          ("The Matrix",1999,"MP4",0,0,("1080p","BluRay","x264")))
+  assert (parse_media_name("Some Show S02E10 720p HDTV.avi") ==
+          ("Some Show",0,"avi",2,10,("720p","HDTV")))
+  assert (parse_media_name("2001 A Space Odyssey (1968)")[:2] == 
+          ("2001 A Space Odyssey",1968))
+  #a bare year is part of the title unless markers follow it
+  assert (parse_media_name("Blade Runner 2049.mp4")[:3] ==
+          ("Blade Runner 2049",0,"mp4"))
+  assert (parse_media_name("Class of 1999.avi")[:3] == ("Class of 1999",0,"avi"))
+  assert (parse_media_name("The Matrix 1999 1080p.mp4")[:2] == ("The Matrix",1999))
+  assert (parse_media_name("Heat_1995_720p.mp4") ==
+          ("Heat",1995,"mp4",0,0,("720p",)))
+  #as is a tag that starts the title or comes before a year in parentheses
+  assert (parse_media_name("Dts Movie (2000).avi")[:3] == ("Dts Movie",2000,"avi"))
+  assert (parse_media_name("Heat (1995) 1080p BluRay.mp4") ==
+          ("Heat",1995,"mp4",0,0,("1080p","BluRay")))
+  assert (parse_media_name("Some Show S02 E10.avi") ==
+          ("Some Show",0,"avi",2,10,()))
+  if sys.argv[1:2] == ["benchmark"]:
+    results = benchmark_parsers()
+    print(results)
+    assert (results["single_pass"] <= results["two_step"])
   x = get_titles_from_file()
   y = parse_titles(x)
 #  for item in y:
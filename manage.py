@@ -1,31 +1,81 @@
-import getTitles
+import config
 import sys
 
-from MediaClass import Media
+from Fingerprint import duplicate_report, fingerprint_manifest
+from FuzzyMatch import fuzzy_link_media
+from ImdbIndex import build_index, link_media
+from MediaProbe import probe_manifest
+from Pipeline import ingest_file
+from Rescan import rescan
 
 def print_usage():
-  print("There is only one option right now:")
-  print("extract file(optional)")
+  print("Options:")
+  print("extract file(optional) --jobs number_of_processes(optional)")
+  print("rescan directory(optional)")
+  print("duplicates")
+  print("probe directory(optional)")
+  print("imdb title_basics_file(optional)")
+  print("link --fuzzy(optional)")
 
 if __name__ == "__main__":
-  for i in range(1,len(sys.argv)):
+  i = 1
+  while i < len(sys.argv):
     arg = sys.argv[i]
-    if arg.lower() == "extract":
-      the_file = None
+    if arg.lower() == "rescan":
+      the_dir = ""
       if i < (len(sys.argv)-1):
-        the_file = sys.argv[i+1]
+        the_dir = sys.argv[i+1]
         i += 2
       else:
         i += 1
-      if the_file:
-        raw_titles = getTitles.get_titles_from_file(the_file)
-      else:
-        raw_titles = getTitles.get_titles_from_file()
-      parsed_titles = getTitles.parse_titles(raw_titles)
-      for item in parsed_titles:
-        m = Media()
-        m.title = item[0]
-        m.year = item[1]
-        m.save()
+      added, changed, removed = rescan(the_dir)
+      print("Added: %d Changed: %d Removed: %d" % \
+            (len(added),len(changed),len(removed)))
+    elif arg.lower() == "extract":
+      the_file = None
+      jobs = 1
+      i += 1
+      if i < len(sys.argv) and not sys.argv[i].startswith("--"):
+        the_file = sys.argv[i]
+        i += 1
+      if i < (len(sys.argv)-1) and sys.argv[i] == "--jobs":
+        jobs = int(sys.argv[i+1])
+        i += 2
+      if not the_file:
+        the_file = config.MOVIE_TITLES_FILE
+      saved = ingest_file(the_file,jobs=jobs)
+      print("Saved: %d" % saved)
+    elif arg.lower() == "probe":
+      the_dir = ""
+      i += 1
+      if i < len(sys.argv):
+        the_dir = sys.argv[i]
+        i += 1
+      print("Probed: %d" % probe_manifest(the_dir))
+    elif arg.lower() == "imdb":
+      the_file = None
+      i += 1
+      if i < len(sys.argv):
+        the_file = sys.argv[i]
+        i += 1
+      print("Indexed: %d" % build_index(the_file))
+    elif arg.lower() == "link":
+      i += 1
+      linked, missing = link_media()
+      print("Linked: %d Not found: %d" % (linked,missing))
+      if i < len(sys.argv) and sys.argv[i] == "--fuzzy":
+        i += 1
+        linked, missing = fuzzy_link_media()
+        print("Fuzzy linked: %d Not matched: %d" % (linked,missing))
+    elif arg.lower() == "duplicates":
+      i += 1
+      print("Fingerprinted: %d" % fingerprint_manifest())
+      for group in duplicate_report():
+        print("%s (%s)" % (group.title,group.year))
+        for fingerprint, paths in group.copies.items():
+          print("  %s" % (fingerprint or "not fingerprinted"))
+          for path in paths:
+            print("    %s" % path)
     else:
-      print_usage()
\ No newline at end of file
+      print_usage()
+      i += 1
\ No newline at end of file